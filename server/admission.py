@@ -0,0 +1,190 @@
+"""
+Admission control for calls to a rate-limited upstream (Vertex AI).
+
+A caller must hold a slot before calling out. A slot needs a free
+concurrency permit and a token from a bucket refilled at `rate` per second.
+Callers that cannot get one straight away wait in a priority queue (lower
+number first, FIFO within a priority) for at most `max_wait` seconds. When
+the queue for a priority is already full, or the deadline passes, they get
+AdmissionRejected right away with a Retry-After hint instead of piling onto
+the upstream quota. After an upstream quota error `penalize()` pauses
+admissions briefly so the backlog does not hammer an exhausted quota.
+
+All state is touched only from the event loop thread, so there are no locks.
+"""
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Dict
+
+USER = 0
+ADMIN = 1
+PRIORITY_NAMES = {USER: "user", ADMIN: "admin"}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, name: str, reason: str, retry_after: int, status_code: int = 503):
+        super().__init__(f"{name} admission rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class AdmissionController:
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int,
+                 max_queue: int, max_wait: float, admin_queue_share: float = 0.25):
+        self.name = name
+        self.rate = rate  # tokens per second; 0 disables the bucket
+        self.burst = max(1, burst)
+        self.concurrency = max(1, concurrency)
+        self.max_wait = max_wait
+        # Lower-priority (admin) callers may only fill part of the queue, so a
+        # burst of admin work can never crowd user requests out of it.
+        self.queue_limits = {USER: max_queue, ADMIN: max(1, int(max_queue * admin_queue_share))}
+
+        self.tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self.in_flight = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._waiting = {USER: 0, ADMIN: 0}
+        self._timer = None
+        self._stats = {
+            "admitted": 0, "rejected_queue_full": 0, "rejected_deadline": 0,
+            "quota_errors": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+        }
+        self._admitted_by_priority = {USER: 0, ADMIN: 0}
+
+    # --- token bucket ---
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rate)
+        else:
+            self.tokens = float(self.burst)
+        self._refilled = now
+
+    def _retry_after(self) -> int:
+        now = time.monotonic()
+        backlog = sum(self._waiting.values()) + 1
+        wait = backlog / self.rate if self.rate > 0 else backlog / self.concurrency
+        return max(1, math.ceil(max(wait, self._paused_until - now)))
+
+    # --- queue ---
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+
+        def fire():
+            self._timer = None
+            self._dispatch()
+
+        self._timer = loop.call_later(max(delay, 0.001), fire)
+
+    def _dispatch(self):
+        while self._heap:
+            priority, _, enqueued, fut = self._heap[0]
+            if fut.done():  # abandoned (deadline or caller cancelled)
+                heapq.heappop(self._heap)
+                continue
+            if self.in_flight >= self.concurrency:
+                return  # release() dispatches again
+            now = time.monotonic()
+            if now < self._paused_until:
+                self._schedule(self._paused_until - now)
+                return
+            self._refill(now)
+            if self.tokens < 1:
+                self._schedule((1 - self.tokens) / self.rate)
+                return
+            heapq.heappop(self._heap)
+            self.tokens -= 1
+            self.in_flight += 1
+            self._waiting[priority] -= 1
+            fut.set_result(now - enqueued)
+
+    async def acquire(self, priority: int = USER):
+        """Waits for a slot; raises AdmissionRejected when shed."""
+        now = time.monotonic()
+        if not self._heap and self.in_flight < self.concurrency and now >= self._paused_until:
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.in_flight += 1
+                self._admit(priority, 0.0)
+                return
+
+        if self._waiting[priority] >= self.queue_limits[priority]:
+            self._stats["rejected_queue_full"] += 1
+            raise AdmissionRejected(self.name, "queue full", self._retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), now, fut))
+        self._waiting[priority] += 1
+        self._dispatch()
+        try:
+            await asyncio.wait({fut}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._abandon(priority, fut)
+            raise
+        if not fut.done():
+            self._abandon(priority, fut)
+            self._stats["rejected_deadline"] += 1
+            raise AdmissionRejected(self.name, "queue deadline exceeded", self._retry_after())
+        self._admit(priority, fut.result())
+
+    def _abandon(self, priority: int, fut: asyncio.Future):
+        if fut.done() and not fut.cancelled():
+            # Granted just as the caller gave up: hand the slot back.
+            self.release()
+            return
+        fut.cancel()
+        self._waiting[priority] -= 1
+
+    def _admit(self, priority: int, waited: float):
+        wait_ms = waited * 1000
+        self._stats["admitted"] += 1
+        self._stats["wait_ms_total"] += wait_ms
+        self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+        self._admitted_by_priority[priority] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = USER):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def penalize(self, seconds: float):
+        """Upstream reported quota exhaustion: hold admissions for `seconds`."""
+        self._stats["quota_errors"] += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def stats(self) -> Dict:
+        data = dict(self._stats)
+        admitted = data["admitted"]
+        data["wait_ms_avg"] = round(data.pop("wait_ms_total") / admitted, 1) if admitted else 0.0
+        data["wait_ms_max"] = round(data["wait_ms_max"], 1)
+        data.update({
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "queue_depth": sum(self._waiting.values()),
+            "queue_depth_by_priority": {PRIORITY_NAMES[p]: n for p, n in self._waiting.items()},
+            "admitted_by_priority": {PRIORITY_NAMES[p]: n for p, n in self._admitted_by_priority.items()},
+            "tokens": round(self.tokens, 2),
+            "rate_per_sec": self.rate,
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 1),
+        })
+        return data
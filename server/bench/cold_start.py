@@ -0,0 +1,137 @@
+"""
+Cold start: how long a fresh process takes to import the app and to answer
+its first requests.
+
+- Import report: `python -X importtime -c "import main"` in a clean
+  interpreter, listing main's direct imports by cumulative time.
+- Cold start: launches `uvicorn main:app` --runs times and measures, from
+  process spawn, the first 200 from / and from /templates, and when /ready
+  flips (background client warmup done). Cloud credentials are not needed;
+  without them warmup ends with the optional clients failed, as in local dev.
+
+    cd server && python -m bench.cold_start --runs 5
+
+tests/test_cold_start.py turns the /ready and first-poster times into
+pass/fail budgets for the test suite.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+
+import requests
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from bench import fakes
+
+
+def _env() -> dict:
+    env = dict(os.environ, PYTHONPATH=SERVER_DIR)
+    # No project: Vertex is optional, so /ready flips once warmup has run.
+    env.pop("GOOGLE_CLOUD_PROJECT", None)
+    return env
+
+
+def import_report(top: int = 12) -> dict:
+    """Total import time of `main` and its slowest direct imports, in ms."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          env=_env(), capture_output=True, text=True, check=True)
+    total_ms, modules = None, []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        ms = int(cumulative) / 1000
+        if name.strip() == "main":
+            total_ms = ms
+        elif name.startswith("   ") and not name.startswith("    "):
+            # Two-space indent past the column separator: imported by main itself.
+            modules.append((name.strip(), ms))
+    modules.sort(key=lambda m: m[1], reverse=True)
+    return {"import_ms": round(total_ms or 0.0, 1), "slowest": [[n, round(ms, 1)] for n, ms in modules[:top]]}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url: str, deadline: float, ok=(200,)) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code in ok:
+                return time.perf_counter()
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    raise TimeoutError(url)
+
+
+def cold_start(timeout: float = 60.0) -> dict:
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        env=_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = t0 + timeout
+        first = _wait_for(f"{base}/", deadline)
+        templates = _wait_for(f"{base}/templates", deadline)
+        try:
+            ready = _wait_for(f"{base}/ready", deadline)
+        except TimeoutError:
+            ready = None
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return {
+        "first_response_ms": round((first - t0) * 1000, 1),
+        "templates_ms": round((templates - t0) * 1000, 1),
+        "ready_ms": round((ready - t0) * 1000, 1) if ready else None,
+    }
+
+
+def run(runs: int = 5) -> dict:
+    """Import report plus the median of `runs` cold starts."""
+    report = import_report()
+    samples = [cold_start() for _ in range(runs)]
+    result = dict(report)
+    for key in ("first_response_ms", "templates_ms", "ready_ms"):
+        values = [s[key] for s in samples if s[key] is not None]
+        result[key] = round(statistics.median(values), 1) if values else None
+    result["runs"] = samples
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    fakes.prepare_env()
+    result = run(args.runs)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"import main: {result['import_ms']:.0f} ms; slowest direct imports:")
+    for name, ms in result["slowest"]:
+        print(f"  {name:<32}{ms:>10.1f} ms")
+    print(f"cold start (median of {args.runs}): / {result['first_response_ms']:.0f} ms, "
+          f"/templates {result['templates_ms']:.0f} ms, /ready {result['ready_ms']} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Accuracy and latency of the face-detection backends over a labelled fixture set.
+
+The fixture directory holds images plus a `labels.json` mapping each file name
+to its main face box `[x, y, w, h]` in EXIF-rotated pixels (or null for "no
+face"). A detection counts as a hit when IoU with the label is >= --iou.
+
+    cd server && python -m bench.face_detect --fixtures /path/to/faces --backends local,vision
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+from PIL import ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_detect import LocalFaceDetector, VisionFaceDetector, largest_face, VISION_MAX_SIDE
+import pipeline
+
+
+def iou(a, b) -> float:
+    ax0, ay0, aw, ah = a
+    bx0, by0, bw, bh = b
+    ix = max(0, min(ax0 + aw, bx0 + bw) - max(ax0, bx0))
+    iy = max(0, min(ay0 + ah, by0 + bh) - max(ay0, by0))
+    inter = ix * iy
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+
+def _vision_client():
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+
+def build_backends(names):
+    backends = {}
+    for name in names:
+        if name == "local":
+            backends[name] = LocalFaceDetector()
+        elif name == "vision":
+            client = _vision_client()
+            backends[name] = VisionFaceDetector(lambda: client)
+        else:
+            raise SystemExit(f"unknown backend '{name}'")
+    return backends
+
+
+def run(fixtures: str, backends, iou_threshold: float):
+    with open(os.path.join(fixtures, "labels.json")) as f:
+        labels = json.load(f)
+
+    for name, detector in backends.items():
+        latencies, ious = [], []
+        hits = 0
+        for filename, label in labels.items():
+            with open(os.path.join(fixtures, filename), "rb") as f:
+                content = f.read()
+            # Same decode the server does before detection.
+            img, scale = pipeline.decode_user_photo(content, max_side=VISION_MAX_SIDE)
+            img = ImageOps.exif_transpose(img)
+
+            t0 = time.perf_counter()
+            face = largest_face(detector.detect(img))
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+            if face:
+                face = tuple(int(v / scale) for v in face)
+            if label is None:
+                hits += face is None
+                continue
+            overlap = iou(face, label) if face else 0.0
+            ious.append(overlap)
+            hits += overlap >= iou_threshold
+
+        latencies.sort()
+        print(f"{name:<8} n={len(labels)} accuracy={hits / len(labels):.1%} "
+              f"mean_iou={statistics.mean(ious) if ious else 0:.3f} "
+              f"p50={latencies[len(latencies) // 2]:.1f}ms "
+              f"p95={latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", required=True, help="Directory with images and labels.json")
+    parser.add_argument("--backends", default="local", help="Comma-separated: local, vision")
+    parser.add_argument("--iou", type=float, default=0.5)
+    args = parser.parse_args()
+    run(args.fixtures, build_backends(args.backends.split(",")), args.iou)
+
+
+if __name__ == "__main__":
+    main()
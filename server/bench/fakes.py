@@ -0,0 +1,124 @@
+"""
+Deterministic stand-ins for the Google services, so the whole
+/generate-meme path can be benchmarked offline.
+
+- FakeVisionClient: `face_detection()` answers from a fixture file
+  (`{"<sha256 of the submitted JPEG>": [[x, y, w, h], ...]}`) or, by default,
+  with one face box at a fixed fraction of the image.
+- FakeImagenModel: `edit_image()` / `generate_images()` sleep for a
+  configurable latency and return the template (or a flat poster).
+- GCS: object_store.FakeStorageClient (directory-backed).
+
+`prepare_env()` must run before `import main`; `install(main)` then swaps
+the fakes into the client registry before the app warms up.
+"""
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from PIL import Image as PILImage
+
+# Default face: centered horizontally, in the upper third, like a poster lead.
+DEFAULT_FACE = (0.38, 0.18, 0.24, 0.22)
+
+
+def _vertex(x, y):
+    return SimpleNamespace(x=int(x), y=int(y))
+
+
+class FakeVisionClient:
+    def __init__(self, fixtures: Optional[Dict[str, List[List[int]]]] = None, latency: float = 0.0):
+        self.fixtures = fixtures or {}
+        self.latency = latency
+        self.calls = 0
+
+    @classmethod
+    def from_file(cls, path: Optional[str], latency: float = 0.0) -> "FakeVisionClient":
+        fixtures = None
+        if path:
+            with open(path) as f:
+                fixtures = json.load(f)
+        return cls(fixtures, latency)
+
+    def face_detection(self, image=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        content = image.content
+        boxes = self.fixtures.get(hashlib.sha256(content).hexdigest())
+        if boxes is None:
+            w, h = PILImage.open(io.BytesIO(content)).size
+            fx, fy, fw, fh = DEFAULT_FACE
+            boxes = [[w * fx, h * fy, w * fw, h * fh]]
+        faces = [
+            SimpleNamespace(bounding_poly=SimpleNamespace(vertices=[
+                _vertex(x, y), _vertex(x + bw, y), _vertex(x + bw, y + bh), _vertex(x, y + bh),
+            ]))
+            for x, y, bw, bh in boxes
+        ]
+        return SimpleNamespace(face_annotations=faces, error=SimpleNamespace(message=""))
+
+
+class FakeImagenModel:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+
+    def _sleep(self):
+        if self.latency:
+            # Deterministic jitter: cycles through [-jitter, +jitter].
+            offset = self.jitter * (((self.calls * 7) % 11) / 5.0 - 1.0)
+            time.sleep(max(0.0, self.latency + offset))
+
+    def edit_image(self, base_image=None, **kwargs):
+        self.calls += 1
+        self._sleep()
+        return SimpleNamespace(images=[SimpleNamespace(image_bytes=base_image._image_bytes)])
+
+    def generate_images(self, prompt: str = "", number_of_images: int = 1, **kwargs):
+        self.calls += 1
+        self._sleep()
+        buf = io.BytesIO()
+        PILImage.new("RGB", (896, 1200), (40, 30, 60)).save(buf, format="PNG")
+        return [SimpleNamespace(image_bytes=buf.getvalue()) for _ in range(number_of_images)]
+
+
+def prepare_env(workdir: Optional[str] = None) -> str:
+    """Points the app's config at a scratch dir and the fake bucket; call before `import main`."""
+    workdir = workdir or tempfile.mkdtemp(prefix="epicmeme-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench-offline")
+    os.environ.setdefault("STORAGE_BACKEND", "fake")
+    os.environ.setdefault("FACE_DETECTOR", "vision")
+    # Measure the pipeline, not the production Vertex rate limit (set it to test shedding).
+    os.environ.setdefault("VERTEX_RATE_PER_SEC", "0")
+    os.environ.setdefault("TEMPLATE_DB_PATH", os.path.join(workdir, "templates.db"))
+    return workdir
+
+
+def install(app_module, vertex_latency: float = 0.0, vertex_jitter: float = 0.0,
+            vision_latency: float = 0.0, vision_fixtures: Optional[str] = None) -> SimpleNamespace:
+    """Replaces the vision/vertex/imagen handles of `app_module.clients` with fakes."""
+    vision = FakeVisionClient.from_file(vision_fixtures, vision_latency)
+    imagen = FakeImagenModel(vertex_latency, vertex_jitter)
+    clients = app_module.clients
+    clients.register("vision", lambda: vision, required=False)
+    clients.register("vertex", lambda: True, required=True)
+    clients.register("imagen", lambda: imagen, required=True)
+    return SimpleNamespace(vision=vision, imagen=imagen)
+
+
+def synthetic_photo(size, seed_color, quality: int = 90) -> bytes:
+    """Noisy JPEG so decoders and encoders see something closer to a real photo."""
+    noise = PILImage.effect_noise(size, 64).convert("RGB")
+    base = PILImage.new("RGB", size, seed_color)
+    buf = io.BytesIO()
+    PILImage.blend(base, noise, 0.35).save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
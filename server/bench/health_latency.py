@@ -0,0 +1,124 @@
+"""
+Health-check latency while generations are running.
+
+Starts the app on a local port, measures `GET /` latency at idle, then again
+while `--concurrency` clients hammer `/generate-meme` (mock inpainting path,
+so no cloud access is needed). With blocking work off the event loop the two
+distributions should be close.
+
+    cd server && python -m bench.health_latency --concurrency 8 --duration 10
+"""
+import io
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import statistics
+
+import requests
+from PIL import Image as PILImage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _jpeg(size, color) -> bytes:
+    buf = io.BytesIO()
+    PILImage.new("RGB", size, color).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "n": len(ordered),
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 2),
+    }
+
+
+def _probe_health(base, stop, samples, interval=0.05):
+    session = requests.Session()
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        session.get(f"{base}/", timeout=30).raise_for_status()
+        samples.append(time.perf_counter() - t0)
+        time.sleep(interval)
+
+
+def _generate_loop(base, stop, user_jpeg, template_jpeg, done, failures):
+    session = requests.Session()
+    form = {
+        "template_id": "bench", "user_name": "Bench User", "movie_title": "Load Test",
+        "tagline": "In a world...", "cover_text": "Coming soon", "tone": "Action", "costume_description": "a suit",
+    }
+    while not stop.is_set():
+        files = {
+            "user_photo": ("user.jpg", user_jpeg, "image/jpeg"),
+            "template_photo": ("template.jpg", template_jpeg, "image/jpeg"),
+        }
+        r = session.post(f"{base}/generate-meme", data=form, files=files, timeout=120)
+        (done if r.status_code == 200 else failures).append(r.status_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    import uvicorn
+    import main as app_module
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    base = f"http://127.0.0.1:{port}"
+
+    user_jpeg = _jpeg((2400, 3200), (180, 140, 120))
+    template_jpeg = _jpeg((2000, 3000), (30, 60, 90))
+
+    idle = []
+    stop = threading.Event()
+    probe = threading.Thread(target=_probe_health, args=(base, stop, idle))
+    probe.start()
+    time.sleep(min(3.0, args.duration))
+    stop.set(); probe.join()
+
+    loaded, done, failures = [], [], []
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=_generate_loop, args=(base, stop, user_jpeg, template_jpeg, done, failures))
+        for _ in range(args.concurrency)
+    ]
+    for w in workers: w.start()
+    probe = threading.Thread(target=_probe_health, args=(base, stop, loaded))
+    probe.start()
+    time.sleep(args.duration)
+    stop.set()
+    probe.join()
+    for w in workers: w.join()
+    server.should_exit = True
+
+    print(f"health idle:      {_percentiles(idle)}")
+    print(f"health under load:{_percentiles(loaded)}")
+    print(f"generations: ok={len(done)} failed={len(failures)} ({args.concurrency} concurrent, {args.duration}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Bytes and milliseconds per CPU stage: legacy decode/encode chain vs the
+single-decode pipeline, across output codecs.
+
+    cd server && python -m bench.image_pipeline --repeat 5
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+
+from PIL import Image as PILImage, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+from template_prep import normalize_template, build_mask
+
+
+def synthetic_photo(size, seed_color) -> bytes:
+    """Noisy JPEG so encoders see something closer to a real photo than a flat fill."""
+    noise = PILImage.effect_noise(size, 64).convert("RGB")
+    base = PILImage.new("RGB", size, seed_color)
+    buf = io.BytesIO()
+    PILImage.blend(base, noise, 0.35).save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+
+def _png(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def legacy_chain(user_jpeg: bytes, template_jpeg: bytes, face_bounds, credits: str):
+    """The pre-pipeline sequence: every stage decodes its input and re-encodes PNG."""
+    stages = {}
+
+    t0 = time.perf_counter()
+    user_pil = ImageOps.exif_transpose(PILImage.open(io.BytesIO(user_jpeg))).convert("RGB")
+    ux, uy, uw, uh = face_bounds
+    pad = int(uw * 0.5)
+    user_pil = user_pil.crop((max(0, ux - pad), max(0, uy - pad),
+                              min(user_pil.width, ux + uw + pad), min(user_pil.height, uy + uh + pad)))
+    user_png = _png(user_pil)
+    stages["user_crop"] = (time.perf_counter() - t0, len(user_png))
+
+    t0 = time.perf_counter()
+    template_pil = normalize_template(template_jpeg)
+    template_png = _png(template_pil)
+    stages["template_prep"] = (time.perf_counter() - t0, len(template_png))
+
+    t0 = time.perf_counter()
+    mask_png = _png(build_mask(template_pil.size, None, "no_vision"))
+    stages["mask"] = (time.perf_counter() - t0, len(mask_png))
+
+    t0 = time.perf_counter()
+    template_pil = PILImage.open(io.BytesIO(template_png)).convert("RGB")
+    template_pil.paste(PILImage.open(io.BytesIO(user_png)).resize((200, 200)), (100, 100))
+    composite_png = _png(template_pil)
+    stages["inpaint_stand_in"] = (time.perf_counter() - t0, len(composite_png))
+
+    t0 = time.perf_counter()
+    img = pipeline.apply_overlays(PILImage.open(io.BytesIO(composite_png)), "Bench User", "Load Test", credits)
+    final_png = _png(img)
+    stages["overlay_encode"] = (time.perf_counter() - t0, len(final_png))
+    return stages
+
+
+def single_decode_chain(user_jpeg: bytes, template_png: bytes, face_bounds, credits: str, output):
+    """Template and mask come from ingest-time artifacts, so they cost nothing here."""
+    stages = {}
+
+    t0 = time.perf_counter()
+    user_png = pipeline.crop_user_photo(user_jpeg, face_bounds)
+    stages["user_crop"] = (time.perf_counter() - t0, len(user_png))
+
+    t0 = time.perf_counter()
+    final = pipeline.finish_poster(template_png, "Bench User", "Load Test", credits, output, mock_user_png=user_png)
+    stages["overlay_encode"] = (time.perf_counter() - t0, len(final))
+    return stages
+
+
+def _summarize(runs):
+    out = {}
+    for stage in runs[0]:
+        ms = [r[stage][0] * 1000 for r in runs]
+        out[stage] = (statistics.median(ms), runs[0][stage][1])
+    return out
+
+
+def _print(label, summary):
+    total = sum(ms for ms, _ in summary.values())
+    print(f"\n{label}  (total {total:.1f} ms)")
+    for stage, (ms, size) in summary.items():
+        print(f"  {stage:<18} {ms:8.1f} ms  {size / 1024:9.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--user-size", default="4032x3024", help="Synthetic phone photo size, WxH")
+    args = parser.parse_args()
+
+    uw, uh = (int(v) for v in args.user_size.lower().split("x"))
+    user_jpeg = synthetic_photo((uw, uh), (180, 140, 120))
+    template_jpeg = synthetic_photo((2000, 3000), (30, 60, 90))
+    template_png = _png(normalize_template(template_jpeg))
+    face_bounds = (uw // 3, uh // 4, uw // 4, uw // 4)
+    credits = "DIRECTED BY MAX POWER   PRODUCED BY RIP STEEL"
+
+    print(f"user upload {uw}x{uh} ({len(user_jpeg) / 1024:.0f} KiB), {args.repeat} runs, median shown")
+    _print("legacy (decode/encode per stage, PNG)",
+           _summarize([legacy_chain(user_jpeg, template_jpeg, face_bounds, credits) for _ in range(args.repeat)]))
+
+    variants = [
+        ("png level 6", pipeline.OutputSettings("png", compress_level=6)),
+        ("png level 1", pipeline.OutputSettings("png", compress_level=1)),
+        ("webp q85", pipeline.OutputSettings("webp", quality=85, compress_level=4)),
+        ("jpeg q88", pipeline.OutputSettings("jpeg", quality=88)),
+    ]
+    for label, output in variants:
+        runs = [single_decode_chain(user_jpeg, template_png, face_bounds, credits, output) for _ in range(args.repeat)]
+        _print(f"single-decode, {label}", _summarize(runs))
+
+
+if __name__ == "__main__":
+    main()
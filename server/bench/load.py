@@ -0,0 +1,171 @@
+"""
+End-to-end load driver against the real app with fake Vision/Vertex/GCS.
+
+Starts the server on a local port in a scratch directory, uploads a
+template through the admin endpoint, then runs `--concurrency` clients
+against /generate-meme for `--duration` seconds. Each request carries a
+distinct user photo (so every one misses the result cache) unless
+--reuse-photos is given. Reports requests/s, latency percentiles, status
+codes, and peak RSS of the server plus its worker processes, also as growth
+over the warmed-up idle server per in-flight request. `--mode fast` drives
+the local compositor instead of the (fake) Vertex path.
+
+    cd server && python -m bench.load --concurrency 8 --duration 20 --vertex-latency 0.5
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import resource
+import threading
+import multiprocessing
+from collections import Counter
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import fakes
+from bench.health_latency import _percentiles
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _children_kb(field: str) -> int:
+    total_kb = 0
+    for child in multiprocessing.active_children():
+        try:
+            with open(f"/proc/{child.pid}/status") as f:
+                for line in f:
+                    if line.startswith(field):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return total_kb
+
+
+def _peak_rss_mb() -> float:
+    """Peak RSS of this process plus live worker processes (VmHWM), in MiB."""
+    total_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + _children_kb("VmHWM:")
+    return round(total_kb / 1024, 1)
+
+
+def _current_rss_mb() -> float:
+    """Current RSS of this process plus live worker processes (VmRSS), in MiB."""
+    with open("/proc/self/status") as f:
+        own_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    return round((own_kb + _children_kb("VmRSS:")) / 1024, 1)
+
+
+def _client(base, stop, template_url, user_jpeg, reuse, mode, latencies, statuses):
+    session = requests.Session()
+    form = {
+        "template_id": "bench", "template_url": template_url, "user_name": "Bench User",
+        "movie_title": "Load Test", "tagline": "In a world...", "cover_text": "Coming soon",
+        "tone": "Action", "costume_description": "a suit", "mode": mode,
+    }
+    while not stop.is_set():
+        # Trailing bytes after the JPEG EOI are ignored by decoders but change the hash.
+        photo = user_jpeg if reuse else user_jpeg + uuid.uuid4().bytes
+        t0 = time.perf_counter()
+        try:
+            r = session.post(f"{base}/generate-meme", data=form, timeout=120,
+                             files={"user_photo": ("user.jpg", photo, "image/jpeg")})
+            status = r.status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = time.perf_counter() - t0
+        statuses.append(status)
+        if status == 200:
+            latencies.append(elapsed)
+
+
+def run(concurrency: int = 8, duration: float = 20.0, vertex_latency: float = 0.5,
+        vision_latency: float = 0.05, reuse_photos: bool = False, user_size=(2400, 3200),
+        mode: str = "quality") -> dict:
+    import uvicorn
+    import main as app_module
+
+    fakes.install(app_module, vertex_latency=vertex_latency, vertex_jitter=vertex_latency * 0.2,
+                  vision_latency=vision_latency)
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    base = f"http://127.0.0.1:{port}"
+
+    r = requests.post(f"{base}/admin/upload-template-image", data={"template_id": "matrix"}, timeout=60,
+                      files={"file": ("template.jpg", fakes.synthetic_photo((1600, 2400), (30, 60, 90)), "image/jpeg")})
+    r.raise_for_status()
+    template_url = r.json()["url"]
+    user_jpeg = fakes.synthetic_photo(user_size, (180, 140, 120))
+    # Warm one request through so worker processes and caches exist before the baseline.
+    requests.post(f"{base}/generate-meme", timeout=120, data={
+        "template_id": "bench", "template_url": template_url, "user_name": "Warmup", "movie_title": "Warmup",
+        "tagline": "-", "cover_text": "-", "costume_description": "a suit", "mode": mode,
+    }, files={"user_photo": ("user.jpg", user_jpeg, "image/jpeg")})
+    idle_rss = _current_rss_mb()
+
+    latencies, statuses = [], []
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=_client, args=(base, stop, template_url, user_jpeg, reuse_photos, mode,
+                                                latencies, statuses))
+        for _ in range(concurrency)
+    ]
+    t0 = time.perf_counter()
+    for w in workers: w.start()
+    time.sleep(duration)
+    stop.set()
+    for w in workers: w.join()
+    elapsed = time.perf_counter() - t0
+    peak_rss = _peak_rss_mb()
+    server.should_exit = True
+    # Lets the lifespan shutdown stop the worker pools, so the process can exit.
+    server_thread.join(timeout=30)
+
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 2),
+        "requests": len(statuses),
+        "ok": len(latencies),
+        "rps": round(len(latencies) / elapsed, 2),
+        "statuses": {str(k): v for k, v in Counter(statuses).items()},
+        "latency": _percentiles(latencies),
+        "user_photo_bytes": len(user_jpeg),
+        "idle_rss_mb": idle_rss,
+        "peak_rss_mb": peak_rss,
+        # Growth over the warmed-up idle server, per in-flight request.
+        "rss_per_request_mb": round(max(0.0, peak_rss - idle_rss) / concurrency, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--vertex-latency", type=float, default=0.5, help="Seconds per fake Imagen call")
+    parser.add_argument("--vision-latency", type=float, default=0.05, help="Seconds per fake Vision call")
+    parser.add_argument("--reuse-photos", action="store_true", help="Send the same photo (result-cache hits)")
+    parser.add_argument("--mode", choices=("quality", "fast"), default="quality", help="Render mode to request")
+    parser.add_argument("--workdir", help="Scratch directory (default: a new temp dir)")
+    args = parser.parse_args()
+
+    fakes.prepare_env(args.workdir)
+    result = run(args.concurrency, args.duration, args.vertex_latency, args.vision_latency, args.reuse_photos,
+                 mode=args.mode)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Micro-benchmarks for the CPU hot spots, with the fake Vision backend:
+`generate_smart_mask` (downscale + detect + mask), the overlay stage and
+poster encode per output format. Prints a table, or JSON with --json.
+
+    cd server && python -m bench.micro --repeat 20
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+from PIL import Image as PILImage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import fakes
+
+POSTER_SIZE = (896, 1200)
+TEXT = ("Jane Doe", "Attack of the Fifty Foot Bench", "DIRECTED BY MAX POWER   PRODUCED BY RIP STEEL")
+
+
+def _time(fn, repeat: int, warmup: int = 2):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return {"median_ms": round(statistics.median(samples), 3), "min_ms": round(min(samples), 3)}
+
+
+def run(repeat: int = 20) -> dict:
+    """Returns {benchmark name: {"median_ms", "min_ms"}}."""
+    import main
+    import pipeline
+    from overlay import OverlayEngine
+
+    fakes.install(main)
+    template = PILImage.open(io.BytesIO(fakes.synthetic_photo(POSTER_SIZE, (60, 50, 90)))).convert("RGB")
+    poster = template.convert("RGBA")
+    engine = OverlayEngine()
+
+    results = {
+        "smart_mask": _time(lambda: main.generate_smart_mask(template), repeat),
+        "overlay": _time(lambda: engine.render(poster.copy(), *TEXT), repeat),
+    }
+    rendered = engine.render(poster.copy(), *TEXT)
+    for fmt in pipeline.OUTPUT_FORMATS:
+        output = pipeline.OutputSettings(fmt, 90, 6)
+        results[f"encode_{fmt}"] = _time(lambda: pipeline.encode_image(rendered, output), repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    fakes.prepare_env()
+    results = run(args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'benchmark':<16}{'median ms':>12}{'min ms':>12}")
+    for name, r in results.items():
+        print(f"{name:<16}{r['median_ms']:>12.2f}{r['min_ms']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Overlay stage before/after: the original per-request gradient + triple text
+draw versus the cached NumPy engine. Reports timings and the pixel difference.
+
+    cd server && python -m bench.overlay --repeat 20
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import numpy as np
+from PIL import Image as PILImage, ImageDraw, ImageFont, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from overlay import OverlayEngine, FONT_BOLD, FONT_REGULAR
+
+# Largest per-channel difference we accept (rounding in the blend).
+TOLERANCE = 1
+
+
+def legacy_overlays(img, user_name, movie_title, credits_text):
+    """Step 5 exactly as /generate-meme used to run it."""
+    gradient = PILImage.new('L', (img.width, img.height), 0)
+    g_draw = ImageDraw.Draw(gradient)
+    g_draw.rectangle((0, int(img.height*0.65), img.width, img.height), fill=230)
+    gradient = gradient.filter(ImageFilter.GaussianBlur(radius=60))
+    black_layer = PILImage.new('RGBA', img.size, (0,0,0,255))
+    black_layer.putalpha(gradient)
+    img = PILImage.alpha_composite(img.convert('RGBA'), black_layer)
+    draw = ImageDraw.Draw(img)
+
+    font_main = ImageFont.truetype(FONT_BOLD, 70)
+    font_title = ImageFont.truetype(FONT_BOLD, 100)
+    font_credits = ImageFont.truetype(FONT_REGULAR, 20)
+
+    def draw_centered(y, text, font, color="white"):
+        if not text: return
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_w = bbox[2] - bbox[0]
+        x = (img.width - text_w) / 2
+        for off in [-3, 3]:
+            draw.text((x+off, y+off), text, font=font, fill="black")
+        draw.text((x, y), text, font=font, fill=color)
+
+    draw_centered(60, user_name.upper(), font_main)
+    draw_centered(img.height - 200, movie_title.upper(), font_title, color="#FFD700")
+    draw_centered(img.height - 100, credits_text, font_credits, color="#ccc")
+    return img
+
+
+def _time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--size", default="896x1200", help="Poster size WxH")
+    args = parser.parse_args()
+
+    w, h = (int(v) for v in args.size.lower().split("x"))
+    base = PILImage.merge("RGB", [
+        PILImage.linear_gradient("L").resize((w, h)),
+        PILImage.effect_noise((w, h), 40),
+        PILImage.linear_gradient("L").rotate(90).resize((w, h)),
+    ])
+    text = ("Jane Doe", "Attack of the Fifty Foot Bench", "DIRECTED BY MAX POWER   PRODUCED BY RIP STEEL")
+
+    engine = OverlayEngine()
+    engine.render(base.copy(), *text)  # warm caches, as a long-lived worker would be
+
+    legacy_ms, legacy_img = _time(lambda: legacy_overlays(base.copy(), *text), args.repeat)
+    engine_ms, engine_img = _time(lambda: engine.render(base.copy(), *text), args.repeat)
+
+    diff = np.abs(np.asarray(legacy_img, dtype=np.int16) - np.asarray(engine_img, dtype=np.int16))
+    max_diff = int(diff.max())
+    print(f"size {w}x{h}, {args.repeat} runs (median)")
+    print(f"  legacy  {legacy_ms:8.2f} ms")
+    print(f"  engine  {engine_ms:8.2f} ms  ({legacy_ms / engine_ms:.1f}x)")
+    print(f"  max channel diff {max_diff}, differing pixels {(diff.max(axis=2) > 0).mean():.4%}")
+    if max_diff > TOLERANCE:
+        raise SystemExit(f"overlay output differs by {max_diff} > tolerance {TOLERANCE}")
+
+
+if __name__ == "__main__":
+    main()
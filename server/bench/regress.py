@@ -0,0 +1,124 @@
+"""
+Regression gate: runs the micro-benchmarks, a short offline load test and
+the cold-start benchmark, then compares them with a stored baseline. Exits non-zero when any metric is
+worse than the baseline by more than --tolerance (relative).
+
+    cd server && python -m bench.regress                    # compare
+    cd server && python -m bench.regress --update           # record a new baseline
+
+Baselines are machine-specific, so none is shipped: the first run (or
+--update) records bench/baseline.json on the machine or CI runner class that
+runs the gate, noting its CPU count and settings.
+"""
+import os
+import sys
+import json
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import fakes
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# metric path -> True when higher is better
+LOAD_METRICS = {
+    "rps": True,
+    "latency.p50_ms": False,
+    "latency.p95_ms": False,
+    "latency.p99_ms": False,
+    "peak_rss_mb": False,
+}
+COLD_START_METRICS = ("import_ms", "first_response_ms", "templates_ms")
+
+
+def _get(data, path):
+    for part in path.split("."):
+        data = data[part]
+    return data
+
+
+def collect(repeat: int, concurrency: int, duration: float, vertex_latency: float, cold_runs: int) -> dict:
+    from bench import micro, load, cold_start
+
+    # Cold starts first: they run in subprocesses, before this one imports the app.
+    cold_result = cold_start.run(cold_runs)
+    micro_results = micro.run(repeat)
+    load_result = load.run(concurrency, duration, vertex_latency)
+    metrics = {f"micro.{name}.median_ms": (r["median_ms"], False) for name, r in micro_results.items()}
+    for path, higher_better in LOAD_METRICS.items():
+        metrics[f"load.{path}"] = (_get(load_result, path), higher_better)
+    for name in COLD_START_METRICS:
+        metrics[f"cold_start.{name}"] = (cold_result[name], False)
+    return {
+        "machine": {"cpus": os.cpu_count(), "python": platform.python_version()},
+        "settings": {"repeat": repeat, "concurrency": concurrency, "duration": duration,
+                     "vertex_latency": vertex_latency, "cold_runs": cold_runs},
+        "metrics": {name: {"value": value, "higher_is_better": hb} for name, (value, hb) in metrics.items()},
+        "load": load_result,
+        "cold_start": cold_result,
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float):
+    """Returns [(metric, baseline, current, change, regressed)]."""
+    rows = []
+    for name, base in baseline["metrics"].items():
+        now = current["metrics"].get(name)
+        if now is None or not base["value"]:
+            continue
+        change = (now["value"] - base["value"]) / base["value"]
+        worse = -change if base["higher_is_better"] else change
+        rows.append((name, base["value"], now["value"], change, worse > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown (0.25 = 25%%)")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--vertex-latency", type=float, default=0.5)
+    parser.add_argument("--cold-runs", type=int, default=3, help="Cold starts to take the median of")
+    parser.add_argument("--output", help="Also write the current results to this JSON file")
+    args = parser.parse_args()
+
+    baseline_path = os.path.abspath(args.baseline)
+    output_path = os.path.abspath(args.output) if args.output else None
+    fakes.prepare_env()
+    current = collect(args.repeat, args.concurrency, args.duration, args.vertex_latency, args.cold_runs)
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if args.update or not os.path.exists(baseline_path):
+        with open(baseline_path, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"Baseline written to {baseline_path}")
+        return
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get("machine", {}).get("cpus") != current["machine"]["cpus"]:
+        print(f"WARNING: baseline was recorded with {baseline['machine'].get('cpus')} CPUs, "
+              f"this machine has {current['machine']['cpus']}; comparisons may be meaningless.")
+    if baseline.get("settings") != current["settings"]:
+        print(f"WARNING: settings differ from the baseline's {baseline.get('settings')}")
+
+    rows = compare(baseline, current, args.tolerance)
+    print(f"{'metric':<34}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, base, now, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<34}{base:>12.2f}{now:>12.2f}{change:>+9.1%}{flag}")
+    failed = [r for r in rows if r[4]]
+    if failed:
+        raise SystemExit(f"{len(failed)} metric(s) regressed by more than {args.tolerance:.0%}")
+    print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
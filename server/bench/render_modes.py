@@ -0,0 +1,72 @@
+"""
+Throughput of `mode=fast` (local compositor) against the default Vertex path,
+using the offline load driver. Each mode runs in a fresh process so the two
+do not share caches or worker pools. The fake Imagen call sleeps for
+--vertex-latency seconds; real Vertex inpainting takes several.
+
+    cd server && python -m bench.render_modes --concurrency 4 --duration 15 --vertex-latency 3
+"""
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ("quality", "fast")
+
+
+def _measure(mode, concurrency, duration, vertex_latency, user_size, conn):
+    from bench import fakes, load
+
+    fakes.prepare_env()
+    result = load.run(concurrency, duration, vertex_latency, user_size=user_size, mode=mode)
+    conn.send(result)
+    conn.close()
+
+
+def run(concurrency: int = 4, duration: float = 15.0, vertex_latency: float = 3.0,
+        user_size=(1600, 1200)) -> list:
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    for mode in MODES:
+        parent, child = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_measure, args=(mode, concurrency, duration, vertex_latency, user_size, child))
+        proc.start()
+        result = parent.recv()
+        proc.join()
+        rows.append({
+            "mode": mode,
+            "ok": result["ok"],
+            "statuses": result["statuses"],
+            "rps": result["rps"],
+            "p50_ms": result["latency"].get("p50_ms"),
+            "p95_ms": result["latency"].get("p95_ms"),
+            "peak_rss_mb": result["peak_rss_mb"],
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--vertex-latency", type=float, default=3.0, help="Seconds per fake Imagen call")
+    parser.add_argument("--user-size", default="1600x1200", help="WxH of the user photo")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    user_size = tuple(int(v) for v in args.user_size.lower().split("x"))
+    rows = run(args.concurrency, args.duration, args.vertex_latency, user_size)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'mode':<10}{'ok':>6}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}")
+    for r in rows:
+        print(f"{r['mode']:<10}{r['ok']:>6}{r['rps']:>8.2f}{r['p50_ms'] or 0:>10.0f}"
+              f"{r['p95_ms'] or 0:>10.0f}{r['peak_rss_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Memory per request for growing user photo sizes, using the offline load
+driver. Each size runs in a fresh process, because peak RSS only ever goes up.
+
+    cd server && python -m bench.upload_memory --sizes 1600x1200,3000x4000,4500x6000 --concurrency 4
+"""
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _measure(size, concurrency, duration, vertex_latency, conn):
+    from bench import fakes, load
+
+    fakes.prepare_env()
+    result = load.run(concurrency, duration, vertex_latency, user_size=size)
+    conn.send(result)
+    conn.close()
+
+
+def run(sizes, concurrency: int = 4, duration: float = 10.0, vertex_latency: float = 0.2) -> list:
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    for size in sizes:
+        parent, child = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_measure, args=(size, concurrency, duration, vertex_latency, child))
+        proc.start()
+        result = parent.recv()
+        proc.join()
+        rows.append({
+            "size": f"{size[0]}x{size[1]}",
+            "photo_mb": round(result["user_photo_bytes"] / (1024 * 1024), 2),
+            "ok": result["ok"],
+            "statuses": result["statuses"],
+            "idle_rss_mb": result["idle_rss_mb"],
+            "peak_rss_mb": result["peak_rss_mb"],
+            "rss_per_request_mb": result["rss_per_request_mb"],
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1600x1200,3000x4000,4500x6000", help="Comma-separated WxH photo sizes")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--vertex-latency", type=float, default=0.2)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in s.lower().split("x")) for s in args.sizes.split(",") if s.strip()]
+    rows = run(sizes, args.concurrency, args.duration, args.vertex_latency)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'size':<12}{'photo MB':>10}{'ok':>6}{'idle MB':>10}{'peak MB':>10}{'MB/request':>12}")
+    for r in rows:
+        print(f"{r['size']:<12}{r['photo_mb']:>10.2f}{r['ok']:>6}{r['idle_rss_mb']:>10.1f}"
+              f"{r['peak_rss_mb']:>10.1f}{r['rss_per_request_mb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
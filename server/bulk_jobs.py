@@ -0,0 +1,226 @@
+"""
+SQLite-backed state for bulk template background generation.
+
+A bulk job is a list of (template_id, prompt) items. Every item moves
+queued -> generating -> generated -> committed (or failed), and each step is
+written here before the next one starts, so a restarted process can pick a
+job up where it stopped:
+
+- queued/generating: (re)generated; a crash mid-call loses only that call;
+- generated: the image is already stored (url, image_hash), it only still
+  has to be added to its template;
+- committed/failed: done.
+
+Generated items reach the template store in batches (one update_many per
+flush), not one catalogue write per image.
+
+Several processes can share the database: a running job is leased to one
+owner (`claimed_by`), who renews `heartbeat` while it works. Another worker
+only takes a job over once its lease has gone stale, so a job is never run
+twice at once (which would mean duplicate, billed Imagen calls).
+
+A job that stops on an unexpected error (not a shutdown or a lost lease) is
+marked failed with that error and is not resumed.
+"""
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+QUEUED = "queued"
+GENERATING = "generating"
+GENERATED = "generated"
+COMMITTED = "committed"
+FAILED = "failed"
+RUNNING = "running"
+FINISHED = "finished"
+ITEM_STATES = (QUEUED, GENERATING, GENERATED, COMMITTED, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bulk_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    claimed_by TEXT,
+    heartbeat REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS bulk_items (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    template_id TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    url TEXT,
+    image_hash TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_bulk_jobs_status ON bulk_jobs(status);
+"""
+
+
+class BulkJobStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        # Databases created before leases (and job errors) existed.
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(bulk_jobs)")}
+        for column, kind in (("claimed_by", "TEXT"), ("heartbeat", "REAL"), ("error", "TEXT")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE bulk_jobs ADD COLUMN {column} {kind}")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def create(self, items: List[Tuple[str, str]], params: Optional[Dict] = None, owner: Optional[str] = None) -> str:
+        """Stores a new running job, already leased to `owner`."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO bulk_jobs (id, status, params, created_at, updated_at, claimed_by, heartbeat)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, RUNNING, json.dumps(params or {}), now, now, owner, now if owner else None),
+            )
+            conn.executemany(
+                "INSERT INTO bulk_items (job_id, position, template_id, prompt, status, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, i, template_id, prompt, QUEUED, now) for i, (template_id, prompt) in enumerate(items)],
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return job_id
+
+    def params(self, job_id: str) -> Dict:
+        row = self._conn().execute("SELECT params FROM bulk_jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row["params"]) if row else {}
+
+    def items(self, job_id: str, states: Tuple[str, ...] = ITEM_STATES) -> List[Dict]:
+        marks = ",".join("?" * len(states))
+        rows = self._conn().execute(
+            f"SELECT * FROM bulk_items WHERE job_id = ? AND status IN ({marks}) ORDER BY position",
+            (job_id, *states),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def mark(self, job_id: str, position: int, status: str, **fields):
+        """Sets an item's status plus any of attempts/url/image_hash/error."""
+        columns = ["status = ?", "updated_at = ?"] + [f"{k} = ?" for k in fields]
+        self._conn().execute(
+            f"UPDATE bulk_items SET {', '.join(columns)} WHERE job_id = ? AND position = ?",
+            (status, time.time(), *fields.values(), job_id, position),
+        )
+
+    def mark_committed(self, job_id: str, positions: List[int]):
+        now = time.time()
+        self._conn().executemany(
+            "UPDATE bulk_items SET status = ?, updated_at = ? WHERE job_id = ? AND position = ?",
+            [(COMMITTED, now, job_id, p) for p in positions],
+        )
+
+    def finish(self, job_id: str):
+        self._conn().execute(
+            "UPDATE bulk_jobs SET status = ?, updated_at = ?, claimed_by = NULL, heartbeat = NULL WHERE id = ?",
+            (FINISHED, time.time(), job_id),
+        )
+
+    def fail(self, job_id: str, owner: str, error: str):
+        """Stops a job `owner` holds for good: it keeps its items but is never claimed again."""
+        self._conn().execute(
+            "UPDATE bulk_jobs SET status = ?, error = ?, updated_at = ?, claimed_by = NULL, heartbeat = NULL"
+            " WHERE id = ? AND claimed_by = ? AND status = ?",
+            (FAILED, error, time.time(), job_id, owner, RUNNING),
+        )
+
+    # --- leases ---
+
+    def claim_unfinished(self, owner: str, stale_after: float) -> List[str]:
+        """
+        Leases every running job that nobody holds (or whose holder stopped
+        renewing `stale_after` seconds ago) to `owner`; returns their ids.
+        Each claim is one conditional UPDATE, so two workers never both win.
+        """
+        now = time.time()
+        rows = self._conn().execute(
+            "SELECT id FROM bulk_jobs WHERE status = ? AND (claimed_by IS NULL OR heartbeat < ?)"
+            " ORDER BY created_at", (RUNNING, now - stale_after),
+        ).fetchall()
+        claimed = []
+        for r in rows:
+            cur = self._conn().execute(
+                "UPDATE bulk_jobs SET claimed_by = ?, heartbeat = ?"
+                " WHERE id = ? AND status = ? AND (claimed_by IS NULL OR heartbeat < ?)",
+                (owner, now, r["id"], RUNNING, now - stale_after),
+            )
+            if cur.rowcount == 1:
+                claimed.append(r["id"])
+        return claimed
+
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        """Renews the lease; False if `owner` no longer holds it."""
+        cur = self._conn().execute(
+            "UPDATE bulk_jobs SET heartbeat = ? WHERE id = ? AND claimed_by = ? AND status = ?",
+            (time.time(), job_id, owner, RUNNING),
+        )
+        return cur.rowcount == 1
+
+    def release(self, job_id: str, owner: str):
+        """Gives the lease up (shutdown), so another worker can resume straight away."""
+        self._conn().execute(
+            "UPDATE bulk_jobs SET claimed_by = NULL, heartbeat = NULL WHERE id = ? AND claimed_by = ?",
+            (job_id, owner),
+        )
+
+    def _summary(self, row) -> Dict:
+        counts = {state: 0 for state in ITEM_STATES}
+        for r in self._conn().execute(
+            "SELECT status, COUNT(*) AS n FROM bulk_items WHERE job_id = ? GROUP BY status", (row["id"],)
+        ):
+            counts[r["status"]] = r["n"]
+        return {
+            "id": row["id"],
+            "status": row["status"],
+            "claimed_by": row["claimed_by"],
+            "error": row["error"],
+            "total": sum(counts.values()),
+            "counts": counts,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT * FROM bulk_jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        items = [
+            {k: item[k] for k in ("position", "template_id", "prompt", "status", "attempts", "url", "error")}
+            for item in self.items(job_id)
+        ]
+        return {**self._summary(row), "items": items}
+
+    def recent(self, limit: int = 20) -> List[Dict]:
+        rows = self._conn().execute(
+            "SELECT * FROM bulk_jobs ORDER BY created_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [self._summary(r) for r in rows]
@@ -0,0 +1,116 @@
+"""
+Process-wide registry of cloud client and model handles.
+
+Each handle is built once by its factory and reused by every request. A
+failed build is negatively cached: callers get None straight away until an
+exponential backoff expires, so environments without credentials do not pay
+for credential discovery on every request.
+"""
+import time
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class _Slot:
+    def __init__(self, name: str, factory: Callable[[], Any], required: bool):
+        self.name = name
+        self.factory = factory
+        self.required = required
+        self.value: Any = None
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.retry_at = 0.0
+        self.build_ms: Optional[float] = None
+
+
+class ClientRegistry:
+    def __init__(self, backoff_base: float = 5.0, backoff_max: float = 300.0):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots: Dict[str, _Slot] = {}
+        self.warm = False
+
+    def register(self, name: str, factory: Callable[[], Any], required: bool = True):
+        """`required` handles must be up before /ready reports the instance as ready."""
+        self._slots[name] = _Slot(name, factory, required)
+
+    def available(self, name: str) -> bool:
+        slot = self._slots.get(name)
+        return bool(slot and slot.value is not None)
+
+    def get(self, name: str) -> Optional[Any]:
+        """
+        Returns the handle, building it on first use; None while it is failing.
+        Once a failed handle's backoff expires the retry runs in the background,
+        so request threads never wait on a construction that already failed.
+        """
+        slot = self._slots[name]
+        if slot.value is not None:
+            return slot.value
+        if time.monotonic() < slot.retry_at:
+            return None
+        if slot.failures:
+            # Claim the slot here, not in the thread: checking locked() first
+            # would let two callers both see it free and start two retries.
+            if slot.lock.acquire(blocking=False):
+                threading.Thread(target=self._build_claimed, args=(slot,), daemon=True).start()
+            return None
+        with slot.lock:
+            return self._build(slot)
+
+    def _build_claimed(self, slot: _Slot):
+        try:
+            self._build(slot)
+        finally:
+            slot.lock.release()
+
+    def _build(self, slot: _Slot) -> Optional[Any]:
+        """Builds the handle; the caller holds slot.lock."""
+        name = slot.name
+        # Someone else may have built it (or failed) while we waited.
+        if slot.value is not None:
+            return slot.value
+        if time.monotonic() < slot.retry_at:
+            return None
+
+        slot.attempts += 1
+        t0 = time.perf_counter()
+        try:
+            slot.value = slot.factory()
+            slot.build_ms = round((time.perf_counter() - t0) * 1000, 1)
+            slot.failures = 0
+            slot.last_error = None
+            print(f"{name} initialized in {slot.build_ms}ms.")
+        except Exception as e:
+            slot.failures += 1
+            slot.last_error = str(e)
+            delay = min(self.backoff_max, self.backoff_base * (2 ** (slot.failures - 1)))
+            slot.retry_at = time.monotonic() + delay
+            print(f"{name} failed (retry in {delay:.0f}s): {e}")
+        return slot.value
+
+    async def warmup(self, names: Optional[Iterable[str]] = None):
+        """Builds the given (default: all) handles concurrently off the event loop."""
+        names = list(names or self._slots)
+        await asyncio.gather(*(asyncio.to_thread(self.get, name) for name in names))
+        self.warm = True
+
+    def ready(self) -> bool:
+        return self.warm and all(s.value is not None for s in self._slots.values() if s.required)
+
+    def status(self) -> Dict:
+        now = time.monotonic()
+        return {
+            name: {
+                "state": "ready" if s.value is not None else ("failed" if s.failures else "pending"),
+                "required": s.required,
+                "attempts": s.attempts,
+                "build_ms": s.build_ms,
+                "last_error": s.last_error,
+                "retry_in": round(max(0.0, s.retry_at - now), 1) if s.value is None and s.failures else None,
+            }
+            for name, s in self._slots.items()
+        }
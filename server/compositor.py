@@ -0,0 +1,95 @@
+"""
+Local face compositor for `mode=fast`: no cloud call, a few hundred ms of CPU.
+
+The user's photo is scaled so its face matches the template face, mapped
+onto the template with one affine transform, colour-matched to the
+template's face region (per-channel histogram matching in YCbCr) and
+blended through the template's feathered inpainting mask. Only the mask's
+bounding box is processed. Runs in the cpu_pool workers like pipeline.py.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage, ImageFilter
+
+# How far colours move towards the template's (0 = untouched, 1 = full match).
+MATCH_STRENGTH = 0.75
+_QUANTILES = np.linspace(0.0, 1.0, 64)
+
+Box = Tuple[float, float, float, float]
+
+
+def face_box_from_mask(mask: PILImage.Image) -> Optional[Box]:
+    """
+    Inverts template_prep.build_mask: the ellipse spans 1.8 face widths and
+    2.3 face heights, starting 0.4w left of and 0.8h above the face box.
+    Used when the template has no detected face (center fallback mask).
+    """
+    bbox = mask.point(lambda v: 255 if v >= 128 else 0).getbbox()
+    if not bbox:
+        return None
+    x0, y0, x1, y1 = bbox
+    w, h = (x1 - x0) / 1.8, (y1 - y0) / 2.3
+    return (x0 + 0.4 * w, y0 + 0.8 * h, w, h)
+
+
+def _match_histograms(src: np.ndarray, src_sel: np.ndarray, ref: np.ndarray, ref_sel: np.ndarray) -> np.ndarray:
+    """Maps each channel of `src` so its selected pixels' distribution follows `ref`'s."""
+    out = np.empty(src.shape, dtype=np.float32)
+    for c in range(src.shape[2]):
+        channel = src[..., c].astype(np.float32)
+        src_q = np.quantile(channel[src_sel], _QUANTILES)
+        ref_q = np.quantile(ref[..., c][ref_sel], _QUANTILES)
+        matched = np.interp(channel, src_q, ref_q)
+        out[..., c] = channel + MATCH_STRENGTH * (matched - channel)
+    return out
+
+
+def composite_face(base: PILImage.Image, mask: PILImage.Image, template_face: Optional[Box],
+                   user: PILImage.Image, user_face: Optional[Box]) -> PILImage.Image:
+    """Returns `base` (RGB) with the user's face blended in where `mask` is set."""
+    region = mask.getbbox()
+    if region is None:
+        return base
+    template_face = template_face or face_box_from_mask(mask)
+    if template_face is None:
+        return base
+    if user_face is None:
+        # No face found in the upload: assume a roughly centered portrait.
+        user_face = (user.width * 0.25, user.height * 0.2, user.width * 0.5, user.height * 0.5)
+
+    tx, ty, tw, th = template_face
+    ux, uy, uw, uh = user_face
+    scale = ((tw / uw) * (th / uh)) ** 0.5
+    # Big downscales: shrink with a box filter first so the bilinear step does not alias.
+    factor = int(1 / (2 * scale))
+    if factor >= 2:
+        user = user.reduce(factor)
+        ux, uy, uw, uh = (v / factor for v in (ux, uy, uw, uh))
+        scale *= factor
+
+    rx0, ry0, rx1, ry1 = region
+    size = (rx1 - rx0, ry1 - ry0)
+    # Region pixel (x, y) samples the user photo at ((x + rx0 - tcx) / scale + ucx, ...).
+    tcx, tcy = tx + tw / 2, ty + th / 2
+    ucx, ucy = ux + uw / 2, uy + uh / 2
+    affine = (1 / scale, 0, (rx0 - tcx) / scale + ucx, 0, 1 / scale, (ry0 - tcy) / scale + ucy)
+    layer = user.transform(size, PILImage.AFFINE, affine, resample=PILImage.BILINEAR)
+    coverage = PILImage.new("L", user.size, 255).transform(size, PILImage.AFFINE, affine, resample=PILImage.BILINEAR)
+    coverage = coverage.filter(ImageFilter.MinFilter(5)).filter(ImageFilter.GaussianBlur(3))
+
+    base_region = base.crop(region)
+    alpha = (np.asarray(mask.crop(region), dtype=np.float32) / 255.0) * (np.asarray(coverage, dtype=np.float32) / 255.0)
+    base_ycc = np.asarray(base_region.convert("YCbCr"))
+    layer_ycc = np.asarray(layer.convert("YCbCr"))
+    ref_sel = np.asarray(mask.crop(region)) >= 128
+    src_sel = alpha >= 0.5
+    if src_sel.any() and ref_sel.any():
+        matched = _match_histograms(layer_ycc, src_sel, base_ycc, ref_sel)
+        layer = PILImage.fromarray(np.clip(matched, 0, 255).astype(np.uint8), "YCbCr").convert("RGB")
+
+    alpha = alpha[..., None]
+    blended = np.asarray(base_region, dtype=np.float32) * (1.0 - alpha) + np.asarray(layer, dtype=np.float32) * alpha
+    out = base.copy()
+    out.paste(PILImage.fromarray(np.clip(blended + 0.5, 0, 255).astype(np.uint8), "RGB"), region[:2])
+    return out
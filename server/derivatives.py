@@ -0,0 +1,162 @@
+"""
+Resized/transcoded variants of stored images, served at /img/{path}.
+
+Upload and poster names are unique and never rewritten, so a variant is
+fully identified by (path, width, format) and can be cached forever: the
+encoded bytes live on disk under `<cache_dir>/<key>.<ext>`, bounded by total
+bytes and evicted least recently used. Requested widths snap up to a fixed
+ladder so arbitrary `w=` values cannot fan out the cache.
+"""
+import os
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from result_cache import make_key
+
+VARIANT_WIDTHS = (160, 320, 480, 640, 960, 1280)
+# Only user-facing images; caches and the fake bucket stay private.
+SERVABLE_PREFIXES = ("templates/", "generated/")
+
+
+def snap_width(width: int) -> int:
+    for w in VARIANT_WIDTHS:
+        if width <= w:
+            return w
+    return VARIANT_WIDTHS[-1]
+
+
+def is_servable(path: str) -> bool:
+    parts = path.split("/")
+    return path.startswith(SERVABLE_PREFIXES) and ".." not in parts and "" not in parts
+
+
+def variant_key(path: str, width: int, output_key: str) -> str:
+    return make_key("variant", path, width, output_key)
+
+
+class _LeaderCancelled(Exception):
+    """Set on a flight whose rendering request was cancelled; waiters retry."""
+
+
+class VariantCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (filename, size)
+        self._bytes = 0
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            key, dot, ext = name.partition(".")
+            if not dot or ext.endswith("tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_atime, key, name, st.st_size))
+        for _, key, name, size in sorted(entries):
+            self._entries[key] = (name, size)
+            self._bytes += size
+        self._evict()
+
+    def lookup(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        path = os.path.join(self.cache_dir, entry[0])
+        if not os.path.exists(path):
+            with self._lock:
+                self._drop(key)
+            return None
+        return path
+
+    def store(self, key: str, extension: str, data: bytes) -> str:
+        name = f"{key}.{extension}"
+        path = os.path.join(self.cache_dir, name)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries[key][1]
+            self._entries[key] = (name, len(data))
+            self._entries.move_to_end(key)
+            self._bytes += len(data)
+            self._evict()
+        return path
+
+    async def get_or_create(self, key: str, extension: str,
+                            render: Callable[[], Awaitable[bytes]]) -> str:
+        """Cached path for `key`, rendering it once even under concurrent requests."""
+        while True:
+            path = self.lookup(key)
+            if path:
+                self._count("hits")
+                return path
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+            self._count("coalesced")
+            try:
+                return await asyncio.shield(flight)
+            except _LeaderCancelled:
+                # The rendering request went away; the first waiter to get
+                # here renders instead, the others coalesce onto it.
+                continue
+
+        self._count("misses")
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            data = await render()
+            path = await asyncio.to_thread(self.store, key, extension, data)
+            flight.set_result(path)
+            return path
+        except asyncio.CancelledError:
+            # Not flight.cancel(): that would cancel every coalesced waiter too.
+            flight.set_exception(_LeaderCancelled())
+            flight.exception()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            flight.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            self._flights.pop(key, None)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[1]
+            try:
+                os.remove(os.path.join(self.cache_dir, entry[0]))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            data = dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+        lookups = data["hits"] + data["misses"]
+        data["hit_rate"] = round(data["hits"] / lookups, 4) if lookups else 0.0
+        return data
@@ -0,0 +1,151 @@
+"""
+Bounded worker pools for work that must not run on the asyncio event loop.
+
+`cpu_pool` runs Pillow stages (decode, mask, overlay, encode) in worker
+processes; `io_pool` runs blocking SDK calls (Vision, Vertex, GCS, HTTP) in
+threads. Each pool admits at most `workers + max_queue` tasks; beyond that
+`run()` raises PoolSaturated immediately instead of growing an unbounded queue.
+
+A slot is held until the task really ends, not until its caller stops
+waiting: cancelling a request does not stop a task already running. A worker
+process that dies (OOM kill, segfault) breaks a ProcessPoolExecutor for good;
+the pool is then rebuilt and the task retried once.
+"""
+import os
+import asyncio
+import logging
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(os.cpu_count() or 2)))
+CPU_POOL_MAX_QUEUE = int(os.getenv("CPU_POOL_MAX_QUEUE", str(4 * max(CPU_POOL_WORKERS, 1))))
+IO_POOL_WORKERS = int(os.getenv("IO_POOL_WORKERS", "32"))
+IO_POOL_MAX_QUEUE = int(os.getenv("IO_POOL_MAX_QUEUE", "64"))
+
+
+class PoolSaturated(Exception):
+    def __init__(self, pool_name: str, retry_after: int = 2):
+        super().__init__(f"{pool_name} pool is saturated")
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+class BoundedPool:
+    def __init__(self, name: str, factory: Callable[[], Executor], workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._factory = factory
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak = 0
+        self._completed = 0
+        self._rejected = 0
+        self._rebuilt = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.max_queue
+
+    def _get_executor(self) -> Executor:
+        # Created on first use so importing the app never forks or spawns.
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._factory()
+        return self._executor
+
+    def _acquire(self):
+        with self._lock:
+            if self._in_flight >= self.capacity:
+                self._rejected += 1
+                raise PoolSaturated(self.name)
+            self._in_flight += 1
+            self._peak = max(self._peak, self._in_flight)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+
+    def _replace_broken(self, executor: Executor):
+        with self._lock:
+            if self._executor is not executor:
+                return  # another caller already replaced it
+            self._executor = None
+            self._rebuilt += 1
+        logger.warning("%s pool: worker process died, rebuilding the pool", self.name)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, executor: Executor, call) -> Future:
+        self._acquire()
+        try:
+            future = executor.submit(call)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        call = functools.partial(fn, *args, **kwargs)
+        for attempt in (1, 2):
+            executor = self._get_executor()
+            try:
+                return await asyncio.wrap_future(self._submit(executor, call))
+            except BrokenProcessPool:
+                self._replace_broken(executor)
+                if attempt == 2:
+                    raise
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "peak_in_flight": self._peak,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "rebuilt": self._rebuilt,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _cpu_executor() -> Executor:
+    if CPU_POOL_WORKERS <= 0:
+        # CPU_POOL_WORKERS=0 keeps CPU stages in threads (handy for local debugging).
+        return ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="cpu")
+    # spawn, not fork: the parent holds gRPC channels that are not fork-safe.
+    return ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+cpu_pool = BoundedPool("cpu", _cpu_executor, max(CPU_POOL_WORKERS, 1), CPU_POOL_MAX_QUEUE)
+io_pool = BoundedPool(
+    "io",
+    lambda: ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="io"),
+    IO_POOL_WORKERS,
+    IO_POOL_MAX_QUEUE,
+)
+
+
+def pool_stats() -> Dict:
+    return {"cpu": cpu_pool.stats(), "io": io_pool.stats()}
+
+
+def shutdown_pools():
+    cpu_pool.shutdown()
+    io_pool.shutdown()
@@ -0,0 +1,176 @@
+"""
+Pluggable face detection for the user-photo crop and the template mask.
+
+Every backend returns boxes as (x, y, w, h) in the coordinates of the image
+it was given, and raises on backend errors so callers can choose a fallback.
+
+- VisionFaceDetector: Cloud Vision on a downscaled JPEG, boxes scaled back.
+- LocalFaceDetector: OpenCV Haar cascade, CPU-only and offline.
+- AutoFaceDetector: Vision when its client is up, otherwise local.
+"""
+import io
+from typing import Callable, List, Optional, Tuple
+
+from PIL import Image as PILImage
+
+Box = Tuple[int, int, int, int]
+
+VISION_MAX_SIDE = 1024
+LOCAL_MAX_SIDE = 640
+
+
+def largest_face(faces: Optional[List[Box]]) -> Optional[Box]:
+    if not faces:
+        return None
+    return max(faces, key=lambda b: b[2] * b[3])
+
+
+def _downscale(img: PILImage.Image, max_side: int):
+    """Returns (image, factor) where factor maps downscaled coords back to the original."""
+    longest = max(img.size)
+    if longest <= max_side:
+        return img, 1.0
+    factor = longest / max_side
+    small = img.resize((round(img.width / factor), round(img.height / factor)), PILImage.BILINEAR)
+    return small, factor
+
+
+def _scale_box(box: Box, factor: float) -> Box:
+    return tuple(int(round(v * factor)) for v in box)
+
+
+class FaceDetector:
+    name = "none"
+    # Higher is better; template artifacts built with a lower-quality detector
+    # are rebuilt once a better one is available.
+    quality = 0
+
+    def available(self) -> bool:
+        return False
+
+    def detect(self, img: PILImage.Image) -> List[Box]:
+        raise RuntimeError("No face detector available")
+
+
+class VisionFaceDetector(FaceDetector):
+    name = "vision"
+    quality = 2
+
+    def __init__(self, get_client: Callable[[], object], max_side: int = VISION_MAX_SIDE,
+                 call: Optional[Callable] = None):
+        self.get_client = get_client
+        self.max_side = max_side
+        # Wraps the API call, e.g. resilience.Guard.call for deadlines and hedging.
+        self.call = call or (lambda fn, *args, **kwargs: fn(*args, **kwargs))
+
+    def available(self) -> bool:
+        return self.get_client() is not None
+
+    def detect(self, img: PILImage.Image) -> List[Box]:
+        from google.cloud import vision
+
+        client = self.get_client()
+        if client is None:
+            raise RuntimeError("Vision client unavailable")
+
+        small, factor = _downscale(img, self.max_side)
+        if small.mode != "RGB":
+            small = small.convert("RGB")
+        buf = io.BytesIO()
+        small.save(buf, format="JPEG", quality=85)
+
+        response = self.call(client.face_detection, image=vision.Image(content=buf.getvalue()))
+        if response.error and response.error.message:
+            raise RuntimeError(response.error.message)
+
+        faces = []
+        for face in response.face_annotations:
+            vertices = face.bounding_poly.vertices
+            x_min = min(v.x for v in vertices)
+            x_max = max(v.x for v in vertices)
+            y_min = min(v.y for v in vertices)
+            y_max = max(v.y for v in vertices)
+            faces.append(_scale_box((x_min, y_min, x_max - x_min, y_max - y_min), factor))
+        return faces
+
+
+_cascade = None
+
+
+def _load_cascade():
+    # One cascade per process; loading the XML costs tens of milliseconds.
+    global _cascade
+    if _cascade is None:
+        import cv2
+        _cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        if _cascade.empty():
+            _cascade = None
+            raise RuntimeError("Could not load OpenCV face cascade")
+    return _cascade
+
+
+class LocalFaceDetector(FaceDetector):
+    name = "local"
+    quality = 1
+
+    def __init__(self, max_side: int = LOCAL_MAX_SIDE):
+        self.max_side = max_side
+
+    def available(self) -> bool:
+        try:
+            _load_cascade()
+            return True
+        except Exception:
+            return False
+
+    def detect(self, img: PILImage.Image) -> List[Box]:
+        import numpy as np
+
+        cascade = _load_cascade()
+        small, factor = _downscale(img.convert("L"), self.max_side)
+        min_side = max(24, min(small.size) // 12)
+        found = cascade.detectMultiScale(
+            np.asarray(small), scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side)
+        )
+        return [_scale_box(tuple(int(v) for v in box), factor) for box in found]
+
+
+class AutoFaceDetector(FaceDetector):
+    """Prefers the first available backend in `backends`."""
+
+    name = "auto"
+
+    def __init__(self, *backends: FaceDetector):
+        self.backends = backends
+
+    def _pick(self) -> Optional[FaceDetector]:
+        for backend in self.backends:
+            if backend.available():
+                return backend
+        return None
+
+    @property
+    def quality(self) -> int:
+        backend = self._pick()
+        return backend.quality if backend else 0
+
+    def available(self) -> bool:
+        return self._pick() is not None
+
+    def detect(self, img: PILImage.Image) -> List[Box]:
+        backend = self._pick()
+        if backend is None:
+            raise RuntimeError("No face detector available")
+        return backend.detect(img)
+
+
+def make_detector(kind: str, get_vision_client: Callable[[], object],
+                  call_vision: Optional[Callable] = None) -> FaceDetector:
+    kind = (kind or "auto").lower()
+    if kind == "vision":
+        return VisionFaceDetector(get_vision_client, call=call_vision)
+    if kind == "local":
+        return LocalFaceDetector()
+    if kind == "none":
+        return FaceDetector()
+    return AutoFaceDetector(VisionFaceDetector(get_vision_client, call=call_vision), LocalFaceDetector())
@@ -0,0 +1,218 @@
+"""
+Validation of uploaded images, in place.
+
+Request size is enforced by `BodySizeLimit`, the ASGI guard in front of
+multipart parsing: it refuses bodies over the limit by Content-Length or
+while streaming, so no more than that is ever buffered. Starlette then
+spools each file part (in memory up to 1 MB, past that in an anonymous
+temp file), and `ingest()` works on that spooled file directly: it checks
+the size against the per-file limit, hashes it in chunks and reads only the
+image header, so unsupported formats and decompression bombs (too many
+pixels) are refused before anything is decoded.
+
+The result carries the sha256 for cache keys and a `source` that the
+pipeline and worker processes can open: the bytes of a small upload, or a
+/proc path to the parent's descriptor of a disk-spooled one. That path
+stays valid after the request's form is closed, until IngestedUpload.close().
+"""
+import io
+import os
+import shutil
+import hashlib
+import tempfile
+import warnings
+from typing import Optional, Union
+
+from PIL import Image as PILImage
+from starlette.exceptions import HTTPException
+
+CHUNK_BYTES = 1024 * 1024
+ALLOWED_FORMATS = ("JPEG", "MPO", "PNG", "WEBP")
+
+
+class UploadRejected(ValueError):
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+class IngestedUpload:
+    """A validated upload; close() releases the spooled file behind `path`, if any."""
+
+    def __init__(self, data: Optional[bytes], path: Optional[str], size: int, sha256: str,
+                 format: str, width: int, height: int, fd: Optional[int] = None):
+        self._data = data
+        self._fd = fd
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.format = format
+        self.width = width
+        self.height = height
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """What PIL (and pipeline.decode_user_photo) should open: bytes or a file path."""
+        return self._data if self.path is None else self.path
+
+    def read(self) -> bytes:
+        if self.path is None:
+            return self._data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            os.close(fd)
+        elif self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _disk_fd(src) -> Optional[int]:
+    """The descriptor of the file behind `src`, or None while it is held in memory."""
+    # A SpooledTemporaryFile still in memory would roll over to disk on fileno().
+    if getattr(src, "_rolled", True) is False:
+        return None
+    try:
+        return src.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _hash(src) -> str:
+    digest = hashlib.sha256()
+    src.seek(0)
+    while True:
+        chunk = src.read(CHUNK_BYTES)
+        if not chunk:
+            return digest.hexdigest()
+        digest.update(chunk)
+
+
+def _probe(src, max_pixels: int):
+    """Reads only the header; returns (format, width, height)."""
+    try:
+        src.seek(0)
+        with warnings.catch_warnings():
+            # The pixel limit is enforced below, with a clearer error.
+            warnings.simplefilter("ignore", PILImage.DecompressionBombWarning)
+            with PILImage.open(src) as img:
+                fmt, (width, height) = img.format, img.size
+    except PILImage.DecompressionBombError:
+        raise UploadRejected(f"Image exceeds {max_pixels} pixels", 413)
+    except Exception:
+        raise UploadRejected("Invalid image file", 400)
+    if fmt not in ALLOWED_FORMATS:
+        raise UploadRejected(f"Unsupported image format {fmt} (use JPEG, PNG or WebP)", 415)
+    if width * height > max_pixels:
+        raise UploadRejected(f"Image is {width}x{height}; at most {max_pixels} pixels allowed", 413)
+    return fmt, width, height
+
+
+def _keep(src, fd: int, spool_dir: Optional[str]):
+    """
+    A path to the spooled file that outlives `src`: a duplicated descriptor
+    under /proc (no copy), or a temp file copy where there is no /proc.
+    Returns (path, fd to close later or None).
+    """
+    if os.path.isdir(f"/proc/{os.getpid()}/fd"):
+        kept = os.dup(fd)
+        return f"/proc/{os.getpid()}/fd/{kept}", kept
+    fd, path = tempfile.mkstemp(prefix="epicmeme-upload-", dir=spool_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            src.seek(0)
+            shutil.copyfileobj(src, out, CHUNK_BYTES)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, None
+
+
+def ingest(src, max_bytes: int, max_pixels: int, spool_dir: Optional[str] = None) -> IngestedUpload:
+    """Validates a spooled, seekable upload (UploadFile.file) in place; raises UploadRejected."""
+    size = src.seek(0, os.SEEK_END)
+    if not size:
+        raise UploadRejected("Empty upload", 400)
+    if size > max_bytes:
+        raise UploadRejected(f"Upload exceeds {max_bytes // (1024 * 1024)} MB", 413)
+    fmt, width, height = _probe(src, max_pixels)
+    sha256 = _hash(src)
+    fd = _disk_fd(src)
+    if fd is None:
+        src.seek(0)
+        return IngestedUpload(src.read(), None, size, sha256, fmt, width, height)
+    path, kept = _keep(src, fd, spool_dir)
+    return IngestedUpload(None, path, size, sha256, fmt, width, height, fd=kept)
+
+
+class BodySizeLimit:
+    """
+    Answers 413 for request bodies larger than `max_bytes`: up front by
+    Content-Length, otherwise as soon as more than that has been received
+    (chunked bodies, lying clients), before multipart parsing has spooled it.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        for name, value in scope.get("headers", ()):
+            if name == b"content-length":
+                if value.isdigit() and int(value) > self.max_bytes:
+                    return await self._reject(send)
+                break
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            if started:
+                raise
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = b'{"detail":"Request body too large"}'
+        await send({"type": "http.response.start", "status": 413, "headers": [
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+            (b"connection", b"close"),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+
+class _BodyTooLarge(HTTPException):
+    # An HTTPException so FastAPI's body parsing passes it through as a 413
+    # rather than reporting a generic parse error.
+    def __init__(self):
+        super().__init__(status_code=413, detail="Request body too large")
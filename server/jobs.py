@@ -0,0 +1,120 @@
+"""
+In-memory job store for asynchronous meme generation.
+
+Jobs live on the event loop: every mutation happens from coroutines, so a
+plain dict plus one asyncio.Condition per job is enough. Finished jobs are
+evicted `ttl` seconds after their last update; submissions carrying a known
+idempotency key get the existing job back instead of a new one.
+
+State is per process: with several uvicorn/gunicorn workers a poll or event
+stream routed to another worker than the submission gets 404. Run a single
+worker, or route every /jobs request for a job id to the same one.
+"""
+import time
+import uuid
+import asyncio
+from typing import Dict, Optional, List
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL = (SUCCEEDED, FAILED)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id: str, kind: str, idempotency_key: Optional[str] = None):
+        self.id = job_id
+        self.kind = kind
+        self.idempotency_key = idempotency_key
+        self.status = QUEUED
+        self.stage: Optional[str] = None
+        self.result: Optional[Dict] = None
+        self.error: Optional[Dict] = None
+        self.events: List[Dict] = []
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "result": self.result,
+            "error": self.error,
+            "events": self.events,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class JobStore:
+    def __init__(self, ttl: int = 3600, max_active: int = 256):
+        self.ttl = ttl
+        self.max_active = max_active
+        self._jobs: Dict[str, Job] = {}
+        self._by_key: Dict[str, str] = {}
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.evict_expired()
+        return self._jobs.get(job_id)
+
+    def find(self, idempotency_key: str) -> Optional[Job]:
+        self.evict_expired()
+        job_id = self._by_key.get(idempotency_key)
+        job = self._jobs.get(job_id) if job_id else None
+        # A failed job should not pin its key; let the client retry.
+        if job and job.status == FAILED:
+            return None
+        return job
+
+    def create(self, kind: str, idempotency_key: Optional[str] = None) -> Job:
+        self.evict_expired()
+        active = sum(1 for j in self._jobs.values() if not j.done)
+        if active >= self.max_active:
+            raise JobQueueFull(f"{active} jobs already pending")
+        job = Job(uuid.uuid4().hex, kind, idempotency_key)
+        self._jobs[job.id] = job
+        if idempotency_key:
+            self._by_key[idempotency_key] = job.id
+        return job
+
+    async def update(self, job: Job, event: str, **data):
+        job.updated_at = time.time()
+        if event == "stage":
+            job.status = RUNNING
+            job.stage = data.get("stage")
+        elif event == "done":
+            job.status = SUCCEEDED
+            job.result = data
+        elif event == "error":
+            job.status = FAILED
+            job.error = data
+        job.events.append({"seq": len(job.events), "event": event, "at": job.updated_at, **data})
+        async with job.changed:
+            job.changed.notify_all()
+
+    def evict_expired(self):
+        now = time.time()
+        expired = [j for j in self._jobs.values() if j.done and now - j.updated_at > self.ttl]
+        for job in expired:
+            self._jobs.pop(job.id, None)
+            if job.idempotency_key and self._by_key.get(job.idempotency_key) == job.id:
+                self._by_key.pop(job.idempotency_key, None)
+
+    def stats(self) -> Dict:
+        counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return counts
@@ -1,34 +1,183 @@
 
 import os
-import io
 import json
-import uuid
 import base64
+import math
 import random
-import requests
+import time
+import hashlib
+import uuid
+import asyncio
 import traceback
 import shutil
-from typing import Optional, List, Dict
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+import socket
+import logging
+import requests
+from typing import Optional, List, Dict, Union
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from google.cloud import storage, vision
-import vertexai
-from vertexai.preview.vision_models import Image, ImageGenerationModel
-from PIL import Image as PILImage, ImageDraw, ImageFont, ImageOps, ImageFilter
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi.responses import RedirectResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse, PlainTextResponse
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
+from PIL import Image as PILImage, ImageOps
+from template_cache import TemplateCache
+from template_prep import TemplatePreparer, PreparedTemplate, build_mask, build_prepared, normalize_template
+from executors import cpu_pool, io_pool, PoolSaturated, pool_stats, shutdown_pools
+import pipeline
+from jobs import Job, JobStore, JobQueueFull
+from clients import ClientRegistry
+from template_store import TemplateStore, TemplateNotFound
+from template_feed import TemplateFeed, FeedQuery, etag_matches, accepts_gzip
+from result_cache import ResultCache, make_key
+from face_detect import make_detector, largest_face, VISION_MAX_SIDE
+from admission import AdmissionController, AdmissionRejected, USER, ADMIN
+import metrics
+from metrics import span, record_stage, BYTES, FALLBACKS, UPLOAD_REJECTS
+from object_store import ObjectStore, FakeStorageClient, content_name, is_immutable, content_etag
+from object_store import PENDING as STORE_PENDING, UPLOADED as STORE_UPLOADED
+from derivatives import VariantCache, snap_width, is_servable, variant_key
+from ingest import ingest, IngestedUpload, UploadRejected, BodySizeLimit
+from resilience import Guard, CircuitBreaker, Unavailable
+import bulk_jobs
+from bulk_jobs import BulkJobStore
+
+logger = logging.getLogger(__name__)
 
 # Config
 BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "epicmeme-storage")
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 LOCATION = "us-central1"
 TEMPLATES_FILE = "templates.json"
+TEMPLATE_DB_PATH = os.getenv("TEMPLATE_DB_PATH", "templates.db")
 UPLOAD_DIR = "uploads"
+# Internal caches and artifacts. Must stay outside UPLOAD_DIR, which is served
+# as /uploads: nothing in here is meant to be fetchable by URL.
+CACHE_ROOT = os.getenv("CACHE_ROOT", "cache")
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_ROOT, "templates")
+TEMPLATE_CACHE_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# On-disk copies (meta + content-addressed blobs), evicted least recently used first.
+TEMPLATE_CACHE_DISK_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+TEMPLATE_CACHE_TTL = int(os.getenv("TEMPLATE_CACHE_TTL", "3600"))
+PREPARED_TEMPLATES_DIR = os.path.join(CACHE_ROOT, "prepared")
+RESULT_CACHE_DIR = os.path.join(CACHE_ROOT, "results")
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "86400"))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+INPAINT_CACHE_MAX_BYTES = int(os.getenv("INPAINT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# auto (Vision when available, else local OpenCV), vision, local or none
+FACE_DETECTOR = os.getenv("FACE_DETECTOR", "auto")
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png")
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", "90"))
+OUTPUT_COMPRESSION_LEVEL = int(os.getenv("OUTPUT_COMPRESSION_LEVEL", "6"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "256"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+# Vertex admission control: token bucket (rate/burst), in-flight cap and a
+# bounded, deadline-limited wait queue shared by every Imagen call.
+VERTEX_RATE_PER_SEC = float(os.getenv("VERTEX_RATE_PER_SEC", "1.0"))
+VERTEX_BURST = int(os.getenv("VERTEX_BURST", "5"))
+VERTEX_MAX_CONCURRENCY = int(os.getenv("VERTEX_MAX_CONCURRENCY", "8"))
+VERTEX_MAX_QUEUE = int(os.getenv("VERTEX_MAX_QUEUE", "32"))
+VERTEX_MAX_WAIT_SECONDS = float(os.getenv("VERTEX_MAX_WAIT_SECONDS", "20"))
+VERTEX_QUOTA_BACKOFF_SECONDS = float(os.getenv("VERTEX_QUOTA_BACKOFF_SECONDS", "10"))
+VERTEX_DEADLINE_SECONDS = float(os.getenv("VERTEX_DEADLINE_SECONDS", "60"))
+# Hedging: "off", "p95" (after the recent 95th percentile) or a delay in seconds.
+# Off by default: every hedge is a second billed call (Imagen, or Vision).
+VERTEX_HEDGE_AFTER = os.getenv("VERTEX_HEDGE_AFTER", "off")
+VISION_DEADLINE_SECONDS = float(os.getenv("VISION_DEADLINE_SECONDS", "10"))
+VISION_HEDGE_AFTER = os.getenv("VISION_HEDGE_AFTER", "off")
+# Consecutive upstream failures (5xx, timeouts) that open a breaker, and how
+# long it stays open before one probe call is let through.
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+BATCH_MAX_TEMPLATES = int(os.getenv("BATCH_MAX_TEMPLATES", "8"))
+# Posters of one batch that may be in flight (inpainting) at once.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+BULK_JOBS_DB_PATH = os.getenv("BULK_JOBS_DB_PATH", "bulk_jobs.db")
+# Background generations of all bulk jobs in flight at once (part of the Vertex budget).
+BULK_GENERATION_CONCURRENCY = int(os.getenv("BULK_GENERATION_CONCURRENCY", "2"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "500"))
+# Busy/quota/outage errors are retried with exponential backoff up to this many attempts.
+BULK_MAX_ATTEMPTS = int(os.getenv("BULK_MAX_ATTEMPTS", "4"))
+BULK_RETRY_SECONDS = float(os.getenv("BULK_RETRY_SECONDS", "5"))
+# Generated images are added to the template store this many at a time (and at the end).
+BULK_COMMIT_BATCH = int(os.getenv("BULK_COMMIT_BATCH", "20"))
+# A worker renews the lease on each job it runs every third of this; a job whose
+# lease is older is taken over by whichever worker claims it first.
+BULK_LEASE_SECONDS = float(os.getenv("BULK_LEASE_SECONDS", "60"))
+# Identifies this process as a lease owner (several workers may share BULK_JOBS_DB_PATH).
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# gcs, or fake (directory-backed stand-in under FAKE_GCS_DIR, for tests/benchmarks)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+FAKE_GCS_DIR = os.getenv("FAKE_GCS_DIR", os.path.join(CACHE_ROOT, "fake-gcs"))
+STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", "4"))
+STORAGE_MAX_PENDING = int(os.getenv("STORAGE_MAX_PENDING", "256"))
+# Local copies only serve until the bucket confirms the upload; then they are
+# dropped and /uploads redirects there (UPLOAD_DIR may be memory-backed).
+# STORAGE_KEEP_LOCAL=1 keeps them, e.g. for local development.
+STORAGE_KEEP_LOCAL = os.getenv("STORAGE_KEEP_LOCAL", "0") == "1"
+# Signed bucket URLs (uniform-access buckets): lifetime (V4 maximum 7 days), and
+# how long before expiry a cached one is re-signed in the background.
+SIGNED_URL_TTL_SECONDS = int(os.getenv("SIGNED_URL_TTL_SECONDS", str(24 * 3600)))
+SIGNED_URL_REFRESH_SECONDS = int(os.getenv("SIGNED_URL_REFRESH_SECONDS", "3600"))
+# /uploads objects with content-addressed names never change.
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+VARIANT_CACHE_DIR = os.path.join(CACHE_ROOT, "variants")
+VARIANT_CACHE_MAX_BYTES = int(os.getenv("VARIANT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+VARIANT_QUALITY = int(os.getenv("VARIANT_QUALITY", "80"))
+# Widths rendered in the background for every new template image.
+VARIANT_PRECOMPUTE_WIDTHS = [int(w) for w in os.getenv("VARIANT_PRECOMPUTE_WIDTHS", "320,640").split(",") if w.strip()]
+VARIANT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_PIXELS", "50000000"))
+# Only used where /proc is missing and a spooled upload has to be copied to
+# outlive the request. Defaults to the system temp dir; never under UPLOAD_DIR.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# The limit that bounds what a request can make us buffer (memory or temp
+# files): bodies above it are refused while streaming, before multipart
+# parsing finishes. MAX_UPLOAD_BYTES is then checked per file once parsed.
+# Default: two photos plus the text fields.
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(2 * MAX_UPLOAD_BYTES + 1024 * 1024)))
+# Add Server-Timing to every response, not only requests sent with X-Timing: 1.
+TIMING_HEADER_ALWAYS = os.getenv("TIMING_HEADER_ALWAYS", "0") == "1"
+PROFILE_MAX_SECONDS = 60
+
+if os.path.commonpath([os.path.abspath(CACHE_ROOT), os.path.abspath(UPLOAD_DIR)]) == os.path.abspath(UPLOAD_DIR):
+    raise RuntimeError(f"CACHE_ROOT ({CACHE_ROOT}) must not be inside {UPLOAD_DIR}/, which is served as /uploads")
 
 # Ensure local directories exist
 os.makedirs(os.path.join(UPLOAD_DIR, "templates"), exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_DIR, "generated"), exist_ok=True)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not PROJECT_ID:
+        print("WARNING: GOOGLE_CLOUD_PROJECT environment variable not set. Vertex AI will fail.")
+    # Warm clients in the background so / answers while credentials resolve;
+    # /ready flips once every required handle is built.
+    warmup = asyncio.create_task(clients.warmup())
+    # Bulk jobs interrupted by a shutdown or crash (here or in another worker)
+    # carry on from their stored state, in whichever worker claims them.
+    reclaim = asyncio.create_task(reclaim_bulk_jobs())
+    yield
+    warmup.cancel()
+    reclaim.cancel()
+    running = list(_bulk_tasks.items())
+    for _, task in running:
+        task.cancel()
+    await asyncio.gather(*(task for _, task in running), return_exceptions=True)
+    for job_id, _ in running:
+        bulk_store.release(job_id, WORKER_ID)
+    object_store.close()
+    vertex_guard.close()
+    vision_guard.close()
+    shutdown_pools()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -36,46 +185,199 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "Retry-After"],
 )
-
-# Serve local uploads
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.add_middleware(metrics.MetricsMiddleware, always_timing=TIMING_HEADER_ALWAYS)
+app.add_middleware(BodySizeLimit, max_bytes=MAX_REQUEST_BYTES)
 
 # Clients
-storage_client = None
-vision_client = None
+IMAGEN_MODEL = "imagegeneration@006"
+
+# The Cloud SDKs are imported inside the factories below (vertexai alone takes
+# about a second), so the app starts serving / and /templates before they load;
+# the lifespan warmup then imports and builds them in background threads.
+
+def _build_storage():
+    if STORAGE_BACKEND == "fake":
+        return FakeStorageClient(FAKE_GCS_DIR)
+    from google.cloud import storage
+
+    client = storage.Client()
+    # One keep-alive connection per uploader thread instead of urllib3's default of 10 shared.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, STORAGE_UPLOAD_WORKERS))
+    client._http.mount("https://", adapter)
+    return client
+
+def _build_vertex():
+    # Check Project ID first to avoid hard crash inside library
+    if not PROJECT_ID:
+        raise RuntimeError("GOOGLE_CLOUD_PROJECT environment variable not set")
+    import vertexai
+
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    return True
+
+def _build_imagen():
+    if not clients.get("vertex"):
+        raise RuntimeError("Vertex AI not initialized")
+    from vertexai.preview.vision_models import ImageGenerationModel
+
+    return ImageGenerationModel.from_pretrained(IMAGEN_MODEL)
+
+def _build_vision():
+    from google.cloud import vision
+
+    return vision.ImageAnnotatorClient()
 
-def init_clients():
-    global storage_client, vision_client
+def _hedge_setting(value: str):
+    value = (value or "").strip().lower()
+    if value in ("", "off", "0"):
+        return None
+    return value if value == "p95" else float(value)
+
+def _is_upstream_failure(e: BaseException) -> bool:
+    """Outage-type errors (5xx, timeouts, no connection or client) count against the breakers."""
+    from google.api_core.exceptions import ServerError
+
+    return isinstance(e, (ServerError, OSError, Unavailable))
+
+vertex_guard = Guard(
+    "vertex",
+    deadline=VERTEX_DEADLINE_SECONDS,
+    hedge_after=_hedge_setting(VERTEX_HEDGE_AFTER),
+    hedge_default=VERTEX_DEADLINE_SECONDS / 2,
+    breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS),
+    is_failure=_is_upstream_failure,
+    workers=2 * VERTEX_MAX_CONCURRENCY,
+)
+vision_guard = Guard(
+    "vision",
+    deadline=VISION_DEADLINE_SECONDS,
+    hedge_after=_hedge_setting(VISION_HEDGE_AFTER),
+    hedge_default=1.0,
+    breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS),
+    is_failure=_is_upstream_failure,
+)
+
+clients = ClientRegistry(
+    backoff_base=float(os.getenv("CLIENT_RETRY_BASE_SECONDS", "5")),
+    backoff_max=float(os.getenv("CLIENT_RETRY_MAX_SECONDS", "300")),
+)
+# Storage and Vision have local fallbacks, so they do not gate readiness.
+clients.register("storage", _build_storage, required=False)
+clients.register("vision", _build_vision, required=False)
+clients.register("vertex", _build_vertex, required=bool(PROJECT_ID))
+clients.register("imagen", _build_imagen, required=bool(PROJECT_ID))
+
+object_store = ObjectStore(
+    UPLOAD_DIR, BUCKET_NAME, lambda: clients.get("storage"),
+    workers=STORAGE_UPLOAD_WORKERS,
+    max_pending=STORAGE_MAX_PENDING,
+    keep_local=STORAGE_KEEP_LOCAL,
+    signed_url_ttl=SIGNED_URL_TTL_SECONDS,
+    signed_url_refresh=SIGNED_URL_REFRESH_SECONDS,
+    on_upload=lambda seconds: record_stage("gcs_upload", seconds),
+)
+
+def parse_byte_range(value: str, size: int) -> Optional[tuple]:
+    """
+    (start, end) inclusive for a single `bytes=` range; None to ignore the
+    header (malformed or several ranges); ValueError if it cannot be satisfied.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
     try:
-        # Check Project ID first to avoid hard crash inside library
-        if not PROJECT_ID:
-            print("WARNING: GOOGLE_CLOUD_PROJECT environment variable not set. Vertex AI will fail.")
-        
-        # Try to init storage, but don't crash app if it fails
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(value)
+    return start, end
+
+def _read_range(path: str, start: int, length: int, chunk: int = 64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+def may_be_in_bucket(path: str) -> bool:
+    """
+    Whether a name missing locally is worth looking up in the bucket: only
+    names we wrote (pending/uploaded) or content-addressed ones. Any other
+    path is a 404 without an outbound request.
+    """
+    return object_store.state(path) in (STORE_PENDING, STORE_UPLOADED) or is_immutable(path)
+
+class UploadFiles(StaticFiles):
+    """
+    /uploads: the local copy while we have it, else a redirect to the bucket.
+    Content-addressed names are served as immutable with their hash as a
+    strong ETag, and single byte ranges get a 206.
+    """
+
+    async def get_response(self, path: str, scope):
         try:
-            storage_client = storage.Client()
-            print("Storage Client initialized.")
-        except Exception as e:
-            print(f"Storage Client failed (using local fallback): {e}")
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            if e.status_code != 404:
+                raise
+            if not may_be_in_bucket(path):
+                raise
+            remote = await io_pool.run(object_store.remote_url, path)
+            if not remote:
+                raise
+            object_store.note_redirect()
+            # Not cacheable: the local copy may come back, and a signed target expires.
+            return RedirectResponse(remote, status_code=307, headers={"Cache-Control": "no-store"})
 
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        name = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+        headers = {"Accept-Ranges": "bytes"}
+        etag = content_etag(name)
+        if etag:
+            headers["ETag"] = etag
+        if is_immutable(name):
+            headers["Cache-Control"] = UPLOAD_CACHE_CONTROL
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        byte_range = request_headers.get("range")
+        if not byte_range or status_code != 200 or scope["method"] != "GET":
+            return response
+        if_range = request_headers.get("if-range")
+        if if_range and if_range not in (response.headers.get("etag"), response.headers.get("last-modified")):
+            return response  # changed since the client's partial copy: send it whole
+        size = stat_result.st_size
         try:
-            vision_client = vision.ImageAnnotatorClient()
-            print("Vision Client initialized.")
-        except Exception as e:
-             print(f"Vision Client failed: {e}")
-        
-        if PROJECT_ID:
-            try:
-                vertexai.init(project=PROJECT_ID, location=LOCATION)
-                print("Vertex AI initialized.")
-            except Exception as e:
-                 print(f"Vertex AI failed: {e}")
-        
-    except Exception as e:
-        print(f"WARNING: Google Cloud clients failed to initialize: {e}")
+            bounds = parse_byte_range(byte_range, size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if bounds is None:
+            return response
+        start, end = bounds
+        partial = {k: v for k, v in response.headers.items() if k in ("etag", "last-modified", "cache-control",
+                                                                      "accept-ranges")}
+        partial["Content-Range"] = f"bytes {start}-{end}/{size}"
+        partial["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(_read_range(full_path, start, end - start + 1), status_code=206,
+                                 headers=partial, media_type=response.media_type)
 
-init_clients()
+# Serve local uploads
+app.mount("/uploads", UploadFiles(directory=UPLOAD_DIR), name="uploads")
 
 # --- TEMPLATE DATABASE MANAGEMENT ---
 
@@ -161,29 +463,126 @@ def ensure_structure(templates):
             t['images'] = [t['coverImage']] if t.get('coverImage') else []
     return templates
 
-def load_templates():
-    if os.path.exists(TEMPLATES_FILE):
-        try:
-            with open(TEMPLATES_FILE, 'r') as f:
-                data = json.load(f)
-                return ensure_structure(data)
-        except:
-            return ensure_structure(INITIAL_TEMPLATES)
-    return ensure_structure(INITIAL_TEMPLATES)
-
-def save_templates(templates):
-    with open(TEMPLATES_FILE, 'w') as f:
-        json.dump(templates, f, indent=2)
-
-TEMPLATES_DB = load_templates()
+template_store = TemplateStore(TEMPLATE_DB_PATH)
+# One-time import of the legacy templates.json (or the defaults) into SQLite.
+template_store.migrate(TEMPLATES_FILE, INITIAL_TEMPLATES, normalize=ensure_structure)
+template_feed = TemplateFeed(template_store)
 
 @app.get("/")
 def health_check():
     return {"status": "ok", "project_id": PROJECT_ID}
 
 @app.get("/templates")
-def get_templates():
-    return TEMPLATES_DB
+def get_templates(
+    request: Request,
+    category: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    covers_only: bool = False,
+):
+    """
+    Template catalogue. Filters: `category`, `offset`/`limit` paging (total in
+    X-Total-Count) and `covers_only`, which drops the per-image history.
+    Revalidate with If-None-Match; the ETag changes only when templates do.
+    """
+    query = FeedQuery(category, offset, limit, covers_only)
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    etag = template_feed.etag(query)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        template_feed.note_not_modified()
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+
+    feed = template_feed.get(query)
+    headers.update({"ETag": feed.etag, "X-Total-Count": str(feed.total)})
+    if feed.gzipped is not None and accepts_gzip(request.headers.get("accept-encoding")):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=feed.gzipped, media_type="application/json", headers=headers)
+    return Response(content=feed.body, media_type="application/json", headers=headers)
+
+@app.get("/admin/cache-stats")
+def get_cache_stats():
+    return {"template_cache": template_cache.stats(), "result_cache": result_cache.stats(),
+            "template_feed": template_feed.stats(), "variants": variant_cache.stats()}
+
+@app.get("/admin/pool-stats")
+def get_pool_stats():
+    return {**pool_stats(), "jobs": job_store.stats(), "uploads": object_store.stats(),
+            "vertex": vertex_admission.stats(),
+            "guards": {"vertex": vertex_guard.stats(), "vision": vision_guard.stats()}}
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition: stage/request histograms, counters and component stats."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/profile")
+async def get_profile(seconds: float = Query(5.0, gt=0, le=PROFILE_MAX_SECONDS),
+                      interval_ms: float = Query(10.0, ge=1, le=1000)):
+    """Samples every thread's stack for `seconds`; returns collapsed stacks for a flamegraph."""
+    # A dedicated thread, so a saturated io pool can still be profiled.
+    stacks = await asyncio.to_thread(metrics.profiler.sample, seconds, interval_ms / 1000)
+    if stacks is None:
+        raise HTTPException(status_code=409, detail="A profile is already being recorded")
+    return PlainTextResponse(stacks)
+
+@app.get("/ready")
+def readiness_check():
+    body = {"ready": clients.ready(), "warm": clients.warm, "clients": clients.status()}
+    if not body["ready"]:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+async def generate_background_image(template_id: str, prompt: str, base_url: str):
+    """
+    One Imagen background for `template_id`, stored and prepared but not yet
+    added to the template. Returns (filename, public_url, image_hash).
+    """
+    if not PROJECT_ID:
+        raise HTTPException(status_code=500, detail="Vertex AI not configured (missing PROJECT_ID)")
+
+    model = await io_pool.run(clients.get, "imagen")
+    if not model:
+        raise HTTPException(status_code=503, detail="Vertex AI model unavailable, retry shortly")
+
+    # Enhanced prompt engineering for masterpiece quality
+    full_prompt = (
+        f"{prompt}, movie poster style, cinematic lighting, 8k resolution, "
+        f"photorealistic, masterpiece, highly detailed, vertical aspect ratio, no text"
+    )
+
+    print(f"Generating with prompt: {full_prompt}")
+
+    try:
+        with span("generate_background"):
+            results = await call_vertex(
+                ADMIN,
+                model.generate_images,
+                prompt=full_prompt,
+                number_of_images=1,
+                aspect_ratio="3:4",
+                guidance_scale=15,
+            )
+    except Unavailable as outage:
+        raise HTTPException(status_code=503, detail=f"Image generation {outage.reason}, retry shortly",
+                            headers={"Retry-After": str(outage.retry_after)})
+
+    if not results or not results[0]:
+        raise HTTPException(status_code=500, detail="Image generation returned no results")
+
+    generated_bytes = results[0].image_bytes
+    filename = content_name("templates", generated_bytes, "png", stem=f"{template_id}_gen_")
+
+    BYTES.inc(len(generated_bytes), direction="out", kind="template_generated")
+
+    # Local copy now, bucket copy in the background
+    with span("store"):
+        public_url = await io_pool.run(object_store.put, filename, generated_bytes, "image/png", base_url)
+    print(f"Stored: {public_url}")
+
+    # Prepare base image, face bounds and mask once, at ingest time
+    with span("template_ingest"):
+        image_hash = await io_pool.run(ingest_template_image, public_url, generated_bytes)
+    return filename, public_url, image_hash
 
 @app.post("/admin/generate-template-background")
 async def generate_template_background(
@@ -192,83 +591,216 @@ async def generate_template_background(
     prompt: str = Form(...)
 ):
     print(f"--- AI GEN BACKGROUND REQUEST: {template_id} ---")
-    global TEMPLATES_DB
-    
+    if not await io_pool.run(template_store.get, template_id):
+        raise HTTPException(status_code=404, detail="Template ID not found")
+
     try:
-        if not PROJECT_ID:
-            raise HTTPException(status_code=500, detail="Vertex AI not configured (missing PROJECT_ID)")
+        filename, public_url, image_hash = await generate_background_image(
+            template_id, prompt, str(request.base_url))
 
-        model = ImageGenerationModel.from_pretrained("imagegeneration@006")
-        
-        # Enhanced prompt engineering for masterpiece quality
-        full_prompt = (
-            f"{prompt}, movie poster style, cinematic lighting, 8k resolution, "
-            f"photorealistic, masterpiece, highly detailed, vertical aspect ratio, no text"
-        )
-        
-        print(f"Generating with prompt: {full_prompt}")
-        
-        results = model.generate_images(
-            prompt=full_prompt,
-            number_of_images=1,
-            aspect_ratio="3:4", 
-            guidance_scale=15,
-        )
-        
-        if not results or not results[0]:
-            raise HTTPException(status_code=500, detail="Image generation returned no results")
-            
-        generated_bytes = results[0].image_bytes
-        filename = f"templates/{template_id}_gen_{uuid.uuid4().hex[:6]}.png"
-        public_url = ""
-
-        # Strategy 1: Cloud Storage
-        uploaded_to_cloud = False
-        if storage_client:
-            try:
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(filename)
-                blob.upload_from_string(generated_bytes, content_type="image/png")
-                try: 
-                    blob.make_public()
-                    public_url = blob.public_url
-                except: 
-                    public_url = blob.generate_signed_url(expiration=3600*24*365)
-                uploaded_to_cloud = True
-            except Exception as e:
-                print(f"Cloud upload failed: {e}")
-
-        # Strategy 2: Local Storage
-        if not uploaded_to_cloud:
-            local_path = os.path.join(UPLOAD_DIR, filename)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            with open(local_path, "wb") as f:
-                f.write(generated_bytes)
-            
-            base_url = str(request.base_url).rstrip("/")
-            public_url = f"{base_url}/uploads/{filename}"
-            print(f"Saved locally: {public_url}")
-
-        # Update DB
-        updated = False
-        for t in TEMPLATES_DB:
-            if t['id'] == template_id:
-                if 'images' not in t: t['images'] = []
-                t['images'].insert(0, public_url)
-                t['coverImage'] = public_url
-                updated = True
-                break
-        
-        if not updated: raise HTTPException(status_code=404, detail="Template ID not found")
-        save_templates(TEMPLATES_DB)
+        # Update DB (prepend image + set cover in one transaction)
+        try:
+            await io_pool.run(template_store.add_image, template_id, public_url, image_hash)
+        except TemplateNotFound:
+            raise HTTPException(status_code=404, detail="Template ID not found")
+        precompute_variants(filename)
         
         return {"success": True, "url": public_url}
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Gen Error: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- BULK TEMPLATE BACKGROUNDS ---
+
+class BulkBackgroundItem(BaseModel):
+    template_id: str
+    prompt: str
+
+class BulkBackgroundRequest(BaseModel):
+    items: List[BulkBackgroundItem] = []
+    # Plus every template in `category`, each with `prompt` ("{title}" becomes its movie title).
+    category: Optional[str] = None
+    prompt: Optional[str] = None
+
+bulk_store = BulkJobStore(BULK_JOBS_DB_PATH)
+# Shared by every bulk job, so a catalogue run cannot take all of Vertex from user posters.
+bulk_slots = asyncio.Semaphore(BULK_GENERATION_CONCURRENCY)
+_bulk_tasks: Dict[str, asyncio.Task] = {}
+
+def _bulk_retryable(e: Exception) -> bool:
+    if isinstance(e, (Unavailable, PoolSaturated)):
+        return True
+    return isinstance(e, HTTPException) and e.status_code in (429, 503)
+
+async def _bulk_db(fn, *args, **kwargs):
+    """
+    Runs a bulk_store/template_store call on io_pool. Bulk progress must not
+    be lost to a busy pool, so a saturated pool is waited out, not raised.
+    """
+    while True:
+        try:
+            return await io_pool.run(fn, *args, **kwargs)
+        except PoolSaturated as e:
+            await asyncio.sleep(e.retry_after)
+
+async def _bulk_commit(job_id: str) -> int:
+    """
+    Adds every generated, uncommitted image of the job to its template in
+    one transaction. add_image is idempotent for the same URL, so a crash
+    between this and marking the items committed only repeats the write.
+    """
+    ready = await _bulk_db(bulk_store.items, job_id, (bulk_jobs.GENERATED,))
+    if not ready:
+        return 0
+    gone = []
+    for item in ready:
+        if not await _bulk_db(template_store.get, item["template_id"]):
+            gone.append(item)
+    for item in gone:
+        await _bulk_db(bulk_store.mark, job_id, item["position"], bulk_jobs.FAILED, error="Template ID not found")
+    ready = [i for i in ready if i not in gone]
+    if ready:
+        await _bulk_db(template_store.add_images, [(i["template_id"], i["url"], i["image_hash"]) for i in ready])
+        await _bulk_db(bulk_store.mark_committed, job_id, [i["position"] for i in ready])
+        for item in ready:
+            precompute_variants(item["url"].split("/uploads/", 1)[1])
+    return len(ready)
+
+async def _bulk_generate(job_id: str, item: Dict, base_url: str, generated):
+    position, attempts = item["position"], item["attempts"]
+    while True:
+        async with bulk_slots:
+            attempts += 1
+            await _bulk_db(bulk_store.mark, job_id, position, bulk_jobs.GENERATING, attempts=attempts)
+            try:
+                _, url, image_hash = await generate_background_image(item["template_id"], item["prompt"], base_url)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+        if error is None:
+            await _bulk_db(bulk_store.mark, job_id, position, bulk_jobs.GENERATED,
+                           url=url, image_hash=image_hash, error=None)
+            await generated()
+            return
+        detail = str(error.detail if isinstance(error, HTTPException) else error)
+        if _bulk_retryable(error) and attempts < BULK_MAX_ATTEMPTS:
+            await _bulk_db(bulk_store.mark, job_id, position, bulk_jobs.QUEUED, attempts=attempts, error=detail)
+            await asyncio.sleep(BULK_RETRY_SECONDS * 2 ** (attempts - 1))
+            continue
+        logger.warning("Bulk job %s: %s failed after %d attempts: %s", job_id, item["template_id"], attempts, detail)
+        await _bulk_db(bulk_store.mark, job_id, position, bulk_jobs.FAILED, attempts=attempts, error=detail)
+        return
+
+async def _keep_bulk_lease(job_id: str, job_task: asyncio.Task):
+    """Renews the job's lease; stops the job if another worker has taken it over."""
+    while True:
+        await asyncio.sleep(BULK_LEASE_SECONDS / 3)
+        if not await _bulk_db(bulk_store.heartbeat, job_id, WORKER_ID):
+            logger.warning("Bulk job %s: lease lost to another worker, stopping here", job_id)
+            job_task.cancel()
+            return
+
+async def run_bulk_job(job_id: str):
+    """Runs a job this worker holds the lease on (see bulk_jobs)."""
+    lease = asyncio.create_task(_keep_bulk_lease(job_id, asyncio.current_task()))
+    commit_lock = asyncio.Lock()
+
+    async def generated():
+        async with commit_lock:
+            if len(await _bulk_db(bulk_store.items, job_id, (bulk_jobs.GENERATED,))) >= BULK_COMMIT_BATCH:
+                await _bulk_commit(job_id)
+
+    try:
+        base_url = (await _bulk_db(bulk_store.params, job_id)).get("base_url", "")
+        # Items left "generating" by a crash are simply generated again.
+        todo = await _bulk_db(bulk_store.items, job_id, (bulk_jobs.QUEUED, bulk_jobs.GENERATING))
+        await asyncio.gather(*(_bulk_generate(job_id, item, base_url, generated) for item in todo))
+        async with commit_lock:
+            await _bulk_commit(job_id)
+        await _bulk_db(bulk_store.finish, job_id)
+    except asyncio.CancelledError:
+        # Shutdown or lost lease: everything done so far is stored; whoever
+        # holds the lease next resumes the rest.
+        raise
+    except Exception as e:
+        # Not transient like a shutdown: resuming would hit the same error on
+        # every reclaim, so the job ends here with the error on record.
+        logger.exception("Bulk job %s failed: %s", job_id, e)
+        try:
+            await _bulk_db(bulk_store.fail, job_id, WORKER_ID, f"{type(e).__name__}: {e}")
+        except Exception as e2:
+            logger.exception("Marking bulk job %s failed: %s", job_id, e2)
+    finally:
+        lease.cancel()
+        _bulk_tasks.pop(job_id, None)
+
+def start_bulk_job(job_id: str):
+    _bulk_tasks[job_id] = asyncio.create_task(run_bulk_job(job_id))
+
+async def reclaim_bulk_jobs():
+    """
+    Claims and resumes running jobs nobody holds a live lease on: at startup
+    those left by the last shutdown or crash, later those of a worker that died.
+    """
+    while True:
+        try:
+            for job_id in await _bulk_db(bulk_store.claim_unfinished, WORKER_ID, BULK_LEASE_SECONDS):
+                if job_id not in _bulk_tasks:
+                    logger.warning("Resuming bulk job %s", job_id)
+                    start_bulk_job(job_id)
+        except Exception as e:
+            logger.exception("Reclaiming bulk jobs failed: %s", e)
+        await asyncio.sleep(BULK_LEASE_SECONDS)
+
+@app.post("/admin/generate-template-backgrounds", status_code=202)
+async def generate_template_backgrounds(request: Request, body: BulkBackgroundRequest):
+    """
+    Generates backgrounds for many templates in the background: the listed
+    (template_id, prompt) items and/or every template in `category`. At most
+    BULK_GENERATION_CONCURRENCY generations run at once across all bulk jobs.
+    Progress, per-item errors and resulting URLs: GET /admin/bulk-jobs/{job_id}.
+    Jobs survive restarts and resume where they stopped; one that hits an
+    unexpected error is marked failed with the error instead.
+    """
+    if not PROJECT_ID:
+        raise HTTPException(status_code=500, detail="Vertex AI not configured (missing PROJECT_ID)")
+    items = [(i.template_id, i.prompt) for i in body.items]
+    if body.category:
+        if not body.prompt:
+            raise HTTPException(status_code=400, detail="prompt is required with category")
+        templates = await io_pool.run(template_store.by_category, body.category)
+        if not templates:
+            raise HTTPException(status_code=404, detail=f"No templates in category {body.category}")
+        items += [(t["id"], body.prompt.replace("{title}", t.get("movieTitle") or t.get("title", "")))
+                  for t in templates]
+    if not items:
+        raise HTTPException(status_code=400, detail="No items or category given")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} items per bulk job")
+    known = await io_pool.run(lambda ids: {t for t in ids if template_store.get(t)}, {t for t, _ in items})
+    missing = sorted({t for t, _ in items} - known)
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Unknown template IDs: {', '.join(missing)}")
+
+    job_id = await io_pool.run(bulk_store.create, items, {"base_url": str(request.base_url)}, WORKER_ID)
+    start_bulk_job(job_id)
+    return {"job_id": job_id, "total": len(items), "status": bulk_jobs.RUNNING}
+
+@app.get("/admin/bulk-jobs")
+def list_bulk_jobs(limit: int = Query(20, ge=1, le=200)):
+    return {"jobs": bulk_store.recent(limit)}
+
+@app.get("/admin/bulk-jobs/{job_id}")
+def get_bulk_job(job_id: str):
+    job = bulk_store.get(job_id)
+    if not job: raise HTTPException(status_code=404, detail="Bulk job not found")
+    return {**job, "active": job_id in _bulk_tasks}
+
 @app.post("/admin/upload-template-image")
 async def update_template_image(
     request: Request,
@@ -276,69 +808,114 @@ async def update_template_image(
     template_id: str = Form(...)
 ):
     print(f"--- UPLOAD REQUEST RECEIVED for Template: {template_id} ---")
-    global TEMPLATES_DB
-    
+    if not await io_pool.run(template_store.get, template_id):
+        raise HTTPException(status_code=404, detail="Template ID not found")
+
     try:
-        content = await file.read()
+        with await read_upload(file, "template_upload") as upload:
+            content = await io_pool.run(upload.read)
         print(f"File read successfully. Size: {len(content)} bytes")
         
-        filename = f"templates/{template_id}_{uuid.uuid4().hex[:6]}.png"
-        public_url = ""
+        filename = content_name("templates", content, "png", stem=f"{template_id}_")
 
-        # Strategy 1: Try Cloud Storage
-        uploaded_to_cloud = False
-        if storage_client:
-            try:
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(filename)
-                blob.upload_from_string(content, content_type=file.content_type)
-                try: 
-                    blob.make_public()
-                    public_url = blob.public_url
-                except: 
-                    public_url = blob.generate_signed_url(expiration=3600*24*365)
-                uploaded_to_cloud = True
-                print("Uploaded to Google Cloud Storage")
-            except Exception as cloud_err:
-                print(f"Cloud upload failed ({cloud_err}), falling back to local.")
-
-        # Strategy 2: Local Storage Fallback
-        if not uploaded_to_cloud:
-            local_path = os.path.join(UPLOAD_DIR, filename)
-            # Ensure dir exists (filename includes 'templates/')
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            with open(local_path, "wb") as f:
-                f.write(content)
-            
-            # Construct full URL based on request host
-            base_url = str(request.base_url).rstrip("/")
-            public_url = f"{base_url}/uploads/{filename}"
-            print(f"Saved locally to: {public_url}")
-
-        if not public_url:
-            raise HTTPException(status_code=500, detail="Failed to generate image URL")
-
-        # Update DB
-        updated = False
-        for t in TEMPLATES_DB:
-            if t['id'] == template_id:
-                if 'images' not in t: t['images'] = []
-                t['images'].insert(0, public_url)
-                t['coverImage'] = public_url
-                updated = True
-                break
-        
-        if not updated: raise HTTPException(status_code=404, detail="Template ID not found")
-        save_templates(TEMPLATES_DB)
+        # Local copy now, bucket copy in the background
+        with span("store"):
+            public_url = await io_pool.run(
+                object_store.put, filename, content, file.content_type or "image/png", str(request.base_url))
+        print(f"Stored: {public_url}")
+
+        # Prepare base image, face bounds and mask once, at ingest time
+        with span("template_ingest"):
+            image_hash = await io_pool.run(ingest_template_image, public_url, content)
+
+        # Update DB (prepend image + set cover in one transaction)
+        try:
+            await io_pool.run(template_store.add_image, template_id, public_url, image_hash)
+        except TemplateNotFound:
+            raise HTTPException(status_code=404, detail="Template ID not found")
+        precompute_variants(filename)
         return {"success": True, "url": public_url}
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Upload Error: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- IMAGE VARIANTS ---
+
+variant_cache = VariantCache(VARIANT_CACHE_DIR, max_bytes=VARIANT_CACHE_MAX_BYTES)
+_background_tasks = set()
+
+def load_stored_image(path: str) -> Optional[bytes]:
+    """Bytes of an uploaded/generated object: the local copy, else the bucket copy."""
+    try:
+        with open(object_store.local_path(path), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        if not may_be_in_bucket(path):
+            return None
+        remote = object_store.remote_url(path)
+        return download_image(remote) if remote else None
+
+async def render_variant(path: str, width: int, output: pipeline.OutputSettings) -> bytes:
+    source = await io_pool.run(load_stored_image, path)
+    if source is None:
+        raise FileNotFoundError(path)
+    return await cpu_pool.run(pipeline.render_variant, source, width, output)
+
+def precompute_variants(path: str):
+    """Renders the common gallery widths for a new image in the background."""
+    output = pipeline.OutputSettings("webp", VARIANT_QUALITY)
+
+    async def run():
+        for width in VARIANT_PRECOMPUTE_WIDTHS:
+            width = snap_width(width)
+            key = variant_key(path, width, output.key())
+            try:
+                await variant_cache.get_or_create(
+                    key, output.extension, lambda: render_variant(path, width, output))
+            except Exception as e:
+                print(f"Variant precompute failed for {path} @{width}: {e}")
+                return
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+@app.get("/img/{path:path}")
+async def get_image_variant(
+    request: Request,
+    path: str,
+    w: int = Query(640, ge=1, le=4096),
+    fmt: str = "webp",
+):
+    """Resized copy of an /uploads image; widths snap up to VARIANT_WIDTHS."""
+    if not is_servable(path):
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        output = pipeline.OutputSettings(fmt, VARIANT_QUALITY)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    width = snap_width(w)
+    key = variant_key(path, width, output.key())
+    headers = {"Cache-Control": VARIANT_CACHE_CONTROL, "ETag": f'"{key[:32]}"'}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        file_path = await variant_cache.get_or_create(
+            key, output.extension, lambda: render_variant(path, width, output))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+    except pipeline.InvalidImage as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except PoolSaturated as busy:
+        raise busy_error(busy)
+    return FileResponse(file_path, media_type=output.content_type, headers=headers)
+
 # --- GENERATION LOGIC ---
-# (Rest of the file remains largely unchanged, ensuring imports are kept)
 
 CREDITS_DB = {
     "Funny": ["Al Dente", "Terry Cloth", "Barb Dwyer", "Justin Case", "Paige Turner", "Rick O'Shea", "Hazel Nutt"],
@@ -347,93 +924,470 @@ CREDITS_DB = {
     "Romance": ["Val Entine", "Rose Bush", "Lovett Firstsight", "Hart Throb", "Bea Mine"]
 }
 
+template_cache = TemplateCache(
+    TEMPLATE_CACHE_DIR,
+    max_bytes=TEMPLATE_CACHE_MAX_BYTES,
+    max_disk_bytes=TEMPLATE_CACHE_DISK_MAX_BYTES,
+    ttl=TEMPLATE_CACHE_TTL,
+)
+
 def download_image(url: str) -> bytes:
     if not url: return None
+    entry = template_cache.fetch(url)
+    return entry.content if entry else None
+
+def _vision_client():
+    # An open breaker reads as "no Vision": auto mode falls back to the local
+    # detector and template masks to the center ellipse until it closes.
+    return None if vision_guard.breaker.is_open() else clients.get("vision")
+
+face_detector = make_detector(FACE_DETECTOR, _vision_client, call_vision=vision_guard.call)
+
+def get_face_bounds(img_content: Union[bytes, str]):
+    """Main face box of an upload, in EXIF-rotated original pixel coordinates."""
+    if not face_detector.available(): return None
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return response.content
+        # Detection never needs full resolution; let libjpeg decode a reduced copy.
+        img, scale = pipeline.decode_user_photo(img_content, max_side=VISION_MAX_SIDE)
+        img = ImageOps.exif_transpose(img)
+        face = largest_face(face_detector.detect(img))
+        if not face: return None
+        return tuple(int(v / scale) for v in face)
     except Exception as e:
-        print(f"Failed to download image from {url}: {e}")
+        print(f"Face detection error: {e}")
         return None
 
-def get_face_bounds(img_content: bytes):
-    if not vision_client: return None
+def detect_template_face(img_pil: PILImage.Image):
+    """Returns (face_bounds, fallback); fallback names why no face box was found."""
+    if not face_detector.available():
+        print("No face detector available, using fallback center mask.")
+        return None, "no_detector"
+
+    try:
+        faces = face_detector.detect(img_pil)
+        if not faces:
+            print("No faces detected in template. Using center fallback.")
+            return None, "no_faces"
+        return largest_face(faces), None
+
+    except Exception as e:
+        print(f"Smart Mask Generation Failed: {e}")
+        return None, "error"
+
+def generate_smart_mask(img_pil: PILImage.Image) -> PILImage.Image:
+    face_bounds, fallback = detect_template_face(img_pil)
+    return build_mask(img_pil.size, face_bounds, fallback)
+
+template_preparer = TemplatePreparer(
+    PREPARED_TEMPLATES_DIR,
+    detect_face=detect_template_face,
+    detector_quality=lambda: face_detector.quality,
+)
+
+async def prepare_template_photo(content: bytes) -> PreparedTemplate:
+    """
+    Artifacts for a template photo sent with the request, keyed and stored by
+    content hash like catalogue images, so sending the same photo again skips
+    the build. Decode, mask and PNG encoding run on cpu_pool; only the face
+    lookup (which needs this process's Vision client) runs on io_pool.
+    """
+    sha = await io_pool.run(lambda: hashlib.sha256(content).hexdigest())
+    prepared = await io_pool.run(template_preparer.load, sha)
+    if prepared:
+        return prepared
+    quality = face_detector.quality
+    template_pil = await cpu_pool.run(normalize_template, content)
+    face_bounds, fallback = await io_pool.run(detect_template_face, template_pil)
+    prepared = await cpu_pool.run(build_prepared, sha, template_pil, face_bounds, fallback, quality)
+    await io_pool.run(template_preparer.store, prepared)
+    return prepared
+
+def ingest_template_image(url: str, content: bytes) -> Optional[str]:
+    """Seeds the template cache and prepares artifacts; returns the image hash."""
     try:
-        image = vision.Image(content=img_content)
-        response = vision_client.face_detection(image=image)
-        faces = response.face_annotations
-        if not faces: return None
-        main_face = max(faces, key=lambda f: (f.bounding_poly.vertices[2].x - f.bounding_poly.vertices[0].x) * (f.bounding_poly.vertices[2].y - f.bounding_poly.vertices[0].y))
-        vertices = main_face.bounding_poly.vertices
-        x_min = min(v.x for v in vertices)
-        x_max = max(v.x for v in vertices)
-        y_min = min(v.y for v in vertices)
-        y_max = max(v.y for v in vertices)
-        return (x_min, y_min, x_max - x_min, y_max - y_min)
+        entry = template_cache.put(url, content)
+        template_preparer.prepare(content, sha256=entry.sha256)
+        return entry.sha256
     except Exception as e:
-        print(f"Face detection error: {e}")
+        print(f"Template preparation failed for {url}: {e}")
         return None
 
-def generate_smart_mask(img_pil: PILImage.Image) -> PILImage.Image:
-    if not vision_client:
-        print("Vision Client missing, using fallback center mask.")
-        mask = PILImage.new("L", img_pil.size, 0)
-        d = ImageDraw.Draw(mask)
-        w, h = img_pil.size
-        d.ellipse((w*0.25, h*0.1, w*0.75, h*0.6), fill=255)
-        return mask.filter(ImageFilter.GaussianBlur(30))
+def backfill_templates(force: bool = False):
+    """Prepares artifacts for every image referenced by the template store."""
+    updates = {}
+    for t in template_store.all():
+        prepared_map = dict(t.get('prepared') or {})
+        for url in t.get('images', []):
+            entry = template_cache.fetch(url)
+            if not entry:
+                print(f"[backfill] {t['id']}: could not fetch {url}")
+                continue
+            try:
+                template_preparer.prepare(entry.content, sha256=entry.sha256, force=force)
+            except Exception as e:
+                print(f"[backfill] {t['id']}: preparation failed for {url}: {e}")
+                continue
+            if prepared_map.get(url) != entry.sha256:
+                prepared_map[url] = entry.sha256
+                updates[t['id']] = prepared_map
+            print(f"[backfill] {t['id']}: {url} -> {entry.sha256[:12]}")
+    if updates:
+        template_store.update_many({
+            template_id: (lambda t, m=mapping: t.setdefault('prepared', {}).update(m))
+            for template_id, mapping in updates.items()
+        })
+
+def run_inpainting(model, template_bytes: bytes, mask_bytes: bytes, user_bytes: bytes, costume_description: str) -> bytes:
+    from vertexai.preview.vision_models import Image
+
+    prompt = (
+        f"A cinematic movie poster. The main character is now portrayed by the person in the reference image. "
+        f"Ensure the new face matches the dramatic lighting, shadows, skin texture, and color grading of the original movie poster exactly. "
+        f"Seamless photorealistic integration. The character is wearing {costume_description}. "
+        f"High budget Hollywood style, 8k resolution, highly detailed."
+    )
+    results = model.edit_image(
+        base_image=Image(image_bytes=template_bytes),
+        mask=Image(image_bytes=mask_bytes),
+        prompt=prompt,
+        edit_mode="inpainting-insert",
+        reference_images=[Image(image_bytes=user_bytes)],
+        guidance_scale=60, 
+        mask_mode="mask-mode-background",
+    )
+    return results.images[0].image_bytes
+
+vertex_admission = AdmissionController(
+    "vertex",
+    rate=VERTEX_RATE_PER_SEC,
+    burst=VERTEX_BURST,
+    concurrency=VERTEX_MAX_CONCURRENCY,
+    max_queue=VERTEX_MAX_QUEUE,
+    max_wait=VERTEX_MAX_WAIT_SECONDS,
+)
+
+async def call_vertex(priority: int, fn, *args, **kwargs):
+    """
+    Runs a blocking Vertex call on the io pool once admission control lets
+    it through, under vertex_guard's deadline, hedging and breaker. Shed
+    requests and upstream quota errors surface as 503/429 with Retry-After
+    instead of a late 500; an outage raises Unavailable for the caller to
+    degrade.
+    """
+    from google.api_core.exceptions import TooManyRequests
 
+    # Fail fast on an open breaker rather than queueing for a slot first.
+    vertex_guard.check()
     try:
-        img_byte_arr = io.BytesIO()
-        img_pil.save(img_byte_arr, format='JPEG')
-        content = img_byte_arr.getvalue()
-        
-        image_vision = vision.Image(content=content)
-        response = vision_client.face_detection(image=image_vision)
-        faces = response.face_annotations
+        async with vertex_admission.slot(priority):
+            return await io_pool.run(vertex_guard.call, fn, *args, **kwargs)
+    except AdmissionRejected as rejected:
+        raise HTTPException(
+            status_code=rejected.status_code,
+            detail=f"Image generation is busy ({rejected.reason}), retry shortly",
+            headers={"Retry-After": str(rejected.retry_after)},
+        )
+    except TooManyRequests as quota:
+        vertex_admission.penalize(VERTEX_QUOTA_BACKOFF_SECONDS)
+        print(f"Vertex quota exhausted: {quota}")
+        raise HTTPException(
+            status_code=429,
+            detail="Image generation quota exhausted, retry shortly",
+            headers={"Retry-After": str(math.ceil(VERTEX_QUOTA_BACKOFF_SECONDS))},
+        )
 
-        mask = PILImage.new("L", img_pil.size, 0)
-        draw = ImageDraw.Draw(mask)
+result_cache = ResultCache(
+    RESULT_CACHE_DIR,
+    ttl=RESULT_CACHE_TTL,
+    max_results=RESULT_CACHE_MAX_ENTRIES,
+    max_inpaint_bytes=INPAINT_CACHE_MAX_BYTES,
+)
 
-        if not faces:
-            print("No faces detected in template. Using center fallback.")
-            w, h = img_pil.size
-            draw.ellipse((w*0.3, h*0.15, w*0.7, h*0.6), fill=255)
-            return mask.filter(ImageFilter.GaussianBlur(40))
-
-        main_face = max(faces, key=lambda f: (f.bounding_poly.vertices[2].x - f.bounding_poly.vertices[0].x) * (f.bounding_poly.vertices[2].y - f.bounding_poly.vertices[0].y))
-        vertices = main_face.bounding_poly.vertices
-        x_min = min(v.x for v in vertices)
-        x_max = max(v.x for v in vertices)
-        y_min = min(v.y for v in vertices)
-        y_max = max(v.y for v in vertices)
-        
-        w_face = x_max - x_min
-        h_face = y_max - y_min
-        
-        pad_x = w_face * 0.4
-        pad_top = h_face * 0.8 
-        pad_bottom = h_face * 0.5
-        
-        draw.ellipse(
-            (
-                x_min - pad_x, 
-                y_min - pad_top, 
-                x_max + pad_x, 
-                y_max + pad_bottom
-            ), 
-            fill=255
+# In-memory: a job is only visible to the worker process that created it, so
+# /jobs/{id} needs a single worker (or sticky routing per job id).
+job_store = JobStore(ttl=JOB_TTL_SECONDS, max_active=JOB_MAX_PENDING)
+# Caps how many jobs run the pipeline at once; the rest wait as "queued".
+job_slots = asyncio.Semaphore(JOB_WORKERS)
+
+async def _no_report(stage: str):
+    pass
+
+async def read_upload(upload: UploadFile, kind: str) -> IngestedUpload:
+    """Validates an upload in place with ingest(); 413/415/400 for oversized, bomb or non-image files."""
+    try:
+        with span("read_upload"):
+            ingested = await io_pool.run(ingest, upload.file, MAX_UPLOAD_BYTES, MAX_UPLOAD_PIXELS, UPLOAD_SPOOL_DIR)
+    except UploadRejected as rejected:
+        UPLOAD_REJECTS.inc(kind=kind, status=rejected.status_code)
+        raise HTTPException(status_code=rejected.status_code, detail=rejected.detail)
+    BYTES.inc(ingested.size, direction="in", kind=kind)
+    return ingested
+
+def close_uploads(*uploads: Optional[IngestedUpload]):
+    for upload in uploads:
+        if upload is not None:
+            upload.close()
+
+class UserPhoto:
+    """One uploaded face photo; cropped at most once however many posters use it."""
+
+    def __init__(self, source: Union[bytes, str], sha256: Optional[str] = None):
+        # bytes, or the path of a spooled upload (which must outlive the pipeline)
+        self.source = source
+        self.sha256 = sha256 or hashlib.sha256(source).hexdigest()
+        self._face: Optional[asyncio.Future] = None
+        self._crop: Optional[asyncio.Future] = None
+
+    @classmethod
+    def from_upload(cls, upload: IngestedUpload) -> "UserPhoto":
+        return cls(upload.source, upload.sha256)
+
+    async def face(self):
+        """Main face box in EXIF-rotated original coordinates, or None."""
+        if self._face is None:
+            self._face = asyncio.ensure_future(self._detect_face())
+        # Shielded (like crop) so one cancelled poster does not cancel the shared work.
+        return await asyncio.shield(self._face)
+
+    async def _detect_face(self):
+        with span("face_detect"):
+            return await io_pool.run(get_face_bounds, self.source)
+
+    async def crop(self) -> bytes:
+        """Face-detected, EXIF-corrected PNG crop (the Vertex reference image)."""
+        if self._crop is None:
+            self._crop = asyncio.ensure_future(self._make_crop())
+        return await asyncio.shield(self._crop)
+
+    async def _make_crop(self) -> bytes:
+        face_bounds = await self.face()
+        if not face_bounds:
+            FALLBACKS.inc(path="crop:uncropped")
+        try:
+            with span("crop"):
+                return await cpu_pool.run(pipeline.crop_user_photo, self.source, face_bounds)
+        except pipeline.InvalidImage:
+            raise HTTPException(status_code=400, detail="Invalid image file")
+
+async def run_meme_pipeline(
+    photo: UserPhoto,
+    template_content: Optional[bytes],
+    template_url: Optional[str],
+    user_name: str,
+    movie_title: str,
+    tone: str,
+    costume_description: str,
+    base_url: str,
+    output: pipeline.OutputSettings = None,
+    report=_no_report,
+    mode: str = "quality",
+    preview=None,
+) -> Dict:
+    """
+    Steps 1-6 of meme generation. `report(stage)` is awaited as each stage
+    starts (mask, crop, inpaint, overlay, upload; crop and inpaint are skipped
+    on an inpaint cache hit). `mode="fast"` swaps Vertex inpainting for the
+    local compositor (mask, crop, overlay, upload). Share one `photo` across
+    calls to reuse its face box and crop for several templates. With
+    `preview`, a low-res local composite is rendered alongside inpainting
+    and awaited as `preview(event)` if it is ready first. Raises
+    HTTPException for client/AI errors and PoolSaturated when a worker pool
+    is full. When Vertex is unavailable the local composite is returned with
+    `degraded: true` and is not cached.
+    """
+    started = time.perf_counter()
+    # Fallback if vertex not available
+    if not PROJECT_ID:
+         print("WARNING: PROJECT_ID not set. Mocking generation for demo.")
+         # Simply return the user photo composited for demo if no backend
+         # In real app we raise error, but here we want robustness
+         pass
+
+    output = output or default_output_settings()
+    user_hash = photo.sha256
+
+    # 2. READ & PREP TEMPLATE
+    # 3. GENERATE MASK
+    # Both come from ingest-time artifacts keyed by image hash; a changed
+    # image hashes differently, so its artifacts are rebuilt here once.
+    await report("mask")
+    prepared = None
+    if template_content:
+        with span("mask"):
+            prepared = await prepare_template_photo(template_content)
+    elif template_url:
+        with span("template_fetch"):
+            entry = await io_pool.run(template_cache.fetch, template_url)
+        if entry:
+            with span("mask"):
+                prepared = await io_pool.run(template_preparer.prepare, entry.content, sha256=entry.sha256)
+    if not prepared: raise HTTPException(status_code=400, detail="Could not load template image")
+    if prepared.fallback:
+        # Center-ellipse mask instead of one fitted to a detected face.
+        FALLBACKS.inc(path=f"mask:{prepared.fallback}")
+
+    template_bytes = prepared.base_png
+    mask_bytes = prepared.mask_png
+
+    # Identical inputs already rendered: hand back the stored poster.
+    # Only fields that change the rendered poster are part of the key.
+    template_key = (prepared.sha256, prepared.meta.get("version"), prepared.meta.get("detector_quality"))
+    if mode == "fast":
+        result_key = make_key("result", "fast", pipeline.COMPOSITE_VERSION, user_hash, *template_key,
+                              user_name, movie_title, tone, output.key())
+    else:
+        inpaint_key = make_key("inpaint", IMAGEN_MODEL, user_hash, *template_key, costume_description)
+        result_key = make_key("result", inpaint_key, user_name, movie_title, tone, output.key(), bool(PROJECT_ID))
+    cached = result_cache.get_result(result_key)
+    if cached:
+        return {**cached, "cached": True, "degraded": False}
+
+    names = random.sample(CREDITS_DB.get(tone, CREDITS_DB["Funny"]), 2)
+    cred_text = f"DIRECTED BY {names[0].upper()}   PRODUCED BY {names[1].upper()}"
+    final_img_bytes = None
+    mock_user_png = None
+    degraded_reason = None
+    preview_task = None
+    if PROJECT_ID and mode != "fast":
+        # Same face, template and costume: reuse the inpainted base, re-render text only.
+        final_img_bytes = await io_pool.run(result_cache.get_inpaint, inpaint_key)
+
+    if mode == "fast":
+        # Local compositor: no cloud call, and no PNG crop, only the face box.
+        await report("crop")
+        user_face = await photo.face()
+        await report("overlay")
+        try:
+            output_bytes, durations = await cpu_pool.run(
+                pipeline.composite_poster_timed, template_bytes, mask_bytes, prepared.face_bounds,
+                photo.source, user_face, user_name, movie_title, cred_text, output,
+            )
+        except pipeline.InvalidImage:
+            raise HTTPException(status_code=400, detail="Invalid image file")
+    elif final_img_bytes is None:
+        if preview:
+            # Off the critical path: its own task, sharing the memoized face box.
+            preview_task = asyncio.create_task(send_preview(
+                preview, started, photo, prepared, user_name, movie_title, cred_text))
+        # 1. READ & PREP USER PHOTO
+        await report("crop")
+        # SMART CROP
+        user_bytes = await photo.crop()
+
+        # 4. AI INPAINTING
+        await report("inpaint")
+        try:
+            if PROJECT_ID:
+                # Checked outside vertex_guard: a missing client is not an
+                # upstream failure and must not trip the breaker.
+                model = await io_pool.run(clients.get, "imagen")
+                if not model:
+                    raise Unavailable("vertex", "no_client")
+                with span("inpaint"):
+                    final_img_bytes = await call_vertex(
+                        USER, run_inpainting, model, template_bytes, mask_bytes, user_bytes, costume_description
+                    )
+                await io_pool.run(result_cache.put_inpaint, inpaint_key, final_img_bytes)
+        except Unavailable as outage:
+            # Down, timed out or breaker open: serve the local composite, flagged, not a 500.
+            print(f"Inpainting degraded: {outage}")
+            degraded_reason = str(outage)
+            FALLBACKS.inc(path=f"inpaint:{outage.reason}")
+        except (PoolSaturated, HTTPException):
+            raise
+        except Exception as ai_e:
+            print(f"Vertex AI Generation Failed: {ai_e}")
+            raise HTTPException(status_code=500, detail=f"AI Generation Failed: {str(ai_e)}")
+
+        if final_img_bytes is None:
+            # Mock for no-cloud env: the face is pasted in the overlay pass
+            final_img_bytes = template_bytes
+            mock_user_png = user_bytes
+            if not degraded_reason:
+                FALLBACKS.inc(path="inpaint:mock")
+
+    if mode != "fast":
+        # 5. TEXT OVERLAYS (decoded once, encoded once in the requested format)
+        await report("overlay")
+        output_bytes, durations = await cpu_pool.run(
+            pipeline.finish_poster_timed, final_img_bytes, user_name, movie_title, cred_text,
+            output, mock_user_png=mock_user_png,
         )
-        return mask.filter(ImageFilter.GaussianBlur(radius=30))
+    if preview_task and not preview_task.done():
+        # The real poster is ready; a preview now would only arrive after it.
+        preview_task.cancel()
+    for stage, seconds in durations.items():
+        record_stage(stage, seconds)
+    BYTES.inc(len(output_bytes), direction="out", kind="poster")
+
+    # 6. SAVE & RETURN
+    await report("upload")
+    filename = content_name("generated", output_bytes, output.extension)
+    with span("store"):
+        public_url = await io_pool.run(object_store.put, filename, output_bytes, output.content_type, base_url)
 
+    result = {"public_url": public_url, "id": filename}
+    if degraded_reason:
+        # Not cached, so the same request gets the real poster once Vertex is back.
+        return {**result, "cached": False, "degraded": True, "degraded_reason": degraded_reason}
+    result_cache.put_result(result_key, result)
+    return {**result, "cached": False, "degraded": False}
+
+async def send_preview(preview, started: float, photo: UserPhoto, prepared, user_name: str,
+                       movie_title: str, credits_text: str):
+    """Renders the low-res preview and hands it to `preview`; never fails the poster itself."""
+    try:
+        user_face = await photo.face()
+        with span("preview"):
+            data = await cpu_pool.run(
+                pipeline.render_preview, prepared.base_png, prepared.mask_png, prepared.face_bounds,
+                photo.source, user_face, user_name, movie_title, credits_text,
+                cache_key=(prepared.sha256, prepared.meta.get("version")),
+            )
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        print(f"Smart Mask Generation Failed: {e}")
-        mask = PILImage.new("L", img_pil.size, 0)
-        d = ImageDraw.Draw(mask)
-        w, h = img_pil.size
-        d.ellipse((w*0.3, h*0.2, w*0.7, h*0.6), fill=255)
-        return mask.filter(ImageFilter.GaussianBlur(30))
+        # PoolSaturated or an undecodable photo: the final poster path reports those.
+        print(f"Preview skipped: {e}")
+        FALLBACKS.inc(path="preview:skipped")
+        return
+    BYTES.inc(len(data), direction="out", kind="preview")
+    elapsed = time.perf_counter() - started
+    record_stage("preview_ready", elapsed)
+    await preview({
+        "preview": "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii"),
+        "preview_ms": round(elapsed * 1000, 1),
+    })
+
+def default_output_settings() -> pipeline.OutputSettings:
+    return pipeline.OutputSettings(OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_COMPRESSION_LEVEL)
+
+def parse_output_settings(output_format: Optional[str], output_quality: Optional[int],
+                          compression_level: Optional[int]) -> pipeline.OutputSettings:
+    try:
+        return pipeline.OutputSettings(
+            output_format or OUTPUT_FORMAT,
+            OUTPUT_QUALITY if output_quality is None else output_quality,
+            OUTPUT_COMPRESSION_LEVEL if compression_level is None else compression_level,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# quality: Vertex inpainting (seconds, needs the cloud); fast: local compositor.
+RENDER_MODES = ("quality", "fast")
+
+def parse_render_mode(mode: Optional[str]) -> str:
+    mode = (mode or "quality").lower()
+    if mode not in RENDER_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(RENDER_MODES)}")
+    return mode
+
+def busy_error(busy: PoolSaturated) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=f"Server busy ({busy.pool_name} pool full), retry shortly",
+        headers={"Retry-After": str(busy.retry_after)},
+    )
 
 @app.post("/generate-meme")
 async def generate_meme(
@@ -447,169 +1401,389 @@ async def generate_meme(
     tagline: str = Form(...),
     cover_text: str = Form(...),
     tone: str = Form("Funny"),
-    costume_description: str = Form(...) 
+    costume_description: str = Form(...),
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    compression_level: Optional[int] = Form(None),
+    mode: str = Form("quality"),
+    preview: bool = Form(False),
 ):
+    """
+    Renders one poster. With `preview=true` the response is an SSE stream
+    instead: a `preview` event (low-res JPEG data URL) as soon as it is
+    rendered, then `result`, or `error` with status_code and detail.
+    """
+    output = parse_output_settings(output_format, output_quality, compression_level)
+    mode = parse_render_mode(mode)
+    user = template = None
+    streaming = False
     try:
-        # Fallback if vertex not available
-        if not PROJECT_ID:
-             print("WARNING: PROJECT_ID not set. Mocking generation for demo.")
-             # Simply return the user photo composited for demo if no backend
-             # In real app we raise error, but here we want robustness
-             pass
+        user = await read_upload(user_photo, "user_photo")
+        if template_photo:
+            template = await read_upload(template_photo, "template_photo")
+        template_content = await io_pool.run(template.read) if template else None
+        kwargs = dict(
+            user_name=user_name,
+            movie_title=movie_title,
+            tone=tone,
+            costume_description=costume_description,
+            base_url=str(request.base_url).rstrip("/"),
+            output=output,
+            mode=mode,
+        )
+        if preview:
+            streaming = True
+            return preview_stream(UserPhoto.from_upload(user), template_content, template_url, kwargs, [user, template])
+        return await run_meme_pipeline(UserPhoto.from_upload(user), template_content, template_url, **kwargs)
 
-        if not vision_client or not storage_client:
-             init_clients()
+    except PoolSaturated as busy:
+        raise busy_error(busy)
+    except HTTPException:
+        raise
+    except Exception as fatal:
+        print(f"FATAL: {fatal}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(fatal))
+    finally:
+        if not streaming:
+            close_uploads(user, template)
 
-        # 1. READ & PREP USER PHOTO
-        content = await user_photo.read()
-        try:
-            user_pil = PILImage.open(io.BytesIO(content))
-        except:
-             raise HTTPException(status_code=400, detail="Invalid image file")
-
-        user_pil = ImageOps.exif_transpose(user_pil)
-        if user_pil.mode != 'RGB':
-            user_pil = user_pil.convert('RGB')
-            
-        # SMART CROP
-        face_bounds = get_face_bounds(content)
-        if face_bounds:
-            ux, uy, uw, uh = face_bounds
-            pad = int(uw * 0.5) 
-            left = max(0, ux - pad)
-            top = max(0, uy - pad)
-            right = min(user_pil.width, ux + uw + pad)
-            bottom = min(user_pil.height, uy + uh + pad)
-            user_pil = user_pil.crop((left, top, right, bottom))
-        
-        user_bytes_io = io.BytesIO()
-        user_pil.save(user_bytes_io, format="PNG")
-        user_bytes = user_bytes_io.getvalue()
+def preview_stream(photo: UserPhoto, template_content: Optional[bytes], template_url: Optional[str],
+                   kwargs: Dict, uploads: List[Optional[IngestedUpload]]) -> StreamingResponse:
+    events: asyncio.Queue = asyncio.Queue()
 
-        # 2. READ & PREP TEMPLATE
-        template_bytes = None
-        if template_photo:
-            template_bytes = await template_photo.read()
-        elif template_url:
-            template_bytes = download_image(template_url)
-        if not template_bytes: raise HTTPException(status_code=400, detail="Could not load template image")
-
-        template_pil = PILImage.open(io.BytesIO(template_bytes)).convert("RGB")
-        if template_pil.width > 1200 or template_pil.height > 1200:
-             template_pil.thumbnail((1200, 1200), PILImage.LANCZOS)
-             
-        t_buf = io.BytesIO()
-        template_pil.save(t_buf, format="PNG")
-        template_bytes = t_buf.getvalue()
-
-        # 3. GENERATE MASK
-        mask_pil = generate_smart_mask(template_pil)
-        m_buf = io.BytesIO()
-        mask_pil.save(m_buf, format="PNG")
-        mask_bytes = m_buf.getvalue()
+    async def send_preview(event: Dict):
+        await events.put(("preview", event))
 
-        # 4. AI INPAINTING
-        final_img_bytes = None
+    async def produce():
         try:
-            if PROJECT_ID:
-                model = ImageGenerationModel.from_pretrained("imagegeneration@006")
-                prompt = (
-                    f"A cinematic movie poster. The main character is now portrayed by the person in the reference image. "
-                    f"Ensure the new face matches the dramatic lighting, shadows, skin texture, and color grading of the original movie poster exactly. "
-                    f"Seamless photorealistic integration. The character is wearing {costume_description}. "
-                    f"High budget Hollywood style, 8k resolution, highly detailed."
-                )
-                results = model.edit_image(
-                    base_image=Image(image_bytes=template_bytes),
-                    mask=Image(image_bytes=mask_bytes),
-                    prompt=prompt,
-                    edit_mode="inpainting-insert",
-                    reference_images=[Image(image_bytes=user_bytes)],
-                    guidance_scale=60, 
-                    mask_mode="mask-mode-background",
-                )
-                final_img_bytes = results.images[0].image_bytes
-            else:
-                 # Mock for no-cloud env
-                 template_pil.paste(user_pil.resize((200,200)), (100,100))
-                 buf = io.BytesIO()
-                 template_pil.save(buf, format="PNG")
-                 final_img_bytes = buf.getvalue()
-                 
-        except Exception as ai_e:
-            print(f"Vertex AI Generation Failed: {ai_e}")
-            raise HTTPException(status_code=500, detail=f"AI Generation Failed: {str(ai_e)}")
+            result = await run_meme_pipeline(photo, template_content, template_url, preview=send_preview, **kwargs)
+            await events.put(("result", result))
+        except PoolSaturated as busy:
+            await events.put(("error", {"status_code": 503, "detail": str(busy)}))
+        except HTTPException as http_e:
+            await events.put(("error", {"status_code": http_e.status_code, "detail": http_e.detail}))
+        except Exception as fatal:
+            print(f"FATAL: {fatal}")
+            traceback.print_exc()
+            await events.put(("error", {"status_code": 500, "detail": str(fatal)}))
+
+    async def event_stream():
+        task = asyncio.create_task(produce())
+        try:
+            while True:
+                event, data = await events.get()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event != "preview":
+                    break
+        finally:
+            # Client went away: stop the poster nobody will receive.
+            task.cancel()
+            close_uploads(*uploads)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- BATCH GENERATION ---
+
+class StageTimer:
+    """`report` hook that records how long each pipeline stage took."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+
+    async def report(self, stage: str):
+        self.marks.append((stage, time.perf_counter()))
+
+    def timings(self) -> Dict:
+        end = time.perf_counter()
+        out = {}
+        for i, (stage, t) in enumerate(self.marks):
+            nxt = self.marks[i + 1][1] if i + 1 < len(self.marks) else end
+            out[f"{stage}_ms"] = round((nxt - t) * 1000, 1)
+        out["total_ms"] = round((end - self.start) * 1000, 1)
+        return out
+
+async def _run_batch_item(template: Dict, photo: UserPhoto, slots: asyncio.Semaphore, **kwargs) -> Dict:
+    timer = StageTimer()
+    item = {"template_id": template["id"]}
+    try:
+        await timer.report("queued")
+        async with slots:
+            result = await run_meme_pipeline(
+                photo, None, template.get("coverImage"),
+                movie_title=template.get("movieTitle") or template.get("title", ""),
+                costume_description=template.get("costume", ""),
+                report=timer.report, **kwargs,
+            )
+        item.update(status="succeeded", **result)
+    except PoolSaturated as busy:
+        item.update(status="failed", status_code=503, detail=str(busy))
+    except HTTPException as http_e:
+        item.update(status="failed", status_code=http_e.status_code, detail=http_e.detail)
+    except Exception as fatal:
+        print(f"FATAL (batch {template['id']}): {fatal}")
+        traceback.print_exc()
+        item.update(status="failed", status_code=500, detail=str(fatal))
+    item["timings"] = timer.timings()
+    return item
+
+@app.post("/generate-meme/batch")
+async def generate_meme_batch(
+    request: Request,
+    user_photo: UploadFile = File(...),
+    template_ids: str = Form(..., description="Comma-separated template IDs"),
+    user_name: str = Form(...),
+    tone: str = Form("Funny"),
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    compression_level: Optional[int] = Form(None),
+    stream: bool = Form(False),
+    mode: str = Form("quality"),
+):
+    """
+    One photo onto several templates. The face crop is computed once and
+    shared; posters run concurrently, at most BATCH_CONCURRENCY at a time.
+    Each template's cover image, movie title and costume are used. Returns
+    all results at once, or with `stream=true` an SSE `result` event per
+    poster as it finishes followed by `done`. `mode=fast` renders every
+    poster with the local compositor instead of Vertex.
+    """
+    output = parse_output_settings(output_format, output_quality, compression_level)
+    mode = parse_render_mode(mode)
+    ids = list(dict.fromkeys(t.strip() for t in template_ids.split(",") if t.strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No template IDs given")
+    if len(ids) > BATCH_MAX_TEMPLATES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_TEMPLATES} templates per batch")
+    templates = await io_pool.run(lambda keys: [template_store.get(t) for t in keys], ids)
+    missing = [t for t, entry in zip(ids, templates) if not entry]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Unknown template IDs: {', '.join(missing)}")
+
+    try:
+        upload = await read_upload(user_photo, "user_photo")
+    except PoolSaturated as busy:
+        raise busy_error(busy)
+    photo = UserPhoto.from_upload(upload)
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    started = time.perf_counter()
+    tasks = [
+        asyncio.create_task(_run_batch_item(
+            template, photo, slots,
+            user_name=user_name, tone=tone, output=output, mode=mode,
+            base_url=str(request.base_url).rstrip("/"),
+        ))
+        for template in templates
+    ]
 
-        # 5. TEXT OVERLAYS
-        img = PILImage.open(io.BytesIO(final_img_bytes))
-        gradient = PILImage.new('L', (img.width, img.height), 0)
-        g_draw = ImageDraw.Draw(gradient)
-        g_draw.rectangle((0, int(img.height*0.65), img.width, img.height), fill=230) 
-        gradient = gradient.filter(ImageFilter.GaussianBlur(radius=60))
-        black_layer = PILImage.new('RGBA', img.size, (0,0,0,255))
-        black_layer.putalpha(gradient)
-        img = PILImage.alpha_composite(img.convert('RGBA'), black_layer)
-        draw = ImageDraw.Draw(img)
+    def summary(results: List[Dict]) -> Dict:
+        return {
+            "succeeded": sum(1 for r in results if r["status"] == "succeeded"),
+            "failed": sum(1 for r in results if r["status"] != "succeeded"),
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
 
+    if not stream:
         try:
-            font_main = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 70)
-            font_title = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 100)
-            font_credits = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 20) 
-        except:
-            font_main = ImageFont.load_default()
-            font_title = ImageFont.load_default()
-            font_credits = ImageFont.load_default()
-
-        def draw_centered(y, text, font, color="white"):
-            if not text: return
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_w = bbox[2] - bbox[0]
-            x = (img.width - text_w) / 2
-            for off in [-3, 3]:
-                draw.text((x+off, y+off), text, font=font, fill="black")
-            draw.text((x, y), text, font=font, fill=color)
-
-        draw_centered(60, user_name.upper(), font_main)
-        draw_centered(img.height - 200, movie_title.upper(), font_title, color="#FFD700")
-        names = CREDITS_DB.get(tone, CREDITS_DB["Funny"])
-        random.shuffle(names)
-        cred_text = f"DIRECTED BY {names[0].upper()}   PRODUCED BY {names[1].upper()}"
-        draw_centered(img.height - 100, cred_text, font_credits, color="#ccc")
-
-        # 6. SAVE & RETURN
-        output_buffer = io.BytesIO()
-        img.save(output_buffer, format="PNG")
-        
-        filename = f"generated/{uuid.uuid4()}.png"
-        public_url = ""
-
-        # Strategy 1: Cloud
-        if storage_client:
-             try:
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(filename)
-                blob.upload_from_string(output_buffer.getvalue(), content_type="image/png")
-                try: blob.make_public(); public_url = blob.public_url
-                except: public_url = blob.generate_signed_url(expiration=3600)
-             except Exception as e:
-                 print(f"Cloud gen upload failed: {e}")
-
-        # Strategy 2: Local
-        if not public_url:
-             local_path = os.path.join(UPLOAD_DIR, filename)
-             with open(local_path, "wb") as f:
-                 f.write(output_buffer.getvalue())
-             base_url = str(request.base_url).rstrip("/")
-             public_url = f"{base_url}/uploads/{filename}"
-
-        return {"public_url": public_url, "id": filename}
+            results = await asyncio.gather(*tasks)
+        finally:
+            upload.close()
+        return {"results": results, **summary(results)}
+
+    async def event_stream():
+        results = []
+        try:
+            for finished in asyncio.as_completed(tasks):
+                item = await finished
+                results.append(item)
+                yield f"event: result\ndata: {json.dumps(item)}\n\n"
+            yield f"event: done\ndata: {json.dumps(summary(results))}\n\n"
+        finally:
+            # Client went away: stop the posters nobody will receive.
+            for task in tasks:
+                task.cancel()
+            upload.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- ASYNC JOBS ---
 
+async def _run_meme_job(job: Job, kwargs: Dict, uploads: List[IngestedUpload], preview: bool = False):
+    async def report(stage: str):
+        await job_store.update(job, "stage", stage=stage)
+
+    async def send_preview(event: Dict):
+        await job_store.update(job, "preview", **event)
+
+    try:
+        async with job_slots:
+            result = await run_meme_pipeline(report=report, preview=send_preview if preview else None, **kwargs)
+        await job_store.update(job, "done", **result)
+    except PoolSaturated as busy:
+        await job_store.update(job, "error", status_code=503, detail=str(busy))
+    except HTTPException as http_e:
+        await job_store.update(job, "error", status_code=http_e.status_code, detail=http_e.detail)
     except Exception as fatal:
-        print(f"FATAL: {fatal}")
+        print(f"FATAL (job {job.id}): {fatal}")
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(fatal))
+        await job_store.update(job, "error", status_code=500, detail=str(fatal))
+    finally:
+        close_uploads(*uploads)
+
+@app.post("/jobs/generate-meme", status_code=202)
+async def submit_meme_job(
+    request: Request,
+    user_photo: UploadFile = File(...),
+    template_photo: UploadFile = File(None), 
+    template_id: str = Form(...),
+    template_url: Optional[str] = Form(None),
+    user_name: str = Form(...),
+    movie_title: str = Form(...),
+    tagline: str = Form(...),
+    cover_text: str = Form(...),
+    tone: str = Form("Funny"),
+    costume_description: str = Form(...),
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    compression_level: Optional[int] = Form(None),
+    mode: str = Form("quality"),
+    preview: bool = Form(False),
+):
+    """
+    Queues a poster; follow it at /jobs/{id}/events. With `preview=true` a
+    `preview` event (low-res JPEG data URL) arrives before the final result.
+    """
+    output = parse_output_settings(output_format, output_quality, compression_level)
+    mode = parse_render_mode(mode)
+    # Uploads are closed once the response goes out, so spool them now;
+    # the job removes its copies when it finishes.
+    user = template = None
+    try:
+        user = await read_upload(user_photo, "user_photo")
+        if template_photo:
+            template = await read_upload(template_photo, "template_photo")
+        template_content = await io_pool.run(template.read) if template else None
+    except PoolSaturated as busy:
+        close_uploads(user, template)
+        raise busy_error(busy)
+    except HTTPException:
+        close_uploads(user, template)
+        raise
+    # The template bytes are in memory now; only the user photo stays spooled.
+    close_uploads(template)
+
+    # Same inputs -> same job, unless the client supplies its own key.
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if not idempotency_key:
+        digest = hashlib.sha256(user.sha256.encode("ascii"))
+        digest.update((template.sha256 if template else "").encode("ascii"))
+        for field in (template_id, template_url, user_name, movie_title, tagline, cover_text, tone,
+                      costume_description, output.key(), mode):
+            digest.update(b"\0" + (field or "").encode("utf-8"))
+        idempotency_key = digest.hexdigest()
+
+    existing = job_store.find(idempotency_key)
+    if existing:
+        user.close()
+        return {"job_id": existing.id, "status": existing.status, "duplicate": True}
+
+    try:
+        job = job_store.create("generate-meme", idempotency_key)
+    except JobQueueFull:
+        user.close()
+        raise HTTPException(status_code=503, detail="Too many pending jobs, retry shortly", headers={"Retry-After": "5"})
+
+    job.task = asyncio.create_task(_run_meme_job(job, dict(
+        photo=UserPhoto.from_upload(user),
+        template_content=template_content,
+        template_url=template_url,
+        user_name=user_name,
+        movie_title=movie_title,
+        tone=tone,
+        costume_description=costume_description,
+        base_url=str(request.base_url).rstrip("/"),
+        output=output,
+        mode=mode,
+    ), [user], preview))
+    return {"job_id": job.id, "status": job.status, "duplicate": False}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if not job: raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    job = job_store.get(job_id)
+    if not job: raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        sent = 0
+        while True:
+            pending = job.events[sent:]
+            sent += len(pending)
+            for ev in pending:
+                yield f"id: {ev['seq']}\nevent: {ev['event']}\ndata: {json.dumps(ev)}\n\n"
+            if job.done:
+                return
+            # Never yield while holding job.changed: a slow client would then
+            # block every coroutine that publishes to or watches this job.
+            async with job.changed:
+                try:
+                    await asyncio.wait_for(
+                        job.changed.wait_for(lambda: len(job.events) > sent), timeout=15
+                    )
+                    idle = False
+                except asyncio.TimeoutError:
+                    idle = True
+            if idle:
+                # Comment line keeps proxies from closing an idle stream.
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Component counters exported as gauges on /metrics, read at scrape time.
+metrics.registry.register_stats("template_cache", template_cache.stats)
+metrics.registry.register_stats("result_cache", result_cache.stats)
+metrics.registry.register_stats("template_feed", template_feed.stats)
+metrics.registry.register_stats("variant_cache", variant_cache.stats)
+metrics.registry.register_stats("pool", pool_stats)
+metrics.registry.register_stats("jobs", job_store.stats)
+metrics.registry.register_stats("uploads", object_store.stats)
+metrics.registry.register_stats("vertex", vertex_admission.stats)
+metrics.registry.register_stats("vertex_guard", vertex_guard.stats)
+metrics.registry.register_stats("vision_guard", vision_guard.stats)
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="EpicMeme API server")
+    parser.add_argument("--backfill-templates", action="store_true",
+                        help="Prepare base image, face bounds and mask for every template image, then exit")
+    parser.add_argument("--force", action="store_true", help="With --backfill-templates, rebuild existing artifacts")
+    parser.add_argument("--export-templates", metavar="PATH",
+                        help="Write the template store out as templates.json-style JSON, then exit")
+    args = parser.parse_args()
+    if args.backfill_templates:
+        backfill_templates(force=args.force)
+        raise SystemExit(0)
+    if args.export_templates:
+        template_store.export_json(args.export_templates)
+        raise SystemExit(0)
+
     import uvicorn
     port = int(os.environ.get("PORT", 8080))
     print("\n" + "="*50)
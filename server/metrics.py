@@ -0,0 +1,263 @@
+"""
+In-process metrics rendered in the Prometheus text format at /metrics.
+
+- `span(stage)` / `record_stage()` time pipeline stages into the
+  `epicmeme_stage_seconds` histogram and, when the caller asked for it, into
+  the request's Server-Timing header.
+- Counters for bytes in/out, fallback paths and stage errors.
+- `registry.register_stats(prefix, fn)` exposes an existing `stats()` dict
+  (caches, pools, admission) as gauges, read at scrape time.
+- `MetricsMiddleware` records per-handler request latency.
+- `SamplingProfiler` samples every thread's stack for a few seconds and
+  returns collapsed stacks (flamegraph.pl / speedscope input).
+"""
+import re
+import sys
+import time
+import threading
+import contextvars
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for key, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+def _flatten(prefix: str, value, out: Dict[str, float]):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f"{prefix}_{k}", v, out)
+    elif isinstance(value, bool):
+        out[prefix] = float(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = value
+
+
+class Registry:
+    def __init__(self, namespace: str = "epicmeme"):
+        self.namespace = namespace
+        self._metrics = []
+        self._stats: List[Tuple[str, Callable[[], Dict]]] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(f"{self.namespace}_{name}", help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(f"{self.namespace}_{name}", help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, fn: Callable[[], Dict]):
+        """Exports every numeric field of `fn()` as a gauge at scrape time."""
+        self._stats.append((prefix, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        for prefix, fn in self._stats:
+            try:
+                values: Dict[str, float] = {}
+                _flatten(f"{self.namespace}_{prefix}", fn(), values)
+            except Exception as e:
+                print(f"Metrics collector {prefix} failed: {e}")
+                continue
+            for name, value in sorted(values.items()):
+                name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram("stage_seconds", "Time spent in each pipeline stage.", ("stage",))
+STAGE_ERRORS = registry.counter("stage_errors_total", "Stages that raised.", ("stage",))
+REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by handler.", ("method", "handler", "status"))
+BYTES = registry.counter("bytes_total", "Payload bytes by direction and kind.", ("direction", "kind"))
+FALLBACKS = registry.counter("fallback_total", "Requests served through a degraded/fallback path.", ("path",))
+UPLOAD_REJECTS = registry.counter("upload_rejected_total", "Uploads refused at ingest.", ("kind", "status"))
+
+# --- per-request timing ---
+
+_request_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+
+def record_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - t0)
+
+
+def server_timing(timings: List[Tuple[str, float]], total: float) -> str:
+    parts = [f"{re.sub(r'[^a-zA-Z0-9_-]', '_', stage)};dur={seconds * 1000:.1f}" for stage, seconds in timings]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """
+    Records request latency per handler. Requests sent with `X-Timing: 1`
+    (or every request when `always_timing`) get a Server-Timing header
+    listing the stages that completed before the response started.
+    """
+
+    def __init__(self, app, always_timing: bool = False):
+        self.app = app
+        self.always_timing = always_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        wanted = self.always_timing or Headers(scope=scope).get("x-timing") not in (None, "", "0")
+        timings = [] if wanted else None
+        token = _request_timings.set(timings)
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if timings is not None:
+                    MutableHeaders(scope=message).append(
+                        "Server-Timing", server_timing(timings, time.perf_counter() - t0))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            endpoint = scope.get("endpoint")
+            if endpoint is None:
+                handler = "unmatched"
+            else:
+                handler = getattr(endpoint, "__name__", None) or type(endpoint).__name__
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, method=scope["method"],
+                                    handler=handler, status=status[0])
+
+
+# --- sampling profiler ---
+
+class SamplingProfiler:
+    """Samples all thread stacks every `interval` seconds for `duration` seconds."""
+
+    def __init__(self):
+        self._busy = threading.Lock()
+
+    def sample(self, duration: float, interval: float = 0.01, max_depth: int = 64) -> Optional[str]:
+        """Collapsed stacks ("frame;frame;frame count" per line), or None if already running."""
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            me = threading.get_ident()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = _Tally()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    frames = []
+                    while frame is not None and len(frames) < max_depth:
+                        code = frame.f_code
+                        frames.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    frames.append(names.get(ident, str(ident)))
+                    stacks[";".join(reversed(frames))] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        finally:
+            self._busy.release()
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,429 @@
+"""
+Write-behind object storage for uploaded and generated images.
+
+`put()` writes the bytes under the local upload dir and returns the stable
+`<base_url>/uploads/<name>` URL straight away; a small dedicated thread pool
+then copies the object to the GCS bucket with retries and backoff. /uploads
+keeps serving the local copy, and once an object is confirmed in the bucket
+and the local copy is gone (pruned, or this instance never had it) it
+redirects to the bucket URL instead.
+
+Object names are content-addressed (`content_name`): the same bytes always
+get the same name, so a repeat `put()` is a no-op, and a name's bytes never
+change, so /uploads can serve it as immutable with the hash as a strong
+ETag. When the bucket refuses public objects (uniform access), redirects use
+signed URLs from `SignedUrlCache`, which re-signs shortly before expiry on a
+background thread instead of signing on every redirect.
+
+`FakeStorageClient` mimics the slice of google-cloud-storage used here and
+writes into a directory, for running without GCS credentials.
+"""
+import os
+import re
+import time
+import random
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Tuple
+
+PENDING = "pending"
+UPLOADED = "uploaded"
+FAILED = "failed"
+LOCAL_ONLY = "local"
+
+# <prefix>/[<stem>]<32 hex of sha256>.<ext>, plus the older generated/<uuid4>.<ext>
+# names. Both are written once and never replaced.
+_IMMUTABLE_NAME = re.compile(
+    r"^(?:templates|generated)/[\w-]*?(?P<hash>[0-9a-f]{32})\.\w+$"
+    r"|^generated/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.\w+$"
+)
+# Longest expiry V4 signing allows.
+MAX_SIGNED_URL_TTL = 7 * 24 * 3600
+
+
+def content_name(prefix: str, data: bytes, extension: str, stem: str = "") -> str:
+    """Content-addressed object name: `<prefix>/<stem><sha256[:32]>.<extension>`."""
+    return f"{prefix}/{stem}{hashlib.sha256(data).hexdigest()[:32]}.{extension}"
+
+
+def is_immutable(name: str) -> bool:
+    return _IMMUTABLE_NAME.match(name) is not None
+
+
+def content_etag(name: str) -> Optional[str]:
+    """Strong ETag from a content-addressed name (None for other names)."""
+    m = _IMMUTABLE_NAME.match(name)
+    return f'"{m.group("hash")}"' if m and m.group("hash") else None
+
+
+def _refuses_public(e: Exception) -> bool:
+    """Whether make_public() failed because the bucket never allows public objects."""
+    if isinstance(e, PermissionError):
+        return True
+    from google.api_core.exceptions import BadRequest, Forbidden
+
+    if isinstance(e, Forbidden):
+        return True
+    # "Cannot insert legacy ACL for an object when uniform bucket-level access is enabled."
+    return isinstance(e, BadRequest) and "uniform bucket-level access" in str(e).lower()
+
+
+class SignedUrlCache:
+    """
+    Signed bucket URLs, reused until `refresh_before` seconds ahead of their
+    expiry. Inside that window the cached URL is still returned while one
+    background re-sign replaces it, so requests only sign on a miss. Bounded
+    to `max_entries`, least recently used first out.
+    """
+
+    def __init__(self, sign: Callable[[str, int], str], ttl: int = 86400, refresh_before: int = 3600,
+                 max_entries: int = 10000, submit: Optional[Callable] = None):
+        self.sign = sign
+        self.ttl = min(ttl, MAX_SIGNED_URL_TTL)
+        self.refresh_before = min(refresh_before, self.ttl // 2)
+        self.max_entries = max_entries
+        self.submit = submit  # runs a background re-sign; None re-signs inline
+        self._lock = threading.Lock()
+        self._urls: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._refreshing = set()
+        self._stats = {"signed": 0, "hits": 0, "resigned": 0, "sign_errors": 0}
+
+    def get(self, name: str) -> Tuple[str, float]:
+        """(url, seconds a client may keep using it)."""
+        now = time.time()
+        with self._lock:
+            entry = self._urls.get(name)
+            if entry and entry[1] - now > self.refresh_before:
+                self._urls.move_to_end(name)
+                self._stats["hits"] += 1
+                return entry[0], entry[1] - now - self.refresh_before
+            stale = entry is not None and entry[1] > now and self.submit is not None
+            if stale:
+                self._stats["hits"] += 1
+                if name not in self._refreshing:
+                    self._refreshing.add(name)
+                    self.submit(self._refresh, name)
+        if stale:
+            return entry[0], 0.0
+        url, expires = self._sign(name)
+        return url, expires - time.time() - self.refresh_before
+
+    def _sign(self, name: str) -> Tuple[str, float]:
+        expires = time.time() + self.ttl
+        try:
+            url = self.sign(name, self.ttl)
+        except Exception:
+            with self._lock:
+                self._stats["sign_errors"] += 1
+            raise
+        with self._lock:
+            self._urls[name] = (url, expires)
+            self._urls.move_to_end(name)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+            self._stats["signed"] += 1
+        return url, expires
+
+    def _refresh(self, name: str):
+        try:
+            self._sign(name)
+            with self._lock:
+                self._stats["resigned"] += 1
+        except Exception as e:
+            print(f"Background re-sign of {name} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._urls)}
+
+
+class ObjectStore:
+    def __init__(self, local_dir: str, bucket_name: str, get_client: Callable[[], Any],
+                 workers: int = 4, max_pending: int = 256, max_attempts: int = 5,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 keep_local: bool = False, signed_url_ttl: int = 86400, signed_url_refresh: int = 3600,
+                 max_tracked: int = 10000, on_upload: Optional[Callable[[float], None]] = None):
+        self.local_dir = local_dir
+        self.bucket_name = bucket_name
+        self.get_client = get_client
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.keep_local = keep_local
+        self.max_tracked = max_tracked
+        self.signed_urls = SignedUrlCache(self._sign, signed_url_ttl, signed_url_refresh,
+                                          submit=lambda fn, *a: self._executor().submit(fn, *a))
+        self.on_upload = on_upload  # called with each confirmed upload's duration (s)
+
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._futures = set()
+        # Upload state of recently written names, least recently set first.
+        # Bounded: pending entries (at most max_pending) are never evicted,
+        # and an evicted name is treated like one this process never wrote.
+        self._state: "OrderedDict[str, str]" = OrderedDict()
+        self._bucket = None
+        self._bucket_client = None
+        # None until the first make_public(); False once the bucket refuses it
+        # (uniform access), so later uploads skip the extra round trip.
+        self._public_ok: Optional[bool] = None
+        self._stats = {
+            "queued": 0, "uploaded": 0, "retries": 0, "failed": 0,
+            "skipped": 0, "pruned": 0, "redirects": 0, "deduplicated": 0, "upload_ms_total": 0.0,
+        }
+
+    # --- write path ---
+
+    def local_path(self, name: str) -> str:
+        return os.path.join(self.local_dir, name)
+
+    def put(self, name: str, data: bytes, content_type: str, base_url: str) -> str:
+        """Stores `data` locally, schedules the bucket copy and returns the stable URL."""
+        url = f"{base_url.rstrip('/')}/uploads/{name}"
+        if is_immutable(name):
+            with self._lock:
+                if self._state.get(name) in (PENDING, UPLOADED):
+                    # Same bytes, same name: already in the bucket or on its way there.
+                    self._stats["deduplicated"] += 1
+                    return url
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            if len(self._futures) >= self.max_pending:
+                # Backlogged: keep serving the local copy rather than queueing without bound.
+                self._set_state(name, LOCAL_ONLY)
+                self._stats["skipped"] += 1
+            else:
+                self._set_state(name, PENDING)
+                self._stats["queued"] += 1
+                future = self._executor().submit(self._upload, name, data, content_type)
+                self._futures.add(future)
+                future.add_done_callback(self._futures.discard)
+        return url
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gcs-upload")
+        return self._pool
+
+    def _get_bucket(self):
+        client = self.get_client()
+        if client is None:
+            return None
+        if client is not self._bucket_client:
+            self._bucket = client.bucket(self.bucket_name)
+            self._bucket_client = client
+        return self._bucket
+
+    def _upload(self, name: str, data: bytes, content_type: str):
+        for attempt in range(1, self.max_attempts + 1):
+            bucket = self._get_bucket()
+            if bucket is None:
+                # No storage client (local dev, or credentials still failing).
+                self._finish(name, LOCAL_ONLY, "skipped")
+                return
+            t0 = time.perf_counter()
+            try:
+                blob = bucket.blob(name)
+                blob.upload_from_string(data, content_type=content_type)
+                self._publish(blob)
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    print(f"Cloud upload of {name} failed after {attempt} attempts: {e}")
+                    self._finish(name, FAILED, "failed")
+                    return
+                delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+                with self._lock:
+                    self._stats["retries"] += 1
+                time.sleep(delay * (0.5 + random.random() / 2))
+                continue
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self._stats["upload_ms_total"] += elapsed * 1000
+            if self.on_upload:
+                self.on_upload(elapsed)
+            self._finish(name, UPLOADED, "uploaded")
+            if not self.keep_local:
+                try:
+                    os.remove(self.local_path(name))
+                    with self._lock:
+                        self._stats["pruned"] += 1
+                except OSError:
+                    pass
+            return
+
+    def _publish(self, blob):
+        if self._public_ok is False:
+            return
+        try:
+            blob.make_public()
+            self._public_ok = True
+        except Exception as e:
+            if not _refuses_public(e):
+                raise  # transient: _upload retries the attempt
+            self._public_ok = False
+
+    def _finish(self, name: str, state: str, counter: str):
+        with self._lock:
+            self._set_state(name, state)
+            self._stats[counter] += 1
+
+    def _set_state(self, name: str, state: str):
+        # Caller holds self._lock.
+        self._state[name] = state
+        self._state.move_to_end(name)
+        if len(self._state) > self.max_tracked:
+            for old, old_state in self._state.items():
+                if old_state != PENDING:
+                    del self._state[old]
+                    break
+
+    # --- read path ---
+
+    def state(self, name: str) -> Optional[str]:
+        with self._lock:
+            return self._state.get(name)
+
+    def remote_url(self, name: str) -> Optional[str]:
+        """Bucket URL for `name`, or None if it is known not to be in the bucket."""
+        link = self.remote_link(name)
+        return link[0] if link else None
+
+    def remote_link(self, name: str) -> Optional[Tuple[str, Optional[float]]]:
+        """
+        (bucket URL, seconds it stays usable) for `name`; None for the
+        lifetime of a public URL, which does not expire. None if the object
+        is known not to be in the bucket. Names with no tracked state (written
+        by another instance, before a restart, or evicted) are assumed to be
+        in the bucket.
+        """
+        if self.state(name) in (PENDING, FAILED, LOCAL_ONLY):
+            return None
+        bucket = self._get_bucket()
+        if bucket is None:
+            return None
+        try:
+            if self._public_ok is False:
+                return self.signed_urls.get(name)
+            return bucket.blob(name).public_url, None
+        except Exception as e:
+            print(f"Could not build bucket URL for {name}: {e}")
+            return None
+
+    def _sign(self, name: str, ttl: int) -> str:
+        bucket = self._get_bucket()
+        if bucket is None:
+            raise RuntimeError("no storage client")
+        # V4 takes a timedelta as relative expiry (a bare int would be read as an epoch time by V2).
+        return bucket.blob(name).generate_signed_url(expiration=datetime.timedelta(seconds=ttl), version="v4")
+
+    def note_redirect(self):
+        with self._lock:
+            self._stats["redirects"] += 1
+
+    # --- lifecycle ---
+
+    def drain(self, timeout: Optional[float] = None) -> int:
+        """Waits up to `timeout` for queued uploads; returns how many are still pending."""
+        with self._lock:
+            futures = list(self._futures)
+        if futures:
+            wait(futures, timeout=timeout)
+        with self._lock:
+            return len(self._futures)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        left = self.drain(timeout)
+        if left:
+            print(f"{left} cloud uploads still pending at shutdown; local copies remain.")
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            data = dict(self._stats)
+            data["pending"] = len(self._futures)
+            data["tracked"] = len(self._state)
+            data["public_objects"] = self._public_ok
+        data.update({f"signed_url_{k}": v for k, v in self.signed_urls.stats().items()})
+        data["upload_ms_avg"] = round(data.pop("upload_ms_total") / data["uploaded"], 1) if data["uploaded"] else 0.0
+        return data
+
+
+# --- Local stand-in for google.cloud.storage ---
+
+class _FakeBlob:
+    def __init__(self, bucket: "_FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, self.name)
+
+    def upload_from_string(self, data, content_type: Optional[str] = None):
+        self.bucket.client._maybe_fail()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def make_public(self):
+        if not self.bucket.client.public:
+            raise PermissionError("uniform bucket-level access is enabled")
+
+    @property
+    def public_url(self) -> str:
+        return f"{self.bucket.client.base_url}/{self.bucket.name}/{self.name}"
+
+    def generate_signed_url(self, expiration=3600, **kwargs) -> str:
+        if isinstance(expiration, datetime.timedelta):
+            expiration = expiration.total_seconds()
+        expires = int(time.time() + (expiration if isinstance(expiration, (int, float)) else 3600))
+        return f"{self.public_url}?Expires={expires}&Signature=fake"
+
+
+class _FakeBucket:
+    def __init__(self, client: "FakeStorageClient", name: str):
+        self.client = client
+        self.name = name
+        self.root = os.path.join(client.root, name)
+
+    def blob(self, name: str) -> _FakeBlob:
+        return _FakeBlob(self, name)
+
+
+class FakeStorageClient:
+    """Directory-backed fake of storage.Client with optional latency and failures."""
+
+    def __init__(self, root: str, latency: float = 0.0, fail_rate: float = 0.0,
+                 public: bool = True, base_url: str = "https://storage.googleapis.com"):
+        self.root = root
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.public = public
+        self.base_url = base_url.rstrip("/")
+
+    def bucket(self, name: str) -> _FakeBucket:
+        return _FakeBucket(self, name)
+
+    def _maybe_fail(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise ConnectionError("fake GCS: injected failure")
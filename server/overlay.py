@@ -0,0 +1,128 @@
+"""
+Overlay stage: bottom darkening gradient plus name, title and credits text.
+
+The gradient only depends on the output size, so its blurred alpha is built
+once per size and cached. Compositing an opaque black layer with alpha `a`
+is just `rgb * (255 - a) / 255`, so blending is one masked fill over the
+rows the gradient covers, with no full-frame black/RGBA intermediates.
+Fonts are loaded once per process. Each string is rasterized once and
+stamped three times (two shadow offsets plus the fill). Sizes and offsets
+are for full-size posters; `scale` shrinks them all for previews.
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Tuple
+
+from PIL import Image as PILImage, ImageDraw, ImageFont, ImageFilter
+
+FONT_BOLD = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+FONT_REGULAR = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+GRADIENT_START = 0.65
+GRADIENT_ALPHA = 230
+GRADIENT_BLUR = 60
+SHADOW_OFFSETS = (-3, 3)
+
+
+@lru_cache(maxsize=None)
+def load_font(path: str, size: int):
+    try:
+        return ImageFont.truetype(path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def fonts(scale: float = 1.0):
+    size = lambda points: max(1, round(points * scale))
+    return load_font(FONT_BOLD, size(70)), load_font(FONT_BOLD, size(100)), load_font(FONT_REGULAR, size(20))
+
+
+class OverlayEngine:
+    def __init__(self, max_gradients: int = 16):
+        self.max_gradients = max_gradients
+        self._gradients: "OrderedDict[Tuple[int, int, float], tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def gradient(self, size: Tuple[int, int], scale: float = 1.0):
+        """Returns (first_row, alpha) where alpha is the blurred gradient from first_row down."""
+        key = (*size, scale)
+        with self._lock:
+            cached = self._gradients.get(key)
+            if cached is not None:
+                self._gradients.move_to_end(key)
+                self.hits += 1
+                return cached
+
+        w, h = size
+        mask = PILImage.new("L", size, 0)
+        ImageDraw.Draw(mask).rectangle((0, int(h * GRADIENT_START), w, h), fill=GRADIENT_ALPHA)
+        alpha = mask.filter(ImageFilter.GaussianBlur(radius=GRADIENT_BLUR * scale))
+        bbox = alpha.getbbox()
+        first_row = bbox[1] if bbox else h
+        entry = (first_row, alpha.crop((0, first_row, w, h)))
+
+        with self._lock:
+            self.misses += 1
+            self._gradients[key] = entry
+            while len(self._gradients) > self.max_gradients:
+                self._gradients.popitem(last=False)
+        return entry
+
+    def darken(self, img: PILImage.Image, scale: float = 1.0) -> PILImage.Image:
+        """Equivalent of alpha-compositing the blurred black gradient layer over `img`."""
+        if img.mode == "RGBA" and img.getextrema()[3][0] < 255:
+            # Translucent input: keep PIL's exact Porter-Duff math.
+            w, h = img.size
+            mask = PILImage.new("L", img.size, 0)
+            ImageDraw.Draw(mask).rectangle((0, int(h * GRADIENT_START), w, h), fill=GRADIENT_ALPHA)
+            black_layer = PILImage.new("RGBA", img.size, (0, 0, 0, 255))
+            black_layer.putalpha(mask.filter(ImageFilter.GaussianBlur(radius=GRADIENT_BLUR * scale)))
+            return PILImage.alpha_composite(img, black_layer)
+
+        first_row, alpha = self.gradient(img.size, scale)
+        out = img.convert("RGBA") if img.mode != "RGBA" else img.copy()
+        if first_row >= out.height:
+            return out
+        # Painting black through the alpha band is the opaque case of
+        # alpha_composite, done in place on just the gradient rows.
+        band = out.crop((0, first_row, out.width, out.height))
+        band.paste((0, 0, 0, 255), (0, 0), alpha)
+        out.paste(band, (0, first_row))
+        return out
+
+    def render(self, img: PILImage.Image, user_name: str, movie_title: str, credits_text: str,
+               scale: float = 1.0) -> PILImage.Image:
+        img = self.darken(img, scale)
+        font_main, font_title, font_credits = fonts(scale)
+        shadows = [round(off * scale) or (1 if off > 0 else -1) for off in SHADOW_OFFSETS]
+
+        def draw_centered(y, text, font, color="white"):
+            if not text: return
+            left, top, right, bottom = font.getbbox(text)
+            text_w = right - left
+            x = (img.width - text_w) / 2
+            # Rasterize once (same sub-pixel start ImageDraw.text would use)...
+            xi, yi = int(x), int(y)
+            mask, offset = font.getmask2(text, mode="L", start=(x - xi, y - yi))
+            mask_img = PILImage.frombytes("L", mask.size, bytes(mask)) if mask.size[0] and mask.size[1] else None
+            if mask_img is None: return
+            px, py = xi + offset[0], yi + offset[1]
+            # ...then stamp shadows and fill.
+            for off in shadows:
+                img.paste("black", (px + off, py + off), mask_img)
+            img.paste(color, (px, py), mask_img)
+
+        draw_centered(60 * scale, user_name.upper(), font_main)
+        draw_centered(img.height - 200 * scale, movie_title.upper(), font_title, color="#FFD700")
+        draw_centered(img.height - 100 * scale, credits_text, font_credits, color="#ccc")
+        return img
+
+    def stats(self):
+        with self._lock:
+            return {"gradient_hits": self.hits, "gradient_misses": self.misses, "cached_sizes": len(self._gradients)}
+
+
+engine = OverlayEngine()
@@ -0,0 +1,268 @@
+"""
+CPU-bound stages of the meme pipeline.
+
+Everything here is a plain top-level function over bytes and primitives so it
+can be shipped to a worker process. No cloud clients are touched here.
+"""
+import io
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Union
+
+from PIL import Image as PILImage, ImageOps
+
+import overlay
+
+# JPEG uploads whose longest side exceeds this are decoded at a reduced DCT
+# scale that still keeps the longest side >= this value.
+USER_PHOTO_MAX_SIDE = int(os.getenv("USER_PHOTO_MAX_SIDE", "1600"))
+# Progressive preview: longest side and JPEG quality.
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "480"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "60"))
+
+# format name -> (Pillow format, content type, file extension)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class OutputSettings:
+    """How the finished poster is encoded; validated once at the API boundary."""
+
+    __slots__ = ("format", "quality", "compress_level")
+
+    def __init__(self, format: str = "png", quality: int = 90, compress_level: int = 6):
+        format = (format or "png").lower()
+        if format == "jpg":
+            format = "jpeg"
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format '{format}' (use png, webp or jpeg)")
+        if not 1 <= quality <= 100:
+            raise ValueError("output_quality must be between 1 and 100")
+        if not 0 <= compress_level <= 9:
+            raise ValueError("compression_level must be between 0 and 9")
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+
+    @property
+    def content_type(self) -> str:
+        return OUTPUT_FORMATS[self.format][1]
+
+    @property
+    def extension(self) -> str:
+        return OUTPUT_FORMATS[self.format][2]
+
+    def key(self) -> str:
+        return f"{self.format}:{self.quality}:{self.compress_level}"
+
+
+def _encode_png(img: PILImage.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def encode_image(img: PILImage.Image, output: OutputSettings) -> bytes:
+    buf = io.BytesIO()
+    if output.format == "png":
+        img.save(buf, format="PNG", compress_level=output.compress_level)
+    elif output.format == "webp":
+        # compression_level 0-9 maps onto WebP's 0-6 effort scale.
+        img.save(buf, format="WEBP", quality=output.quality, method=min(6, round(output.compress_level * 6 / 9)))
+    else:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(buf, format="JPEG", quality=output.quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+
+def decode_user_photo(content: Union[bytes, str], max_side: int = USER_PHOTO_MAX_SIDE):
+    """
+    Opens an upload (bytes, or the path of a spooled upload), letting libjpeg
+    decode oversized JPEGs at 1/2, 1/4 or 1/8 scale. Returns (image, scale)
+    where scale maps original pixel coordinates onto the decoded image.
+    """
+    try:
+        user_pil = PILImage.open(content if isinstance(content, str) else io.BytesIO(content))
+        original_size = user_pil.size
+        longest = max(original_size)
+        if user_pil.format == "JPEG" and longest > max_side:
+            # draft() keeps both sides >= the request, so ask for the aspect-correct size.
+            user_pil.draft("RGB", (original_size[0] * max_side // longest, original_size[1] * max_side // longest))
+        user_pil.load()
+    except Exception:
+        raise InvalidImage("Invalid image file")
+    return user_pil, user_pil.width / original_size[0]
+
+
+def crop_user_photo(content: Union[bytes, str], face_bounds=None, max_side: int = USER_PHOTO_MAX_SIDE) -> bytes:
+    """Decodes the upload, applies EXIF rotation, crops around the face and returns PNG."""
+    user_pil, scale = decode_user_photo(content, max_side)
+
+    user_pil = ImageOps.exif_transpose(user_pil)
+    if user_pil.mode != 'RGB':
+        user_pil = user_pil.convert('RGB')
+
+    # SMART CROP
+    if face_bounds:
+        ux, uy, uw, uh = (int(v * scale) for v in face_bounds)
+        pad = int(uw * 0.5)
+        left = max(0, ux - pad)
+        top = max(0, uy - pad)
+        right = min(user_pil.width, ux + uw + pad)
+        bottom = min(user_pil.height, uy + uh + pad)
+        user_pil = user_pil.crop((left, top, right, bottom))
+
+    # The reference image goes to Vertex, so this is an API boundary encode.
+    return _encode_png(user_pil)
+
+
+def apply_overlays(img: PILImage.Image, user_name: str, movie_title: str, credits_text: str,
+                   scale: float = 1.0) -> PILImage.Image:
+    """Darkening gradient plus name, title and credits; returns an RGBA image."""
+    return overlay.engine.render(img, user_name, movie_title, credits_text, scale)
+
+
+def finish_poster(base_bytes: bytes, user_name: str, movie_title: str, credits_text: str,
+                  output: OutputSettings, mock_user_png: bytes = None) -> bytes:
+    """
+    Steps 4b-6 in one pass: decode the inpainted (or template) image once,
+    paste the demo face when mocking, render overlays and encode once.
+    """
+    return finish_poster_timed(base_bytes, user_name, movie_title, credits_text, output, mock_user_png)[0]
+
+
+def finish_poster_timed(base_bytes: bytes, user_name: str, movie_title: str, credits_text: str,
+                        output: OutputSettings, mock_user_png: bytes = None):
+    """finish_poster that also returns {"decode", "overlay", "encode"} durations in seconds."""
+    t0 = time.perf_counter()
+    img = PILImage.open(io.BytesIO(base_bytes))
+    if mock_user_png:
+        # Stand-in for inpainting when Vertex AI is not configured.
+        img = img.convert("RGB")
+        user_pil = PILImage.open(io.BytesIO(mock_user_png))
+        img.paste(user_pil.resize((200, 200)), (100, 100))
+    else:
+        img.load()
+    t1 = time.perf_counter()
+    img = apply_overlays(img, user_name, movie_title, credits_text)
+    t2 = time.perf_counter()
+    data = encode_image(img, output)
+    t3 = time.perf_counter()
+    return data, {"decode": t1 - t0, "overlay": t2 - t1, "encode": t3 - t2}
+
+
+# Part of the result-cache key for mode=fast; bump when compositor output changes.
+COMPOSITE_VERSION = 1
+
+
+def composite_poster_timed(base_png: bytes, mask_png: bytes, template_face, user_content: Union[bytes, str],
+                           user_face, user_name: str, movie_title: str, credits_text: str,
+                           output: OutputSettings, max_side: int = USER_PHOTO_MAX_SIDE):
+    """
+    mode=fast: composites the user's face into the template locally (no
+    Vertex call), then overlays and encodes. `user_face` is in EXIF-rotated
+    original pixel coordinates, as from face detection. Returns (bytes,
+    {"decode", "composite", "overlay", "encode"} durations in seconds).
+    """
+    # numpy stays out of the web process's import path (cold start).
+    import compositor
+
+    t0 = time.perf_counter()
+    base = PILImage.open(io.BytesIO(base_png)).convert("RGB")
+    mask = PILImage.open(io.BytesIO(mask_png)).convert("L")
+    user_pil, scale = decode_user_photo(user_content, max_side)
+    user_pil = ImageOps.exif_transpose(user_pil)
+    if user_pil.mode != "RGB":
+        user_pil = user_pil.convert("RGB")
+    if user_face:
+        user_face = tuple(v * scale for v in user_face)
+    t1 = time.perf_counter()
+    img = compositor.composite_face(base, mask, template_face, user_pil, user_face)
+    t2 = time.perf_counter()
+    img = apply_overlays(img, user_name, movie_title, credits_text)
+    t3 = time.perf_counter()
+    data = encode_image(img, output)
+    t4 = time.perf_counter()
+    return data, {"decode": t1 - t0, "composite": t2 - t1, "overlay": t3 - t2, "encode": t4 - t3}
+
+
+# Preview-sized (base, mask, factor) per template, per worker process: decoding
+# the full-size template PNG is most of a preview's cost.
+_preview_templates: "OrderedDict[tuple, tuple]" = OrderedDict()
+_PREVIEW_TEMPLATES_MAX = 32
+_preview_lock = threading.Lock()
+
+
+def _preview_template(base_png: bytes, mask_png: bytes, max_side: int, cache_key) -> tuple:
+    key = (cache_key, max_side) if cache_key else None
+    with _preview_lock:
+        cached = _preview_templates.get(key) if key else None
+        if cached:
+            _preview_templates.move_to_end(key)
+            return cached
+    base = PILImage.open(io.BytesIO(base_png)).convert("RGB")
+    factor = max(1, -(-max(base.size) // max_side))
+    entry = (base.reduce(factor), PILImage.open(io.BytesIO(mask_png)).convert("L").reduce(factor), factor)
+    if key:
+        with _preview_lock:
+            _preview_templates[key] = entry
+            while len(_preview_templates) > _PREVIEW_TEMPLATES_MAX:
+                _preview_templates.popitem(last=False)
+    return entry
+
+
+def render_preview(base_png: bytes, mask_png: bytes, template_face, user_content: Union[bytes, str],
+                   user_face, user_name: str, movie_title: str, credits_text: str,
+                   max_side: int = PREVIEW_MAX_SIDE, quality: int = PREVIEW_QUALITY, cache_key=None) -> bytes:
+    """
+    Low-res JPEG of the poster to show while inpainting runs: the local
+    compositor plus overlays, all at about `max_side`. Box-reduced by an
+    integer factor rather than resampled, since speed matters more here.
+    `cache_key` (the prepared template's identity) keeps the reduced
+    template around for the next preview in this process.
+    """
+    import compositor
+
+    base, mask, factor = _preview_template(base_png, mask_png, max_side, cache_key)
+    if template_face:
+        template_face = tuple(v / factor for v in template_face)
+    user_pil, scale = decode_user_photo(user_content, max_side)
+    user_pil = ImageOps.exif_transpose(user_pil)
+    if user_pil.mode != "RGB":
+        user_pil = user_pil.convert("RGB")
+    if user_face:
+        user_face = tuple(v * scale for v in user_face)
+    img = compositor.composite_face(base, mask, template_face, user_pil, user_face)
+    img = apply_overlays(img, user_name, movie_title, credits_text, scale=1 / factor)
+    return encode_image(img, OutputSettings("jpeg", quality))
+
+
+def render_variant(content: bytes, width: int, output: OutputSettings) -> bytes:
+    """Downscales (never upscales) an image to `width` and re-encodes it."""
+    try:
+        img = PILImage.open(io.BytesIO(content))
+        if img.width > width:
+            height = max(1, round(img.height * width / img.width))
+            if img.format == "JPEG":
+                img.draft("RGB", (width, height))
+            img = img.resize((width, height), PILImage.LANCZOS, reducing_gap=3.0)
+        else:
+            img.load()
+    except Exception:
+        raise InvalidImage("Invalid image file")
+    if img.mode in ("RGBA", "LA") and img.getextrema()[-1][0] == 255:
+        # Opaque posters carry a useless alpha channel; dropping it shrinks WebP/PNG.
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    return encode_image(img, output)
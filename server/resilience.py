@@ -0,0 +1,238 @@
+"""
+Deadlines, hedged requests and a circuit breaker for the blocking Cloud calls
+(Vertex inpainting, Vision face detection).
+
+`Guard.call(fn, *args, **kwargs)` runs `fn` on the guard's own threads and
+returns its result, or raises Unavailable:
+
+- "circuit_open": the breaker is open, so no call is made at all;
+- "deadline": no attempt answered within `deadline` seconds. The attempt
+  is abandoned: the SDK call finishes in the background and is discarded;
+- "error": every attempt failed with an upstream error (`is_failure`).
+
+Other exceptions (bad input, quota) pass through unchanged and do not count
+against the breaker. With hedging on, a second identical attempt starts
+when the first has not answered after `hedge_after` seconds ("p95": the
+95th percentile of recent successful calls), or straight away if the first
+fails fast; the first success wins.
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Optional, Union
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class Unavailable(Exception):
+    def __init__(self, name: str, reason: str, retry_after: int = 5):
+        super().__init__(f"{name} unavailable ({reason})")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. After `reset_after` seconds
+    it lets a single probe through (half-open); the probe's outcome closes
+    or re-opens it.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        self.threshold = max(1, threshold)
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opens = 0
+
+    def _current(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.reset_after:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current(time.monotonic())
+
+    def is_open(self) -> bool:
+        """True while calls are being refused (does not use up the half-open probe)."""
+        return self.state == OPEN
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._current(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self) -> int:
+        with self._lock:
+            left = self.reset_after - (time.monotonic() - self._opened_at)
+        return max(1, int(left + 0.999))
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._current(time.monotonic())
+            if state == HALF_OPEN or (state == CLOSED and self._failures >= self.threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self.opens += 1
+
+
+class LatencyWindow:
+    """Durations of the last `size` successful calls, for the adaptive hedge delay."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def _timed(fn, args, kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+class Guard:
+    def __init__(self, name: str, deadline: float, hedge_after: Union[None, str, float] = None,
+                 hedge_default: float = 5.0, breaker: Optional[CircuitBreaker] = None,
+                 is_failure: Optional[Callable[[BaseException], bool]] = None, workers: int = 16):
+        self.name = name
+        self.deadline = deadline
+        self.hedge_after = hedge_after  # None (off), "p95", or seconds
+        self.hedge_default = hedge_default  # used for "p95" until enough samples exist
+        self.breaker = breaker or CircuitBreaker()
+        self.is_failure = is_failure or (lambda e: True)
+        self.latency = LatencyWindow()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-call")
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0, "succeeded": 0, "failed": 0, "deadlines": 0, "rejected_open": 0,
+            "hedges_fired": 0, "hedges_won": 0,
+        }
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_after is None:
+            return None
+        if self.hedge_after == "p95":
+            p95 = self.latency.p95()
+            return self.hedge_default if p95 is None else p95
+        return float(self.hedge_after)
+
+    def check(self):
+        """Raises Unavailable straight away while the breaker is open."""
+        if self.breaker.is_open():
+            self._count("rejected_open")
+            raise Unavailable(self.name, "circuit_open", self.breaker.retry_after())
+
+    def call(self, fn, *args, **kwargs):
+        if not self.breaker.allow():
+            self._count("rejected_open")
+            raise Unavailable(self.name, "circuit_open", self.breaker.retry_after())
+        self._count("calls")
+        start = time.monotonic()
+        deadline_at = start + self.deadline
+        delay = self.hedge_delay()
+        hedge_at = start + delay if delay is not None else None
+
+        primary = self._pool.submit(_timed, fn, args, kwargs)
+        running = {primary}
+        hedge = None
+        last_error: Optional[BaseException] = None
+        while True:
+            now = time.monotonic()
+            wake = deadline_at if hedge is not None or hedge_at is None else min(deadline_at, hedge_at)
+            if running:
+                done, _ = wait(running, timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+            else:
+                done = set()
+            for future in done:
+                running.discard(future)
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    if not self.is_failure(e):
+                        # The service answered; the request itself was refused.
+                        self.breaker.record_success()
+                        raise
+                    last_error = e
+                    continue
+                self.latency.add(seconds)
+                self.breaker.record_success()
+                self._count("succeeded")
+                if future is hedge:
+                    self._count("hedges_won")
+                return result
+
+            now = time.monotonic()
+            if now >= deadline_at:
+                break
+            if hedge is None and hedge_at is not None and (now >= hedge_at or not running):
+                hedge = self._pool.submit(_timed, fn, args, kwargs)
+                running.add(hedge)
+                self._count("hedges_fired")
+                continue
+            if not running:
+                break
+
+        self.breaker.record_failure()
+        self._count("failed")
+        retry_after = self.breaker.retry_after() if self.breaker.is_open() else 5
+        if running:
+            self._count("deadlines")
+            raise Unavailable(self.name, "deadline", retry_after) from last_error
+        print(f"{self.name} call failed: {last_error}")
+        raise Unavailable(self.name, "error", retry_after) from last_error
+
+    def stats(self) -> Dict:
+        with self._lock:
+            data = dict(self._stats)
+        state = self.breaker.state
+        data["breaker_state"] = _STATE_CODES[state]  # 0 closed, 1 half-open, 2 open
+        data["breaker_open"] = state == OPEN
+        data["breaker_opens"] = self.breaker.opens
+        delay = self.hedge_delay()
+        data["hedge_delay_ms"] = round(delay * 1000, 1) if delay is not None else 0.0
+        p95 = self.latency.p95()
+        data["p95_ms"] = round(p95 * 1000, 1) if p95 is not None else 0.0
+        return data
+
+    def close(self):
+        self._pool.shutdown(wait=False)
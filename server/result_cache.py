@@ -0,0 +1,155 @@
+"""
+Content-addressed cache of generation results.
+
+Two tiers, so a retry that only changes text skips Vertex:
+- results: full-request key -> stored {"public_url", "id"}; in memory, bounded
+  by entry count.
+- inpaint: (user photo, template, costume) key -> inpainted image bytes; on
+  disk under `<cache_dir>/inpaint/`, bounded by total bytes.
+Both tiers expire entries after `ttl` seconds and evict least recently used.
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+def make_key(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(b"\0" + ("" if part is None else str(part)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir: str, ttl: int = 86400, max_results: int = 10000,
+                 max_inpaint_bytes: int = 512 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_results = max_results
+        self.max_inpaint_bytes = max_inpaint_bytes
+        self.inpaint_dir = os.path.join(cache_dir, "inpaint")
+        os.makedirs(self.inpaint_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._results: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (created, result)
+        self._inpaint: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (created, size)
+        self._inpaint_bytes = 0
+        self._stats = {
+            "result_hits": 0, "result_misses": 0, "result_evictions": 0,
+            "inpaint_hits": 0, "inpaint_misses": 0, "inpaint_evictions": 0,
+        }
+        self._load_inpaint_index()
+
+    # --- results tier ---
+
+    def get_result(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._results.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self._results.move_to_end(key)
+                self._stats["result_hits"] += 1
+                return dict(entry[1])
+            if entry:
+                del self._results[key]
+                self._stats["result_evictions"] += 1
+            self._stats["result_misses"] += 1
+            return None
+
+    def put_result(self, key: str, result: Dict):
+        with self._lock:
+            self._results[key] = (time.time(), dict(result))
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+                self._stats["result_evictions"] += 1
+
+    # --- inpaint tier ---
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.inpaint_dir, f"{key}.bin")
+
+    def _load_inpaint_index(self):
+        entries = []
+        for name in os.listdir(self.inpaint_dir):
+            if not name.endswith(".bin"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.inpaint_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        for created, key, size in sorted(entries):
+            self._inpaint[key] = (created, size)
+            self._inpaint_bytes += size
+        self._evict_inpaint()
+
+    def get_inpaint(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._inpaint.get(key)
+            expired = entry and time.time() - entry[0] >= self.ttl
+            if not entry or expired:
+                if expired:
+                    self._drop_inpaint(key)
+                    self._stats["inpaint_evictions"] += 1
+                self._stats["inpaint_misses"] += 1
+                return None
+            self._inpaint.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._drop_inpaint(key)
+                self._stats["inpaint_misses"] += 1
+            return None
+        with self._lock:
+            self._stats["inpaint_hits"] += 1
+        return data
+
+    def put_inpaint(self, key: str, data: bytes):
+        if len(data) > self.max_inpaint_bytes:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Inpaint cache write failed: {e}")
+            return
+        with self._lock:
+            if key in self._inpaint:
+                self._inpaint_bytes -= self._inpaint[key][1]
+            self._inpaint[key] = (time.time(), len(data))
+            self._inpaint.move_to_end(key)
+            self._inpaint_bytes += len(data)
+            self._evict_inpaint()
+
+    def _drop_inpaint(self, key: str):
+        entry = self._inpaint.pop(key, None)
+        if entry:
+            self._inpaint_bytes -= entry[1]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict_inpaint(self):
+        while self._inpaint_bytes > self.max_inpaint_bytes and self._inpaint:
+            key = next(iter(self._inpaint))
+            self._drop_inpaint(key)
+            self._stats["inpaint_evictions"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            data = dict(self._stats)
+            data["result_entries"] = len(self._results)
+            data["inpaint_entries"] = len(self._inpaint)
+            data["inpaint_bytes"] = self._inpaint_bytes
+        for tier in ("result", "inpaint"):
+            lookups = data[f"{tier}_hits"] + data[f"{tier}_misses"]
+            data[f"{tier}_hit_rate"] = round(data[f"{tier}_hits"] / lookups, 4) if lookups else 0.0
+        return data
@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CachedImage:
+    """A fetched template image plus the validators needed to revalidate it."""
+
+    __slots__ = ("url", "content", "sha256", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, url, content, sha256, etag=None, last_modified=None, fetched_at=None):
+        self.url = url
+        self.content = content
+        self.sha256 = sha256
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at or time.time()
+
+    def meta(self) -> Dict:
+        return {
+            "url": self.url,
+            "sha256": self.sha256,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "fetched_at": self.fetched_at,
+        }
+
+
+class _Flight:
+    __slots__ = ("event", "result")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class TemplateCache:
+    """
+    Two-tier cache for remote template images.
+
+    Memory tier: LRU keyed by URL, bounded by total content bytes.
+    Disk tier: `<cache_dir>/meta/<sha256(url)>.json` points at a content-addressed
+    blob in `<cache_dir>/blobs/<sha256(content)>`, so identical posters served
+    from different URLs are stored once. Meta and blob files share an LRU
+    bounded by `max_disk_bytes`; reads touch their mtime, so the order also
+    survives restarts. A meta whose blob was evicted is dropped on next read.
+
+    Entries older than `ttl` are revalidated with If-None-Match / If-Modified-Since.
+    Concurrent fetches of the same URL are coalesced into a single download.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 64 * 1024 * 1024,
+                 max_disk_bytes: int = 512 * 1024 * 1024,
+                 ttl: int = 3600, timeout: int = 10, pool_size: int = 10):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+
+        os.makedirs(os.path.join(cache_dir, "meta"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+
+        self._memory: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._disk: "OrderedDict[str, int]" = OrderedDict()  # path -> size, least recently used first
+        self._disk_bytes = 0
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "refreshed": 0,
+            "coalesced": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+            "errors": 0,
+        }
+        self._load_disk_index()
+
+    # --- public API ---
+
+    def fetch(self, url: str) -> Optional[CachedImage]:
+        if not url:
+            return None
+
+        entry = self._lookup(url)
+        if entry and time.time() - entry.fetched_at < self.ttl:
+            return entry
+
+        # Single-flight: the first caller downloads, everyone else waits for it.
+        with self._lock:
+            flight = self._flights.get(url)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[url] = flight
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            flight.event.wait(self.timeout * 2)
+            return flight.result or entry
+
+        try:
+            flight.result = self._download(url, entry)
+        finally:
+            with self._lock:
+                self._flights.pop(url, None)
+            flight.event.set()
+        return flight.result
+
+    def put(self, url: str, content: bytes) -> CachedImage:
+        """Seeds the cache with bytes we already hold, e.g. a freshly uploaded template."""
+        entry = CachedImage(url, content, hashlib.sha256(content).hexdigest())
+        self._write_disk(entry)
+        self._remember(entry)
+        return entry
+
+    def stats(self) -> Dict:
+        with self._lock:
+            data = dict(self._stats)
+            data["memory_entries"] = len(self._memory)
+            data["memory_bytes"] = self._memory_bytes
+            data["max_bytes"] = self.max_bytes
+            data["disk_files"] = len(self._disk)
+            data["disk_bytes"] = self._disk_bytes
+            data["max_disk_bytes"] = self.max_disk_bytes
+        lookups = data["memory_hits"] + data["disk_hits"] + data["misses"]
+        data["hit_rate"] = round((data["memory_hits"] + data["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return data
+
+    # --- tiers ---
+
+    def _lookup(self, url: str) -> Optional[CachedImage]:
+        with self._lock:
+            entry = self._memory.get(url)
+            if entry:
+                self._memory.move_to_end(url)
+                self._stats["memory_hits"] += 1
+                return entry
+
+        entry = self._read_disk(url)
+        with self._lock:
+            if entry:
+                self._stats["disk_hits"] += 1
+            else:
+                self._stats["misses"] += 1
+        if entry:
+            self._remember(entry)
+        return entry
+
+    def _remember(self, entry: CachedImage):
+        size = len(entry.content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(entry.url, None)
+            if old:
+                self._memory_bytes -= len(old.content)
+            self._memory[entry.url] = entry
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted.content)
+                self._stats["evictions"] += 1
+
+    def _meta_path(self, url: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "meta", f"{key}.json")
+
+    def _blob_path(self, sha: str) -> str:
+        return os.path.join(self.cache_dir, "blobs", sha)
+
+    def _read_disk(self, url: str) -> Optional[CachedImage]:
+        meta_path = self._meta_path(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            blob_path = self._blob_path(meta["sha256"])
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            with open(blob_path, "rb") as f:
+                content = f.read()
+        except OSError:
+            # Blob evicted (here or by another process sharing the directory).
+            self._remove_disk([meta_path])
+            return None
+        if hashlib.sha256(content).hexdigest() != meta["sha256"]:
+            return None
+        self._touch_disk(meta_path)
+        self._touch_disk(blob_path)
+        return CachedImage(
+            url, content, meta["sha256"],
+            etag=meta.get("etag"),
+            last_modified=meta.get("last_modified"),
+            fetched_at=meta.get("fetched_at", 0),
+        )
+
+    def _write_disk(self, entry: CachedImage):
+        try:
+            blob_path = self._blob_path(entry.sha256)
+            if os.path.exists(blob_path):
+                self._touch_disk(blob_path)
+            else:
+                tmp = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(entry.content)
+                os.replace(tmp, blob_path)
+                self._track_disk(blob_path, len(entry.content))
+            meta_path = self._meta_path(entry.url)
+            meta = json.dumps(entry.meta())
+            tmp = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(meta)
+            os.replace(tmp, meta_path)
+            self._track_disk(meta_path, len(meta))
+        except OSError as e:
+            print(f"Template cache disk write failed for {entry.url}: {e}")
+        self._evict_disk()
+
+    # --- disk budget ---
+
+    def _load_disk_index(self):
+        files = []
+        for sub in ("meta", "blobs"):
+            folder = os.path.join(self.cache_dir, sub)
+            for name in os.listdir(folder):
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._disk[path] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _track_disk(self, path: str, size: int):
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(path, 0)
+            self._disk[path] = size
+
+    def _touch_disk(self, path: str):
+        with self._lock:
+            if path in self._disk:
+                self._disk.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        victims = []
+        with self._lock:
+            while self._disk_bytes > self.max_disk_bytes and self._disk:
+                path, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self._stats["disk_evictions"] += 1
+                victims.append(path)
+        self._remove_disk(victims, tracked=False)
+
+    def _remove_disk(self, paths, tracked: bool = True):
+        for path in paths:
+            if tracked:
+                with self._lock:
+                    self._disk_bytes -= self._disk.pop(path, 0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # --- network ---
+
+    def _download(self, url: str, stale: Optional[CachedImage]) -> Optional[CachedImage]:
+        headers = {}
+        if stale:
+            if stale.etag:
+                headers["If-None-Match"] = stale.etag
+            if stale.last_modified:
+                headers["If-Modified-Since"] = stale.last_modified
+
+        try:
+            response = self._session.get(url, headers=headers, timeout=self.timeout)
+            if stale and response.status_code == 304:
+                stale.fetched_at = time.time()
+                with self._lock:
+                    self._stats["revalidated"] += 1
+                self._write_disk(stale)
+                self._remember(stale)
+                return stale
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Failed to download image from {url}: {e}")
+            with self._lock:
+                self._stats["errors"] += 1
+            # A stale copy beats no template at all.
+            return stale
+
+        content = response.content
+        entry = CachedImage(
+            url, content, hashlib.sha256(content).hexdigest(),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+        if stale:
+            with self._lock:
+                self._stats["refreshed"] += 1
+        self._write_disk(entry)
+        self._remember(entry)
+        return entry
@@ -0,0 +1,124 @@
+"""
+Pre-serialized views of the template catalogue for GET /templates.
+
+Each distinct query (category, offset, limit, covers_only) is rendered once
+per template-store version into JSON bytes plus a gzipped copy, and served
+from memory until an admin write bumps the version. The ETag is derived
+from the version and the query alone, so a matching If-None-Match can be
+answered with 304 without touching the catalogue.
+"""
+import gzip
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+# Server-side bookkeeping that never leaves the process (url -> prepared sha).
+INTERNAL_FIELDS = ("prepared",)
+# Per-image history that a gallery view does not need.
+HISTORY_FIELDS = ("images",)
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+
+class FeedQuery(NamedTuple):
+    category: Optional[str] = None
+    offset: int = 0
+    limit: Optional[int] = None
+    covers_only: bool = False
+
+
+class FeedBody:
+    def __init__(self, version: int, etag: str, body: bytes, total: int):
+        self.version = version
+        self.etag = etag
+        self.body = body
+        self.total = total
+        self.gzipped = (gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+                        if len(body) >= GZIP_MIN_BYTES else None)
+
+
+def make_etag(version: int, query: FeedQuery) -> str:
+    digest = hashlib.sha1(json.dumps(list(query)).encode("utf-8")).hexdigest()[:12]
+    return f'"v{version}-{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    for part in (accept_encoding or "").lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip() not in ("gzip", "*"):
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class TemplateFeed:
+    def __init__(self, store, max_variants: int = 64):
+        self.store = store
+        self.max_variants = max_variants
+        self._bodies: "OrderedDict[FeedQuery, FeedBody]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "builds": 0, "not_modified": 0}
+
+    def etag(self, query: FeedQuery) -> str:
+        return make_etag(self.store.version(), query)
+
+    def note_not_modified(self):
+        with self._lock:
+            self._stats["not_modified"] += 1
+
+    def get(self, query: FeedQuery) -> FeedBody:
+        version = self.store.version()
+        with self._lock:
+            cached = self._bodies.get(query)
+            if cached is not None and cached.version == version:
+                self._bodies.move_to_end(query)
+                self._stats["hits"] += 1
+                return cached
+
+        version, templates = self.store.snapshot()
+        selected = self._select(templates, query)
+        body = json.dumps(selected, separators=(",", ":")).encode("utf-8")
+        total = len(templates) if query.category is None else sum(
+            1 for t in templates if t.get("category") == query.category)
+        entry = FeedBody(version, make_etag(version, query), body, total)
+
+        with self._lock:
+            self._stats["builds"] += 1
+            self._bodies[query] = entry
+            self._bodies.move_to_end(query)
+            while len(self._bodies) > self.max_variants:
+                self._bodies.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _select(templates: List[Dict], query: FeedQuery) -> List[Dict]:
+        if query.category is not None:
+            templates = [t for t in templates if t.get("category") == query.category]
+        end = None if query.limit is None else query.offset + query.limit
+        templates = templates[query.offset:end]
+        hidden = INTERNAL_FIELDS + HISTORY_FIELDS if query.covers_only else INTERNAL_FIELDS
+        return [{k: v for k, v in t.items() if k not in hidden} for t in templates]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "variants": len(self._bodies)}
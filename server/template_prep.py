@@ -0,0 +1,209 @@
+import os
+import io
+import json
+import hashlib
+import threading
+from typing import Optional, Callable, Tuple
+
+from PIL import Image as PILImage, ImageDraw, ImageFilter
+
+# Bump when the normalization or mask recipe changes so old artifacts get rebuilt.
+PREP_VERSION = 2
+TEMPLATE_MAX_SIDE = 1200
+LOCK_STRIPES = 64
+
+# Why no face box was available for the template. Each reason has its own
+# fallback ellipse (fractions of width/height) and blur radius.
+FALLBACK_MASKS = {
+    "no_detector": ((0.25, 0.1, 0.75, 0.6), 30),
+    "no_faces": ((0.3, 0.15, 0.7, 0.6), 40),
+    "error": ((0.3, 0.2, 0.7, 0.6), 30),
+}
+
+# Masks built under these conditions carry no detector quality at all.
+DEGRADED_FALLBACKS = ("no_detector", "error")
+
+
+def normalize_template(template_bytes: bytes) -> PILImage.Image:
+    template_pil = PILImage.open(io.BytesIO(template_bytes)).convert("RGB")
+    if template_pil.width > TEMPLATE_MAX_SIDE or template_pil.height > TEMPLATE_MAX_SIDE:
+        template_pil.thumbnail((TEMPLATE_MAX_SIDE, TEMPLATE_MAX_SIDE), PILImage.LANCZOS)
+    return template_pil
+
+
+def build_mask(size: Tuple[int, int], face_bounds=None, fallback: Optional[str] = None) -> PILImage.Image:
+    """Inpainting mask: a padded, blurred ellipse over the face (or a center fallback)."""
+    mask = PILImage.new("L", size, 0)
+    draw = ImageDraw.Draw(mask)
+    w, h = size
+
+    if face_bounds:
+        x_min, y_min, w_face, h_face = face_bounds
+        pad_x = w_face * 0.4
+        pad_top = h_face * 0.8
+        pad_bottom = h_face * 0.5
+        draw.ellipse(
+            (
+                x_min - pad_x,
+                y_min - pad_top,
+                x_min + w_face + pad_x,
+                y_min + h_face + pad_bottom
+            ),
+            fill=255
+        )
+        return mask.filter(ImageFilter.GaussianBlur(radius=30))
+
+    (fx0, fy0, fx1, fy1), radius = FALLBACK_MASKS.get(fallback, FALLBACK_MASKS["error"])
+    draw.ellipse((w*fx0, h*fy0, w*fx1, h*fy1), fill=255)
+    return mask.filter(ImageFilter.GaussianBlur(radius))
+
+
+def _encode_png(img: PILImage.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class PreparedTemplate:
+    """Normalized base PNG, face bounds and mask PNG for one template image."""
+
+    def __init__(self, sha256: str, base_png: bytes, mask_png: bytes, meta: dict):
+        self.sha256 = sha256
+        self.base_png = base_png
+        self.mask_png = mask_png
+        self.meta = meta
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.meta["width"], self.meta["height"])
+
+    @property
+    def face_bounds(self):
+        bounds = self.meta.get("face_bounds")
+        return tuple(bounds) if bounds else None
+
+    @property
+    def fallback(self) -> Optional[str]:
+        return self.meta.get("fallback")
+
+    def base_image(self) -> PILImage.Image:
+        return PILImage.open(io.BytesIO(self.base_png)).convert("RGB")
+
+    def mask_image(self) -> PILImage.Image:
+        return PILImage.open(io.BytesIO(self.mask_png)).convert("L")
+
+
+def build_prepared(sha: str, template_pil: PILImage.Image, face_bounds, fallback: Optional[str],
+                   detector_quality: int) -> PreparedTemplate:
+    """
+    Mask and PNG encoding for a normalized template whose face was already
+    looked up. Pure CPU, so it can run in a worker process.
+    """
+    if fallback in DEGRADED_FALLBACKS:
+        detector_quality = 0
+    mask_pil = build_mask(template_pil.size, face_bounds, fallback)
+    meta = {
+        "version": PREP_VERSION,
+        "sha256": sha,
+        "width": template_pil.width,
+        "height": template_pil.height,
+        "face_bounds": list(face_bounds) if face_bounds else None,
+        "fallback": fallback,
+        "detector_quality": detector_quality,
+    }
+    return PreparedTemplate(sha, _encode_png(template_pil), _encode_png(mask_pil), meta)
+
+
+class TemplatePreparer:
+    """
+    Builds template artifacts once per image and stores them under
+    `<root_dir>/<sha256 of source image>/` as base.png, mask.png and meta.json.
+
+    `detect_face(img_pil)` returns `(face_bounds, fallback)` where exactly one
+    is set; `detector_quality()` rates the detector available right now.
+    Artifacts built with a lower-rated detector are rebuilt on next use.
+    """
+
+    def __init__(self, root_dir: str,
+                 detect_face: Callable[[PILImage.Image], Tuple[Optional[tuple], Optional[str]]],
+                 detector_quality: Callable[[], int] = lambda: 0):
+        self.root_dir = root_dir
+        self.detect_face = detect_face
+        self.detector_quality = detector_quality
+        # Striped: a fixed set of locks shared by hash, not one kept per sha forever.
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _dir(self, sha: str) -> str:
+        return os.path.join(self.root_dir, sha)
+
+    def _lock_for(self, sha: str) -> threading.Lock:
+        return self._locks[int(sha[:8], 16) % LOCK_STRIPES]
+
+    def load(self, sha: str) -> Optional[PreparedTemplate]:
+        """Returns stored artifacts for `sha`, or None if missing or stale."""
+        folder = self._dir(sha)
+        try:
+            with open(os.path.join(folder, "meta.json"), "r") as f:
+                meta = json.load(f)
+            if meta.get("version") != PREP_VERSION:
+                return None
+            if meta.get("detector_quality", 0) < self.detector_quality():
+                return None
+            with open(os.path.join(folder, "base.png"), "rb") as f:
+                base_png = f.read()
+            with open(os.path.join(folder, "mask.png"), "rb") as f:
+                mask_png = f.read()
+        except (OSError, ValueError):
+            return None
+        return PreparedTemplate(sha, base_png, mask_png, meta)
+
+    def prepare(self, image_bytes: bytes, sha256: Optional[str] = None,
+                persist: bool = True, force: bool = False) -> PreparedTemplate:
+        sha = sha256 or hashlib.sha256(image_bytes).hexdigest()
+        if not force:
+            prepared = self.load(sha)
+            if prepared:
+                return prepared
+
+        with self._lock_for(sha):
+            # Another thread may have finished the build while we waited.
+            if not force:
+                prepared = self.load(sha)
+                if prepared:
+                    return prepared
+            prepared = self._build(sha, image_bytes)
+            if persist:
+                self._write(prepared)
+            return prepared
+
+    def _build(self, sha: str, image_bytes: bytes) -> PreparedTemplate:
+        template_pil = normalize_template(image_bytes)
+        quality = self.detector_quality()
+        face_bounds, fallback = self.detect_face(template_pil)
+        return build_prepared(sha, template_pil, face_bounds, fallback, quality)
+
+    def store(self, prepared: PreparedTemplate):
+        """Stores artifacts built elsewhere (e.g. in a worker process)."""
+        with self._lock_for(prepared.sha256):
+            self._write(prepared)
+
+    def _write(self, prepared: PreparedTemplate):
+        # Caller holds the sha's lock; temp names are per process and thread
+        # anyway, since other workers may write the same sha.
+        folder = self._dir(prepared.sha256)
+        suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(folder, exist_ok=True)
+            for name, data in (("base.png", prepared.base_png), ("mask.png", prepared.mask_png)):
+                tmp = os.path.join(folder, f"{name}.{suffix}")
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, os.path.join(folder, name))
+            # meta.json goes last: its presence marks the artifact set as complete.
+            tmp = os.path.join(folder, f"meta.json.{suffix}")
+            with open(tmp, "w") as f:
+                json.dump(prepared.meta, f)
+            os.replace(tmp, os.path.join(folder, "meta.json"))
+        except OSError as e:
+            print(f"Failed to store prepared template {prepared.sha256}: {e}")
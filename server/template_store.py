@@ -0,0 +1,197 @@
+"""
+SQLite-backed template repository.
+
+One row per template (the full entry as JSON, plus indexed id and category).
+Every write runs in a single IMMEDIATE transaction and bumps a version
+counter, so concurrent admin writes serialize instead of clobbering each
+other, and each worker only re-reads the table when the version moved.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS templates (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    category TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_templates_category ON templates(category, position);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+
+
+class TemplateNotFound(KeyError):
+    pass
+
+
+class TemplateStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._cache_lock = threading.Lock()
+        self._cache_version = -1
+        self._cache: List[Dict] = []
+        self._by_id: Dict[str, Dict] = {}
+        # executescript manages its own transaction; every statement is idempotent.
+        self._conn().executescript(SCHEMA)
+
+    # --- connections ---
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    class _Tx:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+            return False
+
+    def _tx(self):
+        return self._Tx(self._conn())
+
+    @staticmethod
+    def _bump(conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    # --- migration ---
+
+    def migrate(self, json_path: Optional[str], initial: Iterable[Dict],
+                normalize: Callable[[List[Dict]], List[Dict]] = lambda t: t) -> int:
+        """Imports `json_path` (or `initial` if unreadable) into an empty store."""
+        with self._tx() as conn:
+            if conn.execute("SELECT COUNT(*) FROM templates").fetchone()[0]:
+                return 0
+            templates = None
+            if json_path and os.path.exists(json_path):
+                try:
+                    with open(json_path, "r") as f:
+                        templates = json.load(f)
+                except Exception as e:
+                    print(f"Could not read {json_path} ({e}); seeding defaults.")
+            if not templates:
+                templates = json.loads(json.dumps(list(initial)))
+            templates = normalize(templates)
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO templates (id, position, category, data, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(t["id"], i, t.get("category"), json.dumps(t), now) for i, t in enumerate(templates)],
+            )
+            self._bump(conn)
+            print(f"Imported {len(templates)} templates into {self.path}")
+            return len(templates)
+
+    # --- reads ---
+
+    def version(self) -> int:
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def _refresh(self) -> Tuple[int, List[Dict]]:
+        version = self.version()
+        with self._cache_lock:
+            if version == self._cache_version:
+                return version, self._cache
+        rows = self._conn().execute("SELECT data FROM templates ORDER BY position").fetchall()
+        templates = [json.loads(r[0]) for r in rows]
+        with self._cache_lock:
+            self._cache = templates
+            self._by_id = {t["id"]: t for t in templates}
+            self._cache_version = version
+        return version, templates
+
+    def snapshot(self) -> Tuple[int, List[Dict]]:
+        """Returns (version, templates) read together; treat the list as read-only."""
+        return self._refresh()
+
+    def all(self) -> List[Dict]:
+        return self._refresh()[1]
+
+    def get(self, template_id: str) -> Optional[Dict]:
+        self._refresh()
+        with self._cache_lock:
+            return self._by_id.get(template_id)
+
+    def by_category(self, category: str) -> List[Dict]:
+        rows = self._conn().execute(
+            "SELECT data FROM templates WHERE category = ? ORDER BY position", (category,)
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    # --- writes ---
+
+    def update(self, template_id: str, mutate: Callable[[Dict], None]) -> Dict:
+        """Applies `mutate` to one entry atomically; raises TemplateNotFound."""
+        return self.update_many({template_id: mutate})[template_id]
+
+    def update_many(self, mutations: Dict[str, Callable[[Dict], None]]) -> Dict[str, Dict]:
+        """Applies several per-template mutations in one transaction and one version bump."""
+        updated = {}
+        with self._tx() as conn:
+            for template_id, mutate in mutations.items():
+                row = conn.execute("SELECT data FROM templates WHERE id = ?", (template_id,)).fetchone()
+                if not row:
+                    raise TemplateNotFound(template_id)
+                entry = json.loads(row[0])
+                mutate(entry)
+                conn.execute(
+                    "UPDATE templates SET data = ?, category = ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(entry), entry.get("category"), time.time(), template_id),
+                )
+                updated[template_id] = entry
+            if updated:
+                self._bump(conn)
+        return updated
+
+    @staticmethod
+    def _prepend_image(url: str, image_hash: Optional[str]) -> Callable[[Dict], None]:
+        def mutate(t):
+            if 'images' not in t: t['images'] = []
+            # Content-addressed URLs: re-uploading the same image moves it to the front.
+            if url in t['images']: t['images'].remove(url)
+            t['images'].insert(0, url)
+            t['coverImage'] = url
+            if image_hash: t.setdefault('prepared', {})[url] = image_hash
+        return mutate
+
+    def add_image(self, template_id: str, url: str, image_hash: Optional[str] = None) -> Dict:
+        """Prepends `url` to the template's images and makes it the cover."""
+        return self.update(template_id, self._prepend_image(url, image_hash))
+
+    def add_images(self, entries: Iterable[Tuple[str, str, Optional[str]]]) -> Dict[str, Dict]:
+        """add_image for many (template_id, url, image_hash) in one transaction; the last one per template becomes its cover."""
+        per_template: Dict[str, List[Callable[[Dict], None]]] = {}
+        for template_id, url, image_hash in entries:
+            per_template.setdefault(template_id, []).append(self._prepend_image(url, image_hash))
+        return self.update_many({
+            template_id: (lambda t, fns=fns: [fn(t) for fn in fns])
+            for template_id, fns in per_template.items()
+        })
+
+    def export_json(self, json_path: str):
+        """Writes the current catalogue as templates.json (atomic rename)."""
+        tmp = f"{json_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.all(), f, indent=2)
+        os.replace(tmp, json_path)
@@ -0,0 +1,75 @@
+"""
+Cold start budget: a fresh interpreter imports main with the offline fakes
+(bench/fakes.py), and /ready and the first /generate-meme must finish within
+budget. Runs in a subprocess so nothing imported by pytest or earlier tests
+warms the process up.
+
+Budgets are seconds and can be loosened for slow CI machines:
+COLD_START_READY_SECONDS (process start to /ready = 200) and
+COLD_START_GENERATE_SECONDS (first poster, including the CPU pool's first
+worker spawn).
+
+    cd server && python -m pytest -q tests/test_cold_start.py
+"""
+import os
+import sys
+import json
+import subprocess
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_BUDGET = float(os.getenv("COLD_START_READY_SECONDS", "2.0"))
+GENERATE_BUDGET = float(os.getenv("COLD_START_GENERATE_SECONDS", "10.0"))
+
+PROBE = """
+import sys, json, time
+started = time.perf_counter()
+from bench import fakes
+fakes.prepare_env()
+import main
+imported = time.perf_counter()
+fakes.install(main)
+from fastapi.testclient import TestClient
+
+form = dict(template_id="cold", user_name="Jo", movie_title="Cold Start", tagline="t", cover_text="c",
+            tone="Action", costume_description="a suit")
+files = {
+    "user_photo": ("user.jpg", fakes.synthetic_photo((800, 600), (120, 100, 90)), "image/jpeg"),
+    "template_photo": ("template.jpg", fakes.synthetic_photo((600, 800), (20, 30, 40)), "image/jpeg"),
+}
+with TestClient(main.app) as client:
+    while client.get("/ready").status_code != 200:
+        if time.perf_counter() - started > 60:
+            break
+        time.sleep(0.01)
+    ready = time.perf_counter()
+    response = client.post("/generate-meme", files=files, data=form)
+    generated = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - started,
+    "ready_s": ready - started,
+    "generate_s": generated - ready,
+    "status": response.status_code,
+    "body": response.json(),
+}))
+"""
+
+
+def _probe() -> dict:
+    env = dict(os.environ, PYTHONPATH=SERVER_DIR)
+    proc = subprocess.run([sys.executable, "-c", PROBE], cwd=SERVER_DIR, env=env,
+                          capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def test_ready_and_first_poster_within_budget():
+    result = _probe()
+
+    assert result["status"] == 200, result["body"]
+    assert result["body"]["public_url"], result["body"]
+    assert not result["body"]["degraded"], result["body"]
+    assert result["ready_s"] <= READY_BUDGET, (
+        f"/ready took {result['ready_s']:.2f}s from process start (budget {READY_BUDGET}s, "
+        f"import main {result['import_s']:.2f}s)")
+    assert result["generate_s"] <= GENERATE_BUDGET, (
+        f"first /generate-meme took {result['generate_s']:.2f}s (budget {GENERATE_BUDGET}s)")